@@ -11,9 +11,10 @@ Miscellaneous functions for creating blocks.
 from collections import OrderedDict
 from datetime import datetime
 from typing import List
-from blockchain_proto.blockchain.puzzle import sha_256_hash_string, solve_puzzle, check_solution
+from blockchain_proto.blockchain.puzzle import sha_256_hash_string
 from blockchain_proto.transactions.transaction import Transaction
 from blockchain_proto.blockchain.block_simple import BlockHeader, BlockSimple
+from blockchain_proto.blockchain.consensus import ConsensusEngine, PROOF_OF_WORK
 
 
 
@@ -84,23 +85,52 @@ def solve_block_puzzle(trans_hash: str,
     str:
         The solution to the puzzle.
     """
-    puzzle_string = "".join([trans_hash,
-                             prev_block_hash,
-                             str(timestamp),
-                             str(difficulty)])
-    return str(solve_puzzle(puzzle_string, difficulty))
+    return PROOF_OF_WORK.seal(trans_hash, prev_block_hash, timestamp, difficulty)
 
 
 def create_block(transactions: List[Transaction],
                  prev_block_hash: str,
-                 difficulty: int) -> BlockSimple:
+                 difficulty: int,
+                 trans_hash: str = None,
+                 engine: ConsensusEngine = None) -> BlockSimple:
+    """
+    Creates a block with the given transactions on top of the given
+    block, sealed by the given consensus engine, by default by solving
+    the puzzle for it at the given difficulty level.
+
+    Parameters
+    ----------
+    transactions: list of Transaction
+        The transactions that will go into the block.
+
+    prev_block_hash: str
+        Hash of the previous block.
 
-    trans_hash = Transaction.get_trans_hash(transactions)
+    difficulty: int
+        The difficulty level of the puzzle to solve.
+
+    trans_hash: str
+        The hash of the transactions if it was already computed
+        (e.g. by a BlockTemplate), otherwise it is computed here.
+
+    engine: ConsensusEngine
+        The consensus engine sealing the block, proof of work if None.
+
+    Returns
+    -------
+
+    BlockSimple:
+        The created block.
+    """
+    if trans_hash is None:
+        trans_hash = Transaction.get_trans_hash(transactions)
+    if engine is None:
+        engine = PROOF_OF_WORK
     timestamp = datetime.now()
-    nonce = solve_block_puzzle(trans_hash,
-                               prev_block_hash,
-                               timestamp,
-                               difficulty)
+    nonce = engine.seal(trans_hash,
+                        prev_block_hash,
+                        timestamp,
+                        difficulty)
     block_hash = create_block_hash(trans_hash,
                                    prev_block_hash,
                                    timestamp,
@@ -118,15 +148,30 @@ def create_block(transactions: List[Transaction],
     return BlockSimple(new_block_header, transactions)
 
 
-def validate_block_hashes(block: BlockSimple):
+def validate_block_hashes(block: BlockSimple, engine: ConsensusEngine = None):
     """
-    Makes sure that the block puzzle was solved correctly.
+    Makes sure that the block hash matches the contents of the block
+    and that the block was sealed correctly by the given consensus
+    engine, by default that its puzzle was solved correctly.
+    """
+    trans_hash = validate_block_hash(block)
+    validate_block_puzzle(block, trans_hash, engine)
+    return True
+
+
+def validate_block_hash(block: BlockSimple) -> str:
+    """
+    Makes sure that the block hash in the header matches the contents of
+    the block, i.e. its transactions and the rest of the header. Raises a
+    ValueError if it does not.
+
+    Returns
+    -------
+
+    str:
+        The hash of the transactions in the block.
     """
     trans_hash = Transaction.get_trans_hash(block.transactions)
-    puzzle_string = "".join([trans_hash,
-                             block.block_header.prev_block_hash,
-                             str(block.block_header.timestamp),
-                             str(block.block_header.difficulty)])
     block_hash = create_block_hash(trans_hash,
                                    block.block_header.prev_block_hash,
                                    block.block_header.timestamp,
@@ -135,12 +180,30 @@ def validate_block_hashes(block: BlockSimple):
     if block_hash != block.block_header.block_hash:
         raise ValueError(f"Invalid block: block-hash in block header is {block.block_header.block_hash}"
                          f" block hash calculated is {block_hash}.")
+    return trans_hash
 
-    if not check_solution(puzzle_string, block.block_header.nonce, block.block_header.difficulty):
-        raise ValueError(f"Invalid block: invalid puzzle solution {block.block_header.nonce}"
-                         f" for puzzle {puzzle_string} at difficulty {block.block_header.difficulty}.")
-    
-    return True
+
+def validate_block_puzzle(block: BlockSimple, trans_hash: str = None, engine: ConsensusEngine = None):
+    """
+    Makes sure that the block was sealed correctly by the given consensus
+    engine, by default that its puzzle was solved correctly. Raises a
+    ValueError if it was not.
+
+    Parameters
+    ----------
+
+    block: BlockSimple
+        The block to check.
+
+    trans_hash: str
+        The hash of the transactions in the block if already computed.
+
+    engine: ConsensusEngine
+        The consensus engine to check the block with, proof of work if None.
+    """
+    if trans_hash is None:
+        trans_hash = Transaction.get_trans_hash(block.transactions)
+    (engine if engine is not None else PROOF_OF_WORK).verify_seal(block, trans_hash)
 
 
 class BlockMap:
@@ -0,0 +1,125 @@
+"""
+Copyright 2022 M. M. Hassan Mahmud
+
+This Source Code Form is subject to the terms of the Mozilla Public
+License, v. 2.0. If a copy of the MPL was not distributed with this
+file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+
+Implements the scheduling of block production by time, and the
+tracking of how long transactions wait before being added to a block.
+"""
+from bisect import bisect_left
+from typing import List
+
+from blockchain_proto.transactions.transaction import Transaction
+from blockchain_proto.consts import LATENCY_BUCKETS, LATENCY_COUNTS, LATENCY_TOTAL, LATENCY_MAX, \
+    MAX_BLOCK_WAIT
+
+# upper bounds, in seconds, of the buckets of the time in mempool histogram
+DEFAULT_LATENCY_BUCKETS = [0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0]
+
+
+class LatencyHistogram:
+    """
+    Histogram of latencies with fixed buckets. A latency goes in the first
+    bucket whose upper bound it does not exceed, or in an extra last bucket
+    if it exceeds all of them.
+
+    Parameters
+    ----------
+
+    buckets: list of float
+        The increasing upper bounds of the buckets in seconds.
+    """
+    def __init__(self, buckets: List[float] = None):
+        self.buckets = list(buckets) if buckets is not None else list(DEFAULT_LATENCY_BUCKETS)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.total = 0
+        self.max_latency = 0.0
+
+    def record(self, latency: float):
+        """
+        Adds a latency in seconds to the histogram.
+        """
+        self.counts[bisect_left(self.buckets, latency)] += 1
+        self.total += 1
+        self.max_latency = max(self.max_latency, latency)
+
+    def to_json(self) -> dict:
+        """
+        Returns a json representation of the histogram.
+        """
+        return {
+            LATENCY_BUCKETS: self.buckets + ['inf'],
+            LATENCY_COUNTS: list(self.counts),
+            LATENCY_TOTAL: self.total,
+            LATENCY_MAX: self.max_latency
+        }
+
+
+class BlockProductionScheduler:
+    """
+    Keeps the time each free transaction was admitted, to decide when a
+    partial block should be sealed so that no transaction waits for more
+    than max_wait seconds for a block, and to record in a histogram how
+    long transactions waited before being added to a block.
+
+    Parameters
+    ----------
+
+    max_wait: float
+        Number of seconds after which the waiting transactions are sealed
+        into a block even if there are not enough for a full block. If None,
+        blocks are only created when full.
+
+    buckets: list of float
+        The upper bounds of the buckets of the time in mempool histogram.
+    """
+    def __init__(self, max_wait: float = None, buckets: List[float] = None):
+        self.max_wait = max_wait
+        self.admit_times = {}
+        self.histogram = LatencyHistogram(buckets)
+
+    def trans_admitted(self, trans_list: List[Transaction], now: float):
+        """
+        Records that the given transactions were admitted at the given time.
+        """
+        for trans in trans_list:
+            self.admit_times.setdefault((trans.user_id, trans.trans_no), now)
+
+    def trans_confirmed(self, trans_list: List[Transaction], now: float):
+        """
+        Records that the given transactions were added to a block in the
+        longest fork at the given time. Transactions which were not admitted
+        by this node, e.g. ones only seen in incoming blocks, are ignored.
+        """
+        for trans in trans_list:
+            admit_time = self.admit_times.pop((trans.user_id, trans.trans_no), None)
+            if admit_time is not None:
+                self.histogram.record(now - admit_time)
+
+    def is_due(self, waiting_trans: List[Transaction], now: float) -> bool:
+        """
+        Returns True if a block should be sealed now, i.e. if any of the
+        waiting transactions was admitted more than max_wait seconds ago.
+
+        Parameters
+        ----------
+
+        waiting_trans: list of Transaction
+            The transactions ready to go into the next block.
+
+        now: float
+            The current time in seconds, e.g. from time.monotonic.
+        """
+        if self.max_wait is None or len(waiting_trans) == 0:
+            return False
+        oldest = min(self.admit_times.get((trans.user_id, trans.trans_no), now) for trans in waiting_trans)
+        return now - oldest >= self.max_wait
+
+    def to_json(self) -> dict:
+        """
+        Returns a json representation of the scheduler.
+        """
+        return {MAX_BLOCK_WAIT: self.max_wait, **self.histogram.to_json()}
@@ -0,0 +1,136 @@
+"""
+Copyright 2022 M. M. Hassan Mahmud
+
+This Source Code Form is subject to the terms of the Mozilla Public
+License, v. 2.0. If a copy of the MPL was not distributed with this
+file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+
+Policies for choosing the number of transactions per block.
+"""
+from typing import Tuple
+
+
+class FixedBlockSize:
+    """
+    Every block has the same number of transactions. Incoming blocks of
+    any size are accepted.
+
+    Parameters
+    ----------
+
+    trans_per_block: int
+        Number of transactions per block.
+    """
+    def __init__(self, trans_per_block: int):
+        self.trans_per_block = trans_per_block
+
+    def current(self) -> int:
+        """
+        Returns the number of transactions the next block should have.
+        """
+        return self.trans_per_block
+
+    def bounds(self) -> Tuple[int, int]:
+        """
+        Returns the minimum and maximum number of transactions allowed in a
+        block, or None if there are no bounds.
+        """
+        return None
+
+    def block_added(self, backlog: int, now: float):
+        """
+        Called when a block is added to the longest fork, see AdaptiveBlockSize.
+        """
+        pass
+
+
+class AdaptiveBlockSize:
+    """
+    Grows or shrinks the number of transactions per block, within bounds,
+    after every block added. The size grows when more than grow_backlog
+    blocks worth of transactions are waiting, or blocks are being added
+    faster than half the target interval, since then small blocks only add
+    overhead. It shrinks when less than a block of transactions is waiting
+    and blocks are being added slower than twice the target interval, so
+    that transactions do not wait long for a block to fill up.
+
+    Parameters
+    ----------
+
+    min_size: int
+        The minimum number of transactions in a block.
+
+    max_size: int
+        The maximum number of transactions in a block.
+
+    target_interval: float
+        The target number of seconds between blocks.
+
+    initial_size: int
+        The number of transactions per block to start with, min_size if None.
+
+    growth: float
+        Factor by which the size is grown or shrunk at a time.
+
+    grow_backlog: int
+        Number of blocks worth of waiting transactions above which the
+        size is grown.
+
+    smoothing: float
+        Weight of the latest interval in the moving average of the intervals
+        between blocks.
+    """
+    def __init__(self,
+                 min_size: int,
+                 max_size: int,
+                 target_interval: float,
+                 initial_size: int = None,
+                 growth: float = 1.5,
+                 grow_backlog: int = 2,
+                 smoothing: float = 0.25):
+        if not 1 <= min_size <= max_size:
+            raise ValueError(f"Invalid block size bounds: {min_size}, {max_size}.")
+        self.min_size = min_size
+        self.max_size = max_size
+        self.target_interval = target_interval
+        self.size = min(max(initial_size if initial_size is not None else min_size, min_size), max_size)
+        self.growth = growth
+        self.grow_backlog = grow_backlog
+        self.smoothing = smoothing
+        self.avg_interval = target_interval
+        self.last_block_time = None
+
+    def current(self) -> int:
+        """
+        Returns the number of transactions the next block should have.
+        """
+        return self.size
+
+    def bounds(self) -> Tuple[int, int]:
+        """
+        Returns the minimum and maximum number of transactions allowed in a block.
+        """
+        return self.min_size, self.max_size
+
+    def block_added(self, backlog: int, now: float):
+        """
+        Updates the block size after a block was added to the longest fork.
+
+        Parameters
+        ----------
+
+        backlog: int
+            The number of transactions ready to go into the next blocks.
+
+        now: float
+            The current time in seconds, e.g. from time.monotonic.
+        """
+        if self.last_block_time is not None:
+            self.avg_interval += self.smoothing * ((now - self.last_block_time) - self.avg_interval)
+        self.last_block_time = now
+
+        if backlog > self.grow_backlog * self.size or self.avg_interval < self.target_interval / 2:
+            self.size = min(self.max_size, max(self.size + 1, int(self.size * self.growth)))
+        elif backlog < self.size and self.avg_interval > 2 * self.target_interval:
+            self.size = max(self.min_size, min(self.size - 1, int(self.size / self.growth)))
@@ -0,0 +1,154 @@
+"""
+Copyright 2022 M. M. Hassan Mahmud
+
+This Source Code Form is subject to the terms of the Mozilla Public
+License, v. 2.0. If a copy of the MPL was not distributed with this
+file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+
+Implements a cache of the transactions that will go into the next block(s).
+"""
+from hashlib import sha256
+from typing import List, Tuple
+
+from blockchain_proto.transactions.transaction import Transaction
+from blockchain_proto.consts import NULL_BLOCK_HASH
+
+
+class BlockTemplate:
+    """
+    Keeps the candidate transactions for the next block(s) on top of a
+    given block, in the order in which they became ready to be added,
+    along with the hash of the transactions of the next block. The hash
+    is updated incrementally as transactions are appended, so that a
+    block can be mined as soon as it is full.
+
+    Since for each user the transactions are appended in trans_no
+    order, any prefix of the candidate transactions is a valid list of
+    transactions for a block.
+    """
+    def __init__(self):
+        self.prev_block_hash = NULL_BLOCK_HASH
+        self.transactions = []
+        self.next_trans_no = {}
+        self.trans_hasher = sha256()
+        self.num_hashed = 0
+
+    def reset(self, prev_block_hash: str, ready_trans: List[Transaction], block_size: int = None):
+        """
+        Rebuilds the template on top of a new block, e.g. when the head of the
+        longest fork changes.
+
+        Parameters
+        ----------
+
+        prev_block_hash: str
+            The hash of the block the next block will be added to.
+
+        ready_trans: list of Transaction
+            The transactions which can be added on top of that block.
+
+        block_size: int
+            The number of transactions in the next block, see extend.
+        """
+        self.prev_block_hash = prev_block_hash
+        self.transactions = []
+        self.next_trans_no = {}
+        self.trans_hasher = sha256()
+        self.num_hashed = 0
+        self.extend(ready_trans, block_size)
+
+    def get_next_trans_no(self, user_id: str, get_latest_trans) -> int:
+        """
+        Returns the trans_no the next candidate transaction of the user must have.
+
+        Parameters
+        ----------
+
+        user_id: str
+            The user to get the next trans_no for.
+
+        get_latest_trans: func
+            Function that gets the latest trans_no for a user at prev_block_hash.
+        """
+        if user_id in self.next_trans_no:
+            return self.next_trans_no[user_id]
+        return get_latest_trans(user_id) + 1
+
+    def extend(self, ready_trans: List[Transaction], block_size: int = None):
+        """
+        Appends transactions to the candidate transactions. The transactions
+        of each user must continue on from the user's next trans_no.
+
+        Parameters
+        ----------
+
+        ready_trans: list of Transaction
+            The transactions to append.
+
+        block_size: int
+            If given, the number of transactions in the next block. The
+            transactions appended that go into it are hashed right away.
+        """
+        for trans in ready_trans:
+            self.transactions.append(trans)
+            self.next_trans_no[trans.user_id] = trans.trans_no + 1
+        if block_size is not None:
+            self._hash_up_to(block_size)
+
+    def _hash_up_to(self, block_size: int):
+        """
+        Feeds the candidate transactions into the running hash until it
+        covers the transactions of the next block. If the block size has
+        shrunk below the number of transactions hashed, the hash is
+        computed again from the start.
+        """
+        if self.num_hashed > block_size:
+            self.trans_hasher = sha256()
+            self.num_hashed = 0
+        end = min(block_size, len(self.transactions))
+        for trans in self.transactions[self.num_hashed:end]:
+            self.trans_hasher.update(str(trans).encode('utf-8'))
+        self.num_hashed = max(self.num_hashed, end)
+
+    def is_full(self, block_size: int) -> bool:
+        """
+        Returns True if there are enough candidate transactions for a block.
+        """
+        return len(self.transactions) >= block_size
+
+    def __len__(self) -> int:
+        return len(self.transactions)
+
+    def get_trans_hash(self, block_size: int) -> str:
+        """
+        Returns the hash of the transactions of the next block, as computed by
+        Transaction.get_trans_hash.
+        """
+        self._hash_up_to(block_size)
+        return self.trans_hasher.copy().hexdigest()
+
+    def pop_block(self, block_size: int) -> Tuple[List[Transaction], str]:
+        """
+        Removes and returns the transactions of the next block along with their hash.
+        The remaining transactions become the candidates for the block after it.
+
+        Parameters
+        ----------
+
+        block_size: int
+            The number of transactions in the block.
+
+        Returns
+        -------
+
+        list of Transaction, str:
+            The transactions of the block and their hash.
+        """
+        trans_hash = self.get_trans_hash(block_size)
+        block_trans = self.transactions[0:block_size]
+        self.transactions = self.transactions[block_size:]
+        self.trans_hasher = sha256()
+        self.num_hashed = 0
+        self._hash_up_to(block_size)
+        return block_trans, trans_hash
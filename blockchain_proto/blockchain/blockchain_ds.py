@@ -9,17 +9,24 @@ file, You can obtain one at https://mozilla.org/MPL/2.0/.
 Implements a simple blockchain data structure.
 """
 from os import remove, times
-from typing import Union, List
+from typing import Union, List, Tuple
 import logging
+import time
 
-from blockchain_proto.blockchain.block_simple import BlockSimple
+from blockchain_proto.blockchain.block_simple import BlockSimple, BlockHeader
 from blockchain_proto.transactions.transaction import Transaction
 from blockchain_proto.transactions.free_transaction_manager import FreeTransactionManager
+from blockchain_proto.transactions.mempool_wal import MempoolWAL
 from blockchain_proto.forks.fork import Fork
 from blockchain_proto.forks.fork_manager import ForkManager
 from blockchain_proto.blockchain.block_helper import create_block, BlockMap
+from blockchain_proto.blockchain.block_template import BlockTemplate
+from blockchain_proto.blockchain.consensus import ConsensusEngine, PROOF_OF_WORK
+from blockchain_proto.blockchain.block_size import FixedBlockSize
+from blockchain_proto.blockchain.block_production import BlockProductionScheduler
 from blockchain_proto.consts import *
-from blockchain_proto.exceptions import BlockWasAlreadyAddedError, TransWasAlreadyAddedError
+from blockchain_proto.exceptions import BlockWasAlreadyAddedError, UnorderedTransactionError, \
+    EarliestTransMismatchError, BlockSizeError
 from blockchain_proto.log_messages import log_info, log_debug, log_warning, log_error, log_critical
 
 
@@ -32,17 +39,79 @@ class BlockChain(object):
     ----------
 
     trans_per_block: int
-        Number of transactions per block.
+        Number of transactions per block, unless a block_size_policy is given.
 
     difficulty: int
         The level of difficulty level for the puzzles in the blockchain.
+
+    mempool_wal_path: str
+        If given, path of a write-ahead log used to persist the free
+        transactions across restarts.
+
+    finality_depth: int
+        Number of blocks behind the head of the longest fork after which
+        blocks are final, see ForkManager. Uses the ForkManager default if None.
+
+    cleanup_interval: int
+        Forks which have become too short are cleaned up every time this
+        many blocks have been added, as well as when the node is idle.
+
+    cleanup_budget: int
+        The maximum number of forks dropped by each cleanup, or None for no
+        limit. Any remaining forks are dropped by later cleanups.
+
+    self_check: bool
+        If True, blocks created by this node are fully validated, including
+        their hashes and puzzle solutions, before being added. For debugging.
+
+    assume_valid_hashes: list of str
+        Hashes of trusted checkpoint blocks. The puzzle solutions of these
+        blocks and their ancestors are not checked when added in bulk.
+
+    consensus: ConsensusEngine
+        The consensus engine used to seal new blocks and check incoming
+        ones, proof of work if None.
+
+    block_size_policy: FixedBlockSize | AdaptiveBlockSize
+        Policy for the number of transactions per block. If it has bounds,
+        incoming blocks must have a number of transactions within them.
+        Defaults to a fixed size of trans_per_block.
+
+    max_block_wait: float
+        If given, the ready transactions are sealed into a (possibly partial)
+        block by tick once one of them has waited this many seconds.
     """
-    def __init__(self, trans_per_block: int, difficulty: int):
-        self.trans_per_block = trans_per_block
+    def __init__(self, trans_per_block: int, difficulty: int, mempool_wal_path: str = None,
+                 finality_depth: int = None, cleanup_interval: int = DEFAULT_CLEANUP_INTERVAL,
+                 cleanup_budget: int = DEFAULT_CLEANUP_BUDGET, self_check: bool = False,
+                 assume_valid_hashes: List[str] = None, consensus: ConsensusEngine = None,
+                 block_size_policy=None, max_block_wait: float = None):
+        self.block_size_policy = block_size_policy if block_size_policy is not None \
+            else FixedBlockSize(trans_per_block)
         self.difficulty = difficulty
         self.block_map = BlockMap()
-        self.free_trans_manager = FreeTransactionManager()
-        self.fork_manager = ForkManager()
+        self.consensus = consensus if consensus is not None else PROOF_OF_WORK
+        wal = MempoolWAL(mempool_wal_path) if mempool_wal_path else None
+        self.free_trans_manager = FreeTransactionManager(wal)
+        self.fork_manager = ForkManager(finality_depth, assume_valid_hashes, self.consensus,
+                                        self.block_size_policy.bounds())
+        self.block_template = BlockTemplate()
+        self._reset_block_template()
+        self.cleanup_interval = cleanup_interval
+        self.cleanup_budget = cleanup_budget
+        self.blocks_since_cleanup = 0
+        self.self_check = self_check
+        self.production_scheduler = BlockProductionScheduler(max_block_wait)
+        # hashes of the blocks in the longest fork, by height
+        self.main_chain = []
+        self.main_chain_heights = {}
+
+    @property
+    def trans_per_block(self) -> int:
+        """
+        The number of transactions the next block created will have.
+        """
+        return self.block_size_policy.current()
 
     def add_transaction(self, transaction: Transaction) -> List[BlockSimple]:
         """
@@ -65,24 +134,120 @@ class BlockChain(object):
             As described in the function description.
         """
         self.free_trans_manager.add_transaction(transaction)
+        self.production_scheduler.trans_admitted([transaction], time.monotonic())
+        self._update_block_template([transaction])
+        return self._create_blocks_if_ready()
+
+    def add_transactions(self, trans_list: List[Transaction]) -> Tuple[List[BlockSimple], List[Transaction]]:
+        """
+        Adds a list of transactions in one go, and then creates any blocks that
+        can be created from them.
+
+        Parameters
+        ----------
+
+        trans_list: list of Transaction
+            The transactions to add.
+
+        Returns
+        -------
+
+        list of BlockSimple, list of Transaction:
+            The blocks created, and the transactions that were not added because
+            they were added before.
+        """
+        already_added = self.free_trans_manager.add_transactions(trans_list)
+        if len(already_added) > 0:
+            already_added_ids = set((trans.user_id, trans.trans_no) for trans in already_added)
+            trans_list = [trans for trans in trans_list
+                          if (trans.user_id, trans.trans_no) not in already_added_ids]
+        self.production_scheduler.trans_admitted(trans_list, time.monotonic())
+        self._update_block_template(trans_list)
+        return self._create_blocks_if_ready(), already_added
+
+    def _reset_block_template(self):
+        """
+        Rebuilds the block template on top of the head of the longest fork
+        from the valid free transactions. Called when the head changes.
+        """
+        fork = self.fork_manager.get_longest_fork()
+        self.block_template.reset(
+            fork.head_block_hash if fork else NULL_BLOCK_HASH,
+            self.free_trans_manager.get_valid_trans(self.fork_manager.get_longest_latest_trans_no),
+            self.trans_per_block)
+
+    def _update_block_template(self, new_trans: List[Transaction]):
+        """
+        Appends to the block template the transactions that have become
+        ready because of the newly added free transactions, i.e. the run
+        of free transactions starting at the next trans_no for each user
+        that has a new transaction with that trans_no.
 
-        if self.free_trans_manager.num_free() >= self.trans_per_block:
-            # TODO: get the latest transactions for the users
-            valid_trans = self.free_trans_manager.get_valid_trans(self.fork_manager.get_longest_latest_trans_no)
-            if len(valid_trans) < self.trans_per_block: 
-                return []
-            return self.add_new_blocks(valid_trans)
+        Parameters
+        ----------
+
+        new_trans: list of Transaction
+            The transactions that were just added to the free transactions.
+        """
+        next_trans_nos = {}
+        for trans in new_trans:
+            if trans.user_id in next_trans_nos:
+                continue
+            next_trans_no = self.block_template.get_next_trans_no(
+                trans.user_id, self.fork_manager.get_longest_latest_trans_no)
+            if trans.trans_no == next_trans_no:
+                next_trans_nos[trans.user_id] = next_trans_no
+        if len(next_trans_nos) > 0:
+            self.block_template.extend(self.free_trans_manager.get_ready_runs(next_trans_nos), self.trans_per_block)
+
+    def _create_blocks_if_ready(self) -> List[BlockSimple]:
+        """
+        Creates and adds new blocks if there are enough valid free transactions.
+        """
+        if self.block_template.is_full(self.trans_per_block):
+            return self.add_new_blocks()
         return []
 
-    def add_new_blocks(self, valid_trans: List[Transaction]) -> List[BlockSimple]:
+    def tick(self, now: float = None) -> List[BlockSimple]:
         """
-        Create and add new blocks using the valid transactions to the given form.
+        Seals the ready transactions into a block, even if there are not
+        enough of them for a full block, if one of them has waited for
+        longer than max_block_wait. Should be called regularly, e.g. from
+        the main loop of the node. A partial block is not sealed if it would
+        be smaller than the minimum block size allowed.
 
         Parameters
         ----------
-        valid_trans: [Transaction]
-            List of transactions to add to the new block(s).
-            Assumes that the transactions are ordered by transaction number.
+
+        now: float
+            The current time in seconds from time.monotonic, or None for now.
+
+        Returns
+        -------
+
+        list(BlockSimple):
+            The blocks added.
+        """
+        now = time.monotonic() if now is None else now
+        if not self.production_scheduler.is_due(self.block_template.transactions, now):
+            return []
+        bounds = self.block_size_policy.bounds()
+        if bounds is not None and len(self.block_template) < bounds[0]:
+            return []
+        return self.add_new_blocks(seal_partial=True)
+
+    def add_new_blocks(self, seal_partial: bool = False) -> List[BlockSimple]:
+        """
+        Create and add new blocks to the longest fork using the transactions
+        in the block template, for as long as it has enough transactions for
+        a block.
+
+        Parameters
+        ----------
+
+        seal_partial: bool
+            If True, a block is created from the transactions in the block
+            template even if there are not enough for a full block.
 
         Returns
         -------
@@ -90,28 +255,33 @@ class BlockChain(object):
             All the blocks added
         """
         log_info(logging, "Adding new blocks to the chain...")
-        trans_to_remove = []
         fork = self.fork_manager.get_longest_fork()
-        latest_block_hash = fork.head_block_hash if fork else NULL_BLOCK_HASH
+        if self.block_template.prev_block_hash != (fork.head_block_hash if fork else NULL_BLOCK_HASH):
+            self._reset_block_template()
         blocks_added = []
-        while len(valid_trans) >= self.trans_per_block:
-            new_block = create_block(valid_trans[0:self.trans_per_block],
-                                     latest_block_hash,
-                                     self.difficulty)
+        while self.block_template.is_full(self.trans_per_block) or \
+              (seal_partial and len(blocks_added) == 0 and len(self.block_template) > 0):
+            block_trans, trans_hash = self.block_template.pop_block(self.trans_per_block)
+            new_block = create_block(block_trans,
+                                     self.block_template.prev_block_hash,
+                                     self.difficulty,
+                                     trans_hash,
+                                     self.consensus)
             self.block_map.add(new_block)
-            latest_block_hash = new_block.block_header.block_hash
-
-            trans_to_remove.extend(valid_trans[0:self.trans_per_block])
-            valid_trans = valid_trans[self.trans_per_block:]
+            self.block_template.prev_block_hash = new_block.hash()
             blocks_added.append(new_block)
-        self.fork_manager.add_blocks(blocks_added)
-        remove_failures = self.free_trans_manager.remove_older_and_equal_trans(trans_to_remove)
+            self.block_size_policy.block_added(len(self.block_template), time.monotonic())
+        add_status = self.fork_manager.add_local_blocks(blocks_added, self.self_check)
+        for status in add_status:
+            if status != 1:
+                log_critical(logging, f"Failed to add a block created by this node: {status}")
+        remove_failures = self._apply_reorg_diffs(reset_template=False)
         if len(remove_failures) > 0:
             log_critical(logging, "Something went wrong when adding transactions.")
             log_critical(logging, "Failed to remove the following unadded transactions after they were added to a block.")
             for t in remove_failures:
                 log_critical(logging, str(t))
-        self.cleanup()
+        self._schedule_cleanup(len(blocks_added))
         log_info(logging, f"Added: {len(blocks_added)} blocks.")
         return blocks_added
 
@@ -144,28 +314,193 @@ class BlockChain(object):
             return ret_val[0]
         
         self.block_map.add(incoming_block)
-        self.free_trans_manager.update_trans_in_inc_block(incoming_block.transactions)
-        self.free_trans_manager.remove_older_and_equal_trans(incoming_block.transactions)
+        self._apply_reorg_diffs()
+        self._incoming_block_added(incoming_block)
+        self._schedule_cleanup(1)
         return incoming_block
 
-    def cleanup(self):
+    def add_incoming_blocks(self, incoming_blocks: List[BlockSimple],
+                            headers_checked: bool = False) -> List[BlockSimple]:
+        """
+        Adds blocks sent by another peer in bulk, e.g. when syncing with a peer
+        after coming online. Blocks are validated as in add_incoming_block,
+        except that the puzzle solutions of the trusted checkpoint blocks in
+        the list and their ancestors are not checked. Blocks which were added
+        before or fail validation are skipped.
+
+        Parameters
+        ----------
+
+        incoming_blocks: list of BlockSimple
+            The blocks to add, each after the block it is added to.
+
+        headers_checked: bool
+            If True, the block hashes and puzzle solutions are not checked,
+            as for the blocks returned by HeaderSync.blocks_received, whose
+            headers were checked and whose bodies were checked to match them.
+
+        Returns
+        -------
+
+        list of BlockSimple:
+            The blocks which were added.
+        """
+        new_blocks = [block for block in incoming_blocks if block.hash() not in self.block_map]
+        if not headers_checked:
+            self.fork_manager.assume_valid.add_blocks(new_blocks)
+        blocks_added = []
+        for block in new_blocks:
+            try:
+                ret_val = self.fork_manager.add_blocks([block], verify_hashes=not headers_checked)
+            except (ValueError, UnorderedTransactionError, EarliestTransMismatchError, BlockSizeError) as e:
+                log_error(logging, f"Error: {e}")
+                continue
+            if ret_val[0] != 1:
+                log_error(logging, f"Error: {ret_val[0]}")
+                continue
+            self.block_map.add(block)
+            blocks_added.append(block)
+
+        self._apply_reorg_diffs()
+        for block in blocks_added:
+            self._incoming_block_added(block)
+        self._schedule_cleanup(len(blocks_added))
+        return blocks_added
+
+    def _incoming_block_added(self, block: BlockSimple):
+        """
+        Lets the block size policy know about an incoming block if it
+        is in the longest fork.
+        """
+        if self.fork_manager.is_in_longest_fork(block.hash()):
+            self.block_size_policy.block_added(len(self.block_template), time.monotonic())
+
+    def _apply_reorg_diffs(self, reset_template: bool = True) -> List[Transaction]:
+        """
+        Updates the free transactions with the changes to the longest fork
+        since the last update: the transactions in disconnected blocks are
+        released, and the ones in connected blocks are removed. So the work
+        done depends on the size of the changes and not on the size of
+        the forks.
+
+        Parameters
+        ----------
+
+        reset_template: bool
+            If True, the block template is rebuilt if the longest fork changed.
+
+        Returns
+        -------
+
+        list of Transaction:
+            Transactions in connected blocks which were not free.
+        """
+        reorg_diffs = self.fork_manager.pop_reorg_diffs()
+        remove_failures = []
+        released_trans = []
+        now = time.monotonic()
+        for reorg_diff in reorg_diffs:
+            for bhash in reorg_diff.disconnected:
+                del self.main_chain_heights[bhash]
+            del self.main_chain[len(self.main_chain) - len(reorg_diff.disconnected):]
+            for bhash in reorg_diff.connected:
+                self.main_chain_heights[bhash] = len(self.main_chain)
+                self.main_chain.append(bhash)
+            if reorg_diff.is_reorg():
+                log_info(logging, f"Reorg: disconnected {len(reorg_diff.disconnected)} and connected "
+                                  f"{len(reorg_diff.connected)} blocks.")
+                disconnected_trans = [trans for bhash in reorg_diff.disconnected
+                                      for trans in self.block_map[bhash].transactions]
+                self.free_trans_manager.release_transactions(
+                    disconnected_trans, self.fork_manager.get_longest_latest_trans_no)
+                released_trans.extend(disconnected_trans)
+            connected_trans = [trans for bhash in reorg_diff.connected
+                               for trans in self.block_map[bhash].transactions]
+            remove_failures.extend(self.free_trans_manager.remove_older_and_equal_trans(connected_trans))
+            self.production_scheduler.trans_confirmed(connected_trans, now)
+        self._readmit_released(released_trans, now)
+        if reset_template and len(reorg_diffs) > 0:
+            self._reset_block_template()
+        return remove_failures
+
+    def _readmit_released(self, released_trans: List[Transaction], now: float):
+        """
+        Records the transactions from dropped blocks which are free again as
+        admitted now, so that a block of only such transactions is still
+        sealed after max_block_wait.
+        """
+        if len(released_trans) == 0:
+            return
+        free_trans = self.free_trans_manager.get_transactions(
+            [(trans.user_id, trans.trans_no) for trans in released_trans])
+        self.production_scheduler.trans_admitted(free_trans, now)
+
+    def _schedule_cleanup(self, num_blocks: int):
+        """
+        Runs a cleanup with the cleanup budget once cleanup_interval blocks
+        have been added since the last one.
+
+        Parameters
+        ----------
+
+        num_blocks: int
+            The number of blocks just added.
+        """
+        self.blocks_since_cleanup += num_blocks
+        if self.blocks_since_cleanup >= self.cleanup_interval:
+            self.cleanup(self.cleanup_budget)
+
+    def run_idle_tasks(self) -> bool:
+        """
+        Runs the housekeeping tasks that are put off while the node is busy:
+        writes out the mempool log if due, and runs a cleanup with the
+        cleanup budget if blocks were added since the last one or forks
+        are still waiting to be dropped.
+
+        Returns
+        -------
+
+        bool:
+            True if there is still work left for later calls.
+        """
+        self.free_trans_manager.flush_wal()
+        if self.blocks_since_cleanup > 0 or self.fork_manager.num_forks_to_cleanup() > 0:
+            return self.cleanup(self.cleanup_budget)
+        return False
+
+    def cleanup(self, max_forks: int = None) -> bool:
         """
         Cleans up the blockchain by removing any fork that has become too
         short compared to the longest fork and moves all its transactions into
-        the list of transactions that can be added.
-        """
-        released_bhashes = self.fork_manager.cleanup_forks(self.block_map)
-        for bhash in released_bhashes:
-            block = self.block_map[bhash]
-            for trans in block.transactions:
-                try:
-                    self.free_trans_manager.add_transaction(trans)
-                except TransWasAlreadyAddedError as e:
-                    pass 
-                except Exception as e:
-                    log_error(logging, str(e))
-
-            self.block_map.remove(bhash)
+        the list of transactions that can be added, in one bulk release.
+
+        Parameters
+        ----------
+
+        max_forks: int
+            If given, the maximum number of forks to remove.
+
+        Returns
+        -------
+
+        bool:
+            True if there are forks left to remove.
+        """
+        released_bhashes = self.fork_manager.cleanup_forks(self.block_map, max_forks)
+        self.blocks_since_cleanup = 0
+        if len(released_bhashes) > 0:
+            released_trans = [trans for bhash in released_bhashes
+                              for trans in self.block_map[bhash].transactions]
+            for bhash in released_bhashes:
+                self.block_map.remove(bhash)
+            num_released = self.free_trans_manager.release_transactions(
+                released_trans, self.fork_manager.get_longest_latest_trans_no)
+            log_info(logging, f"Cleanup released {len(released_bhashes)} blocks and "
+                              f"{num_released} transactions.")
+            if num_released > 0:
+                self._readmit_released(released_trans, time.monotonic())
+                self._reset_block_template()
+        return self.fork_manager.num_forks_to_cleanup() > 0
         
     def to_json(self):
         """
@@ -180,6 +515,7 @@ class BlockChain(object):
             FORK_DATA: self.fork_manager.to_json(),
             TRANS_DATA: self.free_trans_manager.to_json(),
             TRANS_PER_BLOCK: self.trans_per_block,
+            BLOCK_PRODUCTION: self.production_scheduler.to_json(),
             DIFFICULTY: self.difficulty,
             BLOCK_MAP: self.block_map.to_json()
         }
@@ -251,6 +587,134 @@ class BlockChain(object):
         """
         return self.free_trans_manager.get_trans_list()
 
+    def get_missing_inventory(self, block_hashes: List[str],
+                              trans_ids: List[Tuple[str, int]]) -> Tuple[List[str], List[Tuple[str, int]]]:
+        """
+        Returns the blocks and transactions, out of the ones announced by a
+        peer, that this node does not have.
+
+        Parameters
+        ----------
+
+        block_hashes: list of str
+            Hashes of the blocks announced.
+
+        trans_ids: list of (str, int)
+            The (user_id, trans_no)'s of the transactions announced.
+
+        Returns
+        -------
+
+        list of str, list of (str, int):
+            The hashes of the missing blocks, and the ids of the missing transactions.
+        """
+        missing_hashes = [bhash for bhash in block_hashes if bhash not in self.block_map]
+        missing_ids = self.free_trans_manager.get_missing_trans_ids(trans_ids) if len(trans_ids) > 0 else []
+        return missing_hashes, missing_ids
+
+    def get_inventory(self, block_hashes: List[str],
+                      trans_ids: List[Tuple[str, int]]) -> Tuple[List[BlockSimple], List[Transaction]]:
+        """
+        Returns the blocks and free transactions with the given hashes and ids
+        which this node has, e.g. to send to a peer that requested them.
+        Transactions which are no longer free are left out, since the peer
+        will get them in blocks.
+        """
+        blocks = [self.block_map[bhash] for bhash in block_hashes if bhash in self.block_map]
+        trans_list = self.free_trans_manager.get_transactions(trans_ids) if len(trans_ids) > 0 else []
+        return blocks, trans_list
+
+    def get_block_transactions(self, block_hash: str, trans_ids: List[Tuple[str, int]]) -> List[Transaction]:
+        """
+        Returns the transactions with the given (user_id, trans_no)'s in the
+        block with the given hash, e.g. for a peer rebuilding the block from
+        a compact block, or an empty list if there is no such block.
+        """
+        if block_hash not in self.block_map:
+            return []
+        trans_ids = set(trans_ids)
+        return [trans for trans in self.block_map[block_hash].transactions
+                if (trans.user_id, trans.trans_no) in trans_ids]
+
+    def get_headers(self, start_height: int, count: int) -> List[BlockHeader]:
+        """
+        Returns a page of the headers of the blocks in the longest fork.
+
+        Parameters
+        ----------
+
+        start_height: int
+            Height of the first block, the first block in the chain has height 0.
+
+        count: int
+            Maximum number of headers returned.
+
+        Returns
+        -------
+
+        list of BlockHeader:
+            The headers, in chain order.
+        """
+        return [self.block_map[bhash].block_header for bhash in self.main_chain[start_height:start_height + count]]
+
+    def get_block_locator(self) -> List[str]:
+        """
+        Returns a block locator for the longest fork: the hashes of the last
+        10 blocks, then of blocks exponentially further back, ending with
+        the first block. A peer finds in it the latest block the two nodes
+        have in common, in a number of steps logarithmic in the height.
+        """
+        locator = []
+        height = len(self.main_chain) - 1
+        step = 1
+        while height > 0:
+            locator.append(self.main_chain[height])
+            if len(locator) >= 10:
+                step *= 2
+            height -= step
+        if len(self.main_chain) > 0:
+            locator.append(self.main_chain[0])
+        return locator
+
+    def get_headers_after(self, locator: List[str], count: int) -> Tuple[int, List[BlockHeader]]:
+        """
+        Returns a page of the headers of the blocks in the longest fork which
+        come after the latest block in the locator that is in it.
+
+        Parameters
+        ----------
+
+        locator: list of str
+            A block locator from a peer, see get_block_locator.
+
+        count: int
+            Maximum number of headers returned.
+
+        Returns
+        -------
+
+        int, list of BlockHeader:
+            The height of the first header, and the headers in chain order.
+        """
+        start_height = 0
+        for bhash in locator:
+            if bhash in self.main_chain_heights:
+                start_height = self.main_chain_heights[bhash] + 1
+                break
+        return start_height, self.get_headers(start_height, count)
+
+    def get_trans_summary(self) -> dict:
+        """
+        See FreeTransactionManager.get_trans_summary.
+        """
+        return self.free_trans_manager.get_trans_summary()
+
+    def get_trans_not_in(self, summary: dict) -> List[Transaction]:
+        """
+        See FreeTransactionManager.get_trans_not_in.
+        """
+        return self.free_trans_manager.get_trans_not_in(summary)
+
     def get_block_list(self) -> List[BlockSimple]:
         """
         Returns all the blocks in list form.
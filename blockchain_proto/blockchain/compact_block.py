@@ -0,0 +1,167 @@
+"""
+Copyright 2022 M. M. Hassan Mahmud
+
+This Source Code Form is subject to the terms of the Mozilla Public
+License, v. 2.0. If a copy of the MPL was not distributed with this
+file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+
+Implements compact blocks, which carry the (user_id, trans_no) of their
+transactions instead of the transactions themselves, and rebuilding
+blocks from them with the free transactions of a node.
+"""
+from collections import OrderedDict
+from typing import List, Tuple
+
+from blockchain_proto.blockchain.block_simple import BlockHeader, BlockSimple
+from blockchain_proto.blockchain.block_helper import validate_block_hash
+
+
+class CompactBlock:
+    """
+    A block header with the (user_id, trans_no)'s of the transactions of
+    the block, in order.
+
+    Parameters
+    ----------
+
+    block_header: BlockHeader
+        The header of the block.
+
+    trans_ids: list of (str, int)
+        The (user_id, trans_no)'s of the transactions in the block.
+    """
+    def __init__(self, block_header: BlockHeader, trans_ids: List[Tuple[str, int]]):
+        self.block_header = block_header
+        self.trans_ids = trans_ids
+
+    @staticmethod
+    def from_block(block: BlockSimple) -> 'CompactBlock':
+        return CompactBlock(block.block_header, [(trans.user_id, trans.trans_no) for trans in block.transactions])
+
+    def hash(self) -> str:
+        return self.block_header.block_hash
+
+
+class CompactBlockAssembler:
+    """
+    Rebuilds blocks from compact blocks using the free transactions of this
+    node. The transactions that are missing, or that differ from those in
+    the block so that its hash does not match, are to be requested from the
+    peer that sent the compact blocks. The compact blocks gossiped together
+    are kept together until their transactions arrive, so that the blocks
+    are returned in order.
+
+    Parameters
+    ----------
+
+    get_transactions: func
+        Returns the free transactions with the given (user_id, trans_no)'s
+        which this node has, e.g. using BlockChain.get_inventory.
+
+    max_pending: int
+        Maximum number of groups of compact blocks waiting for transactions.
+        The oldest group is dropped when there are more.
+    """
+    def __init__(self, get_transactions, max_pending: int = 1000):
+        self.get_transactions = get_transactions
+        self.max_pending = max_pending
+        self.pending = OrderedDict()
+        self.next_request_id = 0
+
+    def add(self, compact_blocks: List[CompactBlock]) -> Tuple[List[BlockSimple], int, dict]:
+        """
+        Rebuilds the blocks from compact blocks.
+
+        Parameters
+        ----------
+
+        compact_blocks: list of CompactBlock
+            The compact blocks, each after the block it is added to if it
+            is in the list.
+
+        Returns
+        -------
+
+        list of BlockSimple, int, dict:
+            If all the blocks were rebuilt, the blocks, None and an empty
+            dict. Otherwise, an empty list, the id of the request for the
+            missing transactions and a dict from block hash to the
+            (user_id, trans_no)'s to request, see trans_received.
+        """
+        trans_ids = [trans_id for compact in compact_blocks for trans_id in compact.trans_ids]
+        free_trans = {(trans.user_id, trans.trans_no): trans for trans in self.get_transactions(trans_ids)}
+
+        blocks = []
+        missing = {}
+        for compact in compact_blocks:
+            block_missing = [trans_id for trans_id in compact.trans_ids if trans_id not in free_trans]
+            if len(block_missing) == 0:
+                block = BlockSimple(compact.block_header, [free_trans[trans_id] for trans_id in compact.trans_ids])
+                if self._is_valid(block):
+                    blocks.append(block)
+                    continue
+                # a transaction with the same id but different content
+                block_missing = compact.trans_ids
+            missing[compact.hash()] = block_missing
+            blocks.append(compact)
+
+        if len(missing) == 0:
+            return blocks, None, {}
+        request_id = self.next_request_id
+        self.next_request_id += 1
+        self.pending[request_id] = (blocks, missing)
+        if len(self.pending) > self.max_pending:
+            self.pending.popitem(last=False)
+        return [], request_id, missing
+
+    def trans_received(self, request_id: int, block_trans: dict) -> Tuple[List[BlockSimple], List[str]]:
+        """
+        Rebuilds the blocks waiting for the transactions sent by the peer.
+
+        Parameters
+        ----------
+
+        request_id: int
+            The id returned by add.
+
+        block_trans: dict
+            Block hash to the transactions requested for the block.
+
+        Returns
+        -------
+
+        list of BlockSimple, list of str:
+            The blocks rebuilt, in order, and the hashes of the blocks which
+            could not be rebuilt with the transactions sent, and all the
+            blocks after them.
+        """
+        if request_id not in self.pending:
+            return [], []
+        blocks, missing = self.pending.pop(request_id)
+        rebuilt = []
+        for i, block in enumerate(blocks):
+            if isinstance(block, CompactBlock):
+                sent = {(trans.user_id, trans.trans_no): trans for trans in block_trans.get(block.hash(), [])}
+                free_trans = {}
+                if len(sent) < len(block.trans_ids):
+                    free_trans = {(trans.user_id, trans.trans_no): trans
+                                  for trans in self.get_transactions(block.trans_ids)}
+                free_trans.update(sent)
+                if any(trans_id not in free_trans for trans_id in block.trans_ids):
+                    return rebuilt, [block.hash() for block in blocks[i:]]
+                block = BlockSimple(block.block_header, [free_trans[trans_id] for trans_id in block.trans_ids])
+                if not self._is_valid(block):
+                    return rebuilt, [block.hash() for block in blocks[i:]]
+            rebuilt.append(block)
+        return rebuilt, []
+
+    def _is_valid(self, block: BlockSimple) -> bool:
+        """
+        Returns True if the transactions of the block match its hash.
+        """
+        try:
+            validate_block_hash(block)
+        except ValueError:
+            return False
+        return True
@@ -0,0 +1,144 @@
+"""
+Copyright 2022 M. M. Hassan Mahmud
+
+This Source Code Form is subject to the terms of the Mozilla Public
+License, v. 2.0. If a copy of the MPL was not distributed with this
+file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+
+Consensus engines, which seal new blocks and verify the seals of
+incoming blocks.
+"""
+from abc import ABC, abstractmethod
+from datetime import datetime
+
+from blockchain_proto.blockchain.puzzle import solve_puzzle, check_solution
+from blockchain_proto.blockchain.block_simple import BlockSimple
+
+# nonce marking blocks sealed by the InstantSealEngine. It is not a number so
+# solve_puzzle never produces it.
+INSTANT_SEAL_NONCE = "instant-seal"
+
+
+def get_puzzle_string(trans_hash: str, prev_block_hash: str, timestamp: datetime, difficulty: int) -> str:
+    """
+    Returns the string whose puzzle is solved to seal a block with the given
+    information.
+    """
+    return "".join([trans_hash,
+                    prev_block_hash,
+                    str(timestamp),
+                    str(difficulty)])
+
+
+class ConsensusEngine(ABC):
+    """
+    Interface for the consensus engines. An engine creates the nonce that
+    seals a new block, and checks the nonce of incoming blocks.
+    """
+    name = None
+
+    @abstractmethod
+    def seal(self, trans_hash: str, prev_block_hash: str, timestamp: datetime, difficulty: int) -> str:
+        """
+        Returns the nonce sealing a block with the given information.
+
+        Parameters
+        ----------
+        trans_hash: str
+            A hash representing all the transactions that will go into the block.
+
+        prev_block_hash: str
+            Hash of the previous block.
+
+        timestamp: datetime
+            The timestamp of the creation of the block.
+
+        difficulty: int
+            The difficulty level of the block.
+
+        Returns
+        -------
+
+        str:
+            The nonce of the block.
+        """
+
+    @abstractmethod
+    def verify_seal(self, block: BlockSimple, trans_hash: str):
+        """
+        Raises a ValueError if the block was not sealed correctly.
+
+        Parameters
+        ----------
+
+        block: BlockSimple
+            The block to check.
+
+        trans_hash: str
+            The hash of the transactions in the block.
+        """
+
+
+class ProofOfWorkEngine(ConsensusEngine):
+    """
+    Seals blocks by solving a cryptographic puzzle at the difficulty level
+    of the block. This is the engine used by production nodes, and it
+    rejects blocks sealed by the InstantSealEngine.
+    """
+    name = 'pow'
+
+    def seal(self, trans_hash: str, prev_block_hash: str, timestamp: datetime, difficulty: int) -> str:
+        puzzle_string = get_puzzle_string(trans_hash, prev_block_hash, timestamp, difficulty)
+        return str(solve_puzzle(puzzle_string, difficulty))
+
+    def verify_seal(self, block: BlockSimple, trans_hash: str):
+        if block.block_header.nonce == INSTANT_SEAL_NONCE:
+            raise ValueError(f"Invalid block: block {block.hash()} was instantly sealed by a "
+                             f"development node.")
+        puzzle_string = get_puzzle_string(trans_hash,
+                                          block.block_header.prev_block_hash,
+                                          block.block_header.timestamp,
+                                          block.block_header.difficulty)
+        if not check_solution(puzzle_string, block.block_header.nonce, block.block_header.difficulty):
+            raise ValueError(f"Invalid block: invalid puzzle solution {block.block_header.nonce}"
+                             f" for puzzle {puzzle_string} at difficulty {block.block_header.difficulty}.")
+
+
+class InstantSealEngine(ConsensusEngine):
+    """
+    Development only engine which seals blocks immediately without doing any
+    work, so that tests and load runs on dev clusters measure the rest of the
+    node rather than hashing. Blocks are marked with INSTANT_SEAL_NONCE so
+    nodes using the ProofOfWorkEngine reject them. Blocks sealed by solving
+    the puzzle are accepted as well.
+    """
+    name = 'instant-seal'
+
+    def __init__(self):
+        self.pow_engine = ProofOfWorkEngine()
+
+    def seal(self, trans_hash: str, prev_block_hash: str, timestamp: datetime, difficulty: int) -> str:
+        return INSTANT_SEAL_NONCE
+
+    def verify_seal(self, block: BlockSimple, trans_hash: str):
+        if block.block_header.nonce != INSTANT_SEAL_NONCE:
+            self.pow_engine.verify_seal(block, trans_hash)
+
+
+PROOF_OF_WORK = ProofOfWorkEngine()
+
+CONSENSUS_ENGINES = {
+    ProofOfWorkEngine.name: ProofOfWorkEngine,
+    InstantSealEngine.name: InstantSealEngine,
+}
+
+
+def get_consensus_engine(name: str) -> ConsensusEngine:
+    """
+    Returns a new consensus engine of the type with the given name, one of
+    the keys of CONSENSUS_ENGINES.
+    """
+    if name not in CONSENSUS_ENGINES:
+        raise ValueError(f"Unknown consensus engine {name}, must be one of {list(CONSENSUS_ENGINES)}.")
+    return CONSENSUS_ENGINES[name]()
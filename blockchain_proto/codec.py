@@ -0,0 +1,121 @@
+"""
+Copyright 2022 M. M. Hassan Mahmud
+
+This Source Code Form is subject to the terms of the Mozilla Public
+License, v. 2.0. If a copy of the MPL was not distributed with this
+file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+
+Optional zlib compression of the payloads of messages.
+"""
+from typing import List
+import time
+import zlib
+
+from blockchain_proto.consts import RAW_PAYLOAD, ZLIB_PAYLOAD, CODEC_PAYLOADS, CODEC_COMPRESSED, \
+    CODEC_RAW_BYTES, CODEC_ENCODED_BYTES, CODEC_RATIO, CODEC_COMPRESS_SECONDS, CODEC_DECOMPRESS_SECONDS, \
+    CODEC_DECOMPRESSED
+
+
+def parse_thresholds(specs: List[str]) -> dict:
+    """
+    Parses the message types to compress, each given as 'msg_type:min_bytes',
+    e.g. 'sync_blocks:1024', into a dict from message type to the minimum
+    size of the payloads compressed.
+    """
+    thresholds = {}
+    for spec in specs or []:
+        msg_type, _, min_bytes = spec.rpartition(':')
+        if msg_type == '' or not min_bytes.isdigit():
+            raise ValueError(f"Invalid compression threshold {spec}, expected 'msg_type:min_bytes'.")
+        thresholds[msg_type.encode()] = int(min_bytes)
+    return thresholds
+
+
+class PayloadCodec:
+    """
+    Encodes the payloads of messages, compressing them with zlib if their
+    message type has a threshold and they are at least that many bytes.
+    Each encoded payload starts with a flag byte, RAW_PAYLOAD or
+    ZLIB_PAYLOAD, so any payload can be decoded whatever the thresholds
+    of the sender, and payloads that do not shrink are sent raw. The bytes
+    before and after compression, and the CPU time spent, are counted for
+    each message type.
+
+    Parameters
+    ----------
+
+    thresholds: dict
+        Message type to the minimum size in bytes of the payloads compressed.
+        Payloads of other message types are never compressed.
+
+    level: int
+        zlib compression level, from 1 (fastest) to 9 (smallest).
+    """
+    def __init__(self, thresholds: dict = None, level: int = 6):
+        self.thresholds = thresholds if thresholds is not None else {}
+        self.level = level
+        self.counters = {}
+        self.num_decompressed = 0
+        self.decompress_seconds = 0.0
+
+    def encode(self, msg_type: bytes, payload: bytes) -> bytes:
+        """
+        Returns the payload of a message of the given type, compressed if it
+        is large enough, after the flag byte.
+        """
+        threshold = self.thresholds.get(msg_type)
+        if threshold is None or len(payload) < threshold:
+            return RAW_PAYLOAD + payload
+
+        start = time.process_time()
+        compressed = zlib.compress(payload, self.level)
+        seconds = time.process_time() - start
+
+        counters = self.counters.setdefault(msg_type, [0, 0, 0, 0, 0.0])
+        counters[0] += 1
+        counters[2] += len(payload)
+        counters[4] += seconds
+        if len(compressed) >= len(payload):
+            counters[3] += len(payload)
+            return RAW_PAYLOAD + payload
+        counters[1] += 1
+        counters[3] += len(compressed)
+        return ZLIB_PAYLOAD + compressed
+
+    def decode(self, data) -> bytes:
+        """
+        Returns the payload encoded in data, a bytes or zmq.Frame, which is
+        decompressed if needed. A raw payload is returned as a memoryview
+        of data, without copying. Raises a ValueError for an unknown flag.
+        """
+        data = memoryview(data)
+        flag = bytes(data[0:1])
+        if flag == RAW_PAYLOAD:
+            return data[1:]
+        if flag != ZLIB_PAYLOAD:
+            raise ValueError(f"Unknown payload flag {flag}.")
+        start = time.process_time()
+        payload = zlib.decompress(data[1:])
+        self.decompress_seconds += time.process_time() - start
+        self.num_decompressed += 1
+        return payload
+
+    def to_json(self) -> dict:
+        """
+        Returns a json representation of the counters, for each message type
+        that has a threshold and for the payloads decompressed.
+        """
+        ret = {}
+        for msg_type, (num_payloads, num_compressed, raw_bytes, encoded_bytes, seconds) in self.counters.items():
+            ret[msg_type.decode()] = {
+                CODEC_PAYLOADS: num_payloads,
+                CODEC_COMPRESSED: num_compressed,
+                CODEC_RAW_BYTES: raw_bytes,
+                CODEC_ENCODED_BYTES: encoded_bytes,
+                CODEC_RATIO: raw_bytes / encoded_bytes if encoded_bytes > 0 else 1.0,
+                CODEC_COMPRESS_SECONDS: seconds
+            }
+        ret[CODEC_DECOMPRESSED] = self.num_decompressed
+        ret[CODEC_DECOMPRESS_SECONDS] = self.decompress_seconds
+        return ret
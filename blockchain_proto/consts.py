@@ -18,6 +18,21 @@ GET_UNADDED_TRANS = b'get_unadded_trans'
 ADD_TRANS = b'add_trans'
 NEW_PEER = b'new_peer'
 BLOCKS_AND_TRANS = b'blocks_trans'
+TRANS_BATCH_GOSSIP = b'trans_batch'
+BLOCK_BATCH_GOSSIP = b'block_batch'
+INV_BLOCKS_GOSSIP = b'inv_blocks'
+INV_TRANS_GOSSIP = b'inv_trans'
+GET_DATA = b'get_data'
+GET_HEADERS = b'get_headers'
+SYNC_HEADERS = b'sync_headers'
+GET_BLOCK_BODIES = b'get_block_bodies'
+SYNC_BLOCKS = b'sync_blocks'
+GET_MEMPOOL = b'get_mempool'
+SYNC_TRANS = b'sync_trans'
+COMPACT_BLOCKS_GOSSIP = b'compact_blocks'
+GET_BLOCK_TRANS = b'get_block_trans'
+BLOCK_TRANS_REPLY = b'block_trans_reply'
+SUBSCRIBE_REQUEST = b'subscribe'
 
 GET_BLOCKCHAIN_ROUTE = '/get_blockchain'
 GET_UNADDED_TRANS_ROUTE = '/get_unadded_trans'
@@ -50,6 +65,35 @@ DIFFICULTY = 'difficulty'
 BLOCK_MAP = 'block_map'
 TRANS_DATA = 'trans_data'
 FORK_DATA = 'fork_data'
+BLOCK_PRODUCTION = 'block_production'
+
+# defaults of the cleanup of the forks, see BlockChain
+DEFAULT_CLEANUP_INTERVAL = 10
+DEFAULT_CLEANUP_BUDGET = 8
+
+MAX_BLOCK_WAIT = 'max_block_wait'
+LATENCY_BUCKETS = 'time_in_mempool_buckets'
+LATENCY_COUNTS = 'time_in_mempool_counts'
+LATENCY_TOTAL = 'time_in_mempool_total'
+LATENCY_MAX = 'time_in_mempool_max'
+
+SEEN_CACHE = 'seen_cache'
+SEEN_CACHE_SIZE = 'size'
+SEEN_CACHE_HITS = 'hits'
+SEEN_CACHE_MISSES = 'misses'
+SEEN_CACHE_HIT_RATE = 'hit_rate'
+
+RAW_PAYLOAD = b'\x00'
+ZLIB_PAYLOAD = b'\x01'
+PAYLOAD_CODEC = 'payload_codec'
+CODEC_PAYLOADS = 'payloads'
+CODEC_COMPRESSED = 'compressed'
+CODEC_RAW_BYTES = 'raw_bytes'
+CODEC_ENCODED_BYTES = 'encoded_bytes'
+CODEC_RATIO = 'compression_ratio'
+CODEC_COMPRESS_SECONDS = 'compress_cpu_seconds'
+CODEC_DECOMPRESSED = 'decompressed'
+CODEC_DECOMPRESS_SECONDS = 'decompress_cpu_seconds'
 
 BLOCK_HEADER = 'block_header'
 BLOCK_TRANS = 'block_trans'
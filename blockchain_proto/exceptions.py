@@ -49,6 +49,13 @@ class RemoveNonExistentBlockError(Exception):
         super().__init__(message)
 
 
+class BlockSizeError(Exception):
+    def __init__(self, bhash, num_trans, min_size, max_size):
+        message = f"Block with hash {bhash} has {num_trans} transactions, " +\
+                  f"must have between {min_size} and {max_size}."
+        super().__init__(message)
+
+
 # def unordered_trans_msg(user_id, bhash):
 #     return f"Transactions for {user_id} in block with " +\
 #            f"hash {bhash} are not in order."
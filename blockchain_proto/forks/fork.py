@@ -65,5 +65,39 @@ class Fork:
            TIMESTAMP: str(self.timestamp),
            NUM_BLOCKS: self.num_blocks,
            FORK_START_BLOCK_HASH: self.fork_start_block_hash
-        }        
-        
+        }
+
+
+class ReorgDiff:
+    """
+    Container class for how the chain ending at the head of the longest
+    fork changed when the head moved: the blocks that are no longer in
+    the chain and the blocks that are now in it, relative to the common
+    ancestor of the old and the new head. A plain extension of the
+    longest fork has only connected blocks.
+
+    Parameters
+    ----------
+
+    common_ancestor_hash: str
+        Hash of the common ancestor of the old and new heads.
+
+    disconnected: list of str
+        Hashes of the blocks no longer in the chain, starting at the old head.
+
+    connected: list of str
+        Hashes of the blocks now in the chain, ending at the new head.
+    """
+    def __init__(self,
+                 common_ancestor_hash: str,
+                 disconnected: list,
+                 connected: list):
+        self.common_ancestor_hash = common_ancestor_hash
+        self.disconnected = disconnected
+        self.connected = connected
+
+    def is_reorg(self) -> bool:
+        """
+        Returns True if some blocks were disconnected from the chain.
+        """
+        return len(self.disconnected) > 0
@@ -8,23 +8,37 @@ file, You can obtain one at https://mozilla.org/MPL/2.0/.
 
 Implements helper classes for the fork manager.
 """
+from bisect import bisect_left, insort
 from collections import defaultdict, OrderedDict
-from typing import List
+from typing import List, Tuple
 from blockchain_proto.blockchain.block_simple import BlockSimple
-from blockchain_proto.blockchain.block_helper import validate_block_hashes
+from blockchain_proto.blockchain.block_helper import validate_block_hashes, validate_block_hash
+from blockchain_proto.blockchain.consensus import ConsensusEngine
 from blockchain_proto.consts import NULL_BLOCK_HASH
 from blockchain_proto.exceptions import UnorderedTransactionError, PrecBlockNotFoundError, \
-    EarliestTransMismatchError, BlockWasAlreadyAddedError, RemoveNonExistentBlockError
+    EarliestTransMismatchError, BlockWasAlreadyAddedError, RemoveNonExistentBlockError, BlockSizeError
 
 
 
 class BlockDepthManager:
     """
-    Manages block depths
+    Manages block depths, and ancestor pointers for each block: the
+    i-th pointer of a block is its ancestor 2^i blocks back, so the
+    ancestor at any depth and the lowest common ancestor of two blocks
+    can be found in O(log depth) jumps. The branch points, i.e. the blocks
+    with more than one child, are kept sorted by depth so that the oldest
+    one can be found in O(1).
     """
 
     def __init__(self):
         self.block_depth_map = {}
+        self.num_children = defaultdict(lambda : 0)
+        self.parent_map = {}
+        self.ancestors = {}
+        self.branch_points = []
+        self.branch_depths = {}
+        # depth of the oldest block kept, blocks before it have been pruned
+        self.min_depth = 1
 
     def add_block(self, block: BlockSimple):
         """
@@ -38,6 +52,17 @@ class BlockDepthManager:
                 self.block_depth_map[block.prev_hash()] + 1
         else:
             self.block_depth_map[block.hash()] = 1
+        self.parent_map[block.hash()] = block.prev_hash()
+        self.num_children[block.prev_hash()] += 1
+        if self.num_children[block.prev_hash()] == 2:
+            self._add_branch_point(block.prev_hash())
+
+        ancestors = [block.prev_hash()] if block.prev_hash() != NULL_BLOCK_HASH else []
+        # pointers stop at blocks that have been pruned, see prune_below
+        while len(ancestors) > 0 and ancestors[-1] in self.ancestors and \
+              len(self.ancestors[ancestors[-1]]) >= len(ancestors):
+            ancestors.append(self.ancestors[ancestors[-1]][len(ancestors) - 1])
+        self.ancestors[block.hash()] = ancestors
 
     def remove(self, bhash: str):
         """
@@ -45,6 +70,46 @@ class BlockDepthManager:
         from the depth manager.
         """
         del self.block_depth_map[bhash]
+        del self.ancestors[bhash]
+        self.num_children.pop(bhash, None)
+        prev_hash = self.parent_map.pop(bhash)
+        self.num_children[prev_hash] -= 1
+        if self.num_children[prev_hash] == 1:
+            self._remove_branch_point(prev_hash)
+        if self.num_children[prev_hash] == 0:
+            del self.num_children[prev_hash]
+
+    def _add_branch_point(self, bhash: str):
+        """
+        Records a block which now has two children. The first blocks of
+        separate chains make NULL_BLOCK_HASH a branch point before them all.
+        """
+        depth = self.min_depth - 1 if bhash == NULL_BLOCK_HASH else self.block_depth_map[bhash]
+        self.branch_depths[bhash] = depth
+        insort(self.branch_points, (depth, bhash))
+
+    def _remove_branch_point(self, bhash: str):
+        """
+        Forgets a block which no longer has more than one child.
+        """
+        depth = self.branch_depths.pop(bhash, None)
+        if depth is not None:
+            del self.branch_points[bisect_left(self.branch_points, (depth, bhash))]
+
+    def get_oldest_branch_point(self) -> str:
+        """
+        Returns the hash of the branch point with the smallest depth, which
+        is where the oldest fork still kept branches off the longest one,
+        NULL_BLOCK_HASH if there are separate chains, or None if there are
+        no branch points.
+        """
+        return self.branch_points[0][1] if len(self.branch_points) > 0 else None
+
+    def get_num_children(self, bhash: str) -> int:
+        """
+        Get the number of blocks whose previous block is the given block.
+        """
+        return self.num_children.get(bhash, 0)
 
     def get_depth(self, bhash: str):
         """
@@ -52,6 +117,232 @@ class BlockDepthManager:
         """
         return self.block_depth_map[bhash]
 
+    def __contains__(self, bhash: str) -> bool:
+        return bhash in self.block_depth_map
+
+    def get_ancestor(self, bhash: str, depth: int) -> str:
+        """
+        Returns the hash of the ancestor of the given block at the given
+        depth (the block itself if depth is its depth), or None if there is
+        no such ancestor.
+
+        Parameters
+        ----------
+
+        bhash: str
+            Hash of the block whose ancestor to find.
+
+        depth: int
+            The depth of the ancestor, with the first block at depth 1.
+        """
+        jump = self.block_depth_map[bhash] - depth
+        if jump < 0 or depth < self.min_depth:
+            return None
+        i = 0
+        while jump > 0:
+            if jump & 1:
+                bhash = self.ancestors[bhash][i]
+            jump >>= 1
+            i += 1
+        return bhash
+
+    def get_common_ancestor(self, bhash_a: str, bhash_b: str) -> str:
+        """
+        Returns the hash of the lowest common ancestor of the two given blocks,
+        which may be one of the blocks itself, or NULL_BLOCK_HASH if they
+        have no common ancestor.
+
+        Parameters
+        ----------
+
+        bhash_a: str
+            Hash of the first block.
+
+        bhash_b: str
+            Hash of the second block.
+        """
+        if bhash_a == NULL_BLOCK_HASH or bhash_b == NULL_BLOCK_HASH:
+            return NULL_BLOCK_HASH
+        depth = min(self.block_depth_map[bhash_a], self.block_depth_map[bhash_b])
+        # blocks in different trees, e.g. one rooted at the oldest block kept
+        # and one rooted at a new first block, have no common ancestor
+        if depth < self.min_depth or \
+           self.get_ancestor(bhash_a, self.min_depth) != self.get_ancestor(bhash_b, self.min_depth):
+            return NULL_BLOCK_HASH
+        bhash_a = self.get_ancestor(bhash_a, depth)
+        bhash_b = self.get_ancestor(bhash_b, depth)
+        if bhash_a == bhash_b:
+            return bhash_a
+        # pointers added after pruning stop early, but any pointers past the
+        # shorter list are to blocks before the common ancestor
+        num_pointers = min(len(self.ancestors[bhash_a]), len(self.ancestors[bhash_b]))
+        for i in reversed(range(num_pointers)):
+            if self.ancestors[bhash_a][i] != self.ancestors[bhash_b][i]:
+                bhash_a = self.ancestors[bhash_a][i]
+                bhash_b = self.ancestors[bhash_b][i]
+        return self.parent_map[bhash_a]
+
+    def prune_below(self, checkpoint_hash: str) -> List[str]:
+        """
+        Removes all the ancestors of the given block, which becomes the
+        oldest block kept. Ancestor queries for depths before it return None.
+
+        Parameters
+        ----------
+
+        checkpoint_hash: str
+            Hash of the block to prune below.
+
+        Returns
+        -------
+
+        list of str:
+            Hashes of the blocks removed, oldest first.
+        """
+        pruned = []
+        bhash = self.parent_map[checkpoint_hash]
+        while bhash != NULL_BLOCK_HASH:
+            pruned.append(bhash)
+            self._remove_branch_point(bhash)
+            del self.block_depth_map[bhash]
+            del self.ancestors[bhash]
+            self.num_children.pop(bhash, None)
+            bhash = self.parent_map.pop(bhash)
+        self._remove_branch_point(NULL_BLOCK_HASH)
+        self.parent_map[checkpoint_hash] = NULL_BLOCK_HASH
+        self.num_children[NULL_BLOCK_HASH] = 1
+        self.min_depth = self.block_depth_map[checkpoint_hash]
+        pruned.reverse()
+        return pruned
+
+
+class ForkIndex:
+    """
+    Keeps the ids of the forks sorted by their number of blocks so that
+    the longest fork can be found in O(1), and the forks shorter than a
+    given length in O(log n + k). Among forks of equal length the one
+    which reached that length first is treated as the longest.
+    """
+    def __init__(self):
+        self.keys = []
+        self.fork_keys = {}
+        self.next_seq = 0
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, fork_id: int, num_blocks: int):
+        """
+        Adds the fork with the given id and number of blocks.
+        """
+        key = (num_blocks, -self.next_seq, fork_id)
+        self.next_seq += 1
+        self.fork_keys[fork_id] = key
+        insort(self.keys, key)
+
+    def remove(self, fork_id: int):
+        """
+        Removes the fork with the given id.
+        """
+        key = self.fork_keys.pop(fork_id)
+        del self.keys[bisect_left(self.keys, key)]
+
+    def update(self, fork_id: int, num_blocks: int):
+        """
+        Updates the number of blocks of the fork with the given id.
+        """
+        self.remove(fork_id)
+        self.add(fork_id, num_blocks)
+
+    def longest(self) -> int:
+        """
+        Returns the id of the longest fork, or None if there are no forks.
+        """
+        return self.keys[-1][2] if self.keys else None
+
+    def count_shorter_than(self, num_blocks: int) -> int:
+        """
+        Returns the number of forks with fewer than num_blocks blocks.
+        """
+        return bisect_left(self.keys, (num_blocks,))
+
+    def pop_shorter_than(self, num_blocks: int, max_forks: int = None) -> List[int]:
+        """
+        Removes and returns the ids of the forks with fewer than
+        num_blocks blocks, shortest first, but at most max_forks of them
+        if given.
+        """
+        end = bisect_left(self.keys, (num_blocks,))
+        if max_forks is not None:
+            end = min(end, max_forks)
+        fork_ids = [key[2] for key in self.keys[0:end]]
+        del self.keys[0:end]
+        for fork_id in fork_ids:
+            del self.fork_keys[fork_id]
+        return fork_ids
+
+
+class AssumeValidIndex:
+    """
+    Keeps track of the blocks which are assumed to be valid because they are
+    ancestors of a trusted checkpoint block, so that their puzzle solutions
+    need not be checked, e.g. during the initial sync of a node.
+
+    Parameters
+    ----------
+
+    checkpoint_hashes: list of str
+        Hashes of the trusted checkpoint blocks.
+    """
+    def __init__(self, checkpoint_hashes: List[str] = None):
+        self.checkpoint_hashes = set(checkpoint_hashes) if checkpoint_hashes else set()
+        self.assumed_valid = set()
+
+    def add_blocks(self, blocks: List[BlockSimple]) -> int:
+        """
+        Marks the checkpoint blocks in the given blocks, and their ancestors
+        in the given blocks, as assumed to be valid. The block hash of each
+        block is checked against its contents before following the link to
+        its previous block, so only blocks that the checkpoint hash really
+        commits to are marked.
+
+        Parameters
+        ----------
+
+        blocks: list of BlockSimple
+            The blocks about to be added, e.g. those received from a peer.
+
+        Returns
+        -------
+
+        int:
+            The number of blocks marked.
+        """
+        if len(self.checkpoint_hashes) == 0:
+            return 0
+        block_by_hash = {block.hash(): block for block in blocks}
+        num_marked = 0
+        for bhash in self.checkpoint_hashes:
+            while bhash in block_by_hash and bhash not in self.assumed_valid:
+                try:
+                    validate_block_hash(block_by_hash[bhash])
+                except ValueError:
+                    break
+                self.assumed_valid.add(bhash)
+                num_marked += 1
+                bhash = block_by_hash[bhash].prev_hash()
+        return num_marked
+
+    def pop(self, bhash: str) -> bool:
+        """
+        Returns True if the block with the given hash was marked as assumed
+        to be valid, and forgets it.
+        """
+        if bhash in self.assumed_valid:
+            self.assumed_valid.remove(bhash)
+            return True
+        return False
+
 
 class LatestTrans:
     """
@@ -61,6 +352,7 @@ class LatestTrans:
     def __init__(self):
         # map blocks to latest transaction per user
         self.trans_map = OrderedDict()
+        self.first_trans_map = OrderedDict()
         self.prev_hashes = OrderedDict()
 
     def add_block(self, block: BlockSimple):
@@ -77,6 +369,9 @@ class LatestTrans:
         self.trans_map[block.hash()] = {
             trans.user_id: trans.trans_no for trans in block.transactions
         }
+        self.first_trans_map[block.hash()] = {
+            trans.user_id: trans.trans_no for trans in reversed(block.transactions)
+        }
         self.prev_hashes[block.hash()] = block.prev_hash()
 
     def get_latest_trans(self, user_id: str, start_hash: str):
@@ -124,19 +419,108 @@ class LatestTrans:
             hash of the block to remove
         """
         del self.trans_map[bhash]
+        del self.first_trans_map[bhash]
         del self.prev_hashes[bhash]
 
+    def collapse(self, checkpoint_hash: str, pruned_hashes: List[str]):
+        """
+        Collapses the given blocks, which must be all the blocks before the
+        checkpoint block oldest first, into the checkpoint block. Afterwards
+        the checkpoint block maps every user in it or in the pruned blocks to
+        their latest trans_no up to the checkpoint, and has no previous block.
+
+        Parameters
+        ----------
+
+        checkpoint_hash: str
+            Hash of the block to collapse the blocks into.
+
+        pruned_hashes: list of str
+            The hashes of the blocks to collapse, oldest first.
+        """
+        if len(pruned_hashes) == 0:
+            return
+        # the oldest block is the previous checkpoint, whose map already
+        # has the latest transactions up to it, so it is reused
+        snapshot = self.trans_map[pruned_hashes[0]]
+        for bhash in pruned_hashes[1:]:
+            snapshot.update(self.trans_map[bhash])
+        snapshot.update(self.trans_map[checkpoint_hash])
+        for bhash in pruned_hashes:
+            self.remove_block(bhash)
+        self.trans_map[checkpoint_hash] = snapshot
+        self.prev_hashes[checkpoint_hash] = NULL_BLOCK_HASH
+
+
+class TipState:
+    """
+    Materialized map from each user to the latest trans_no in the
+    chain ending at the head of the longest fork. It is moved from
+    one head to another by connecting and disconnecting blocks, so
+    looking up a user is a single dictionary access.
+    """
+    def __init__(self):
+        self.head_hash = NULL_BLOCK_HASH
+        self.latest_trans = {}
+
+    def connect_block(self, bhash: str, last_trans: dict):
+        """
+        Applies the block with hash bhash on top of the current head.
+
+        Parameters
+        ----------
+
+        bhash: str
+            Hash of the block being connected.
+
+        last_trans: dict
+            Maps each user in the block to their last trans_no in the block.
+        """
+        self.latest_trans.update(last_trans)
+        self.head_hash = bhash
+
+    def disconnect_block(self, prev_hash: str, first_trans: dict):
+        """
+        Undoes the block at the current head. Since the transactions for
+        each user are contiguous, the latest trans_no for a user before
+        the block is one less than their first trans_no in it.
+
+        Parameters
+        ----------
+
+        prev_hash: str
+            Hash of the block preceding the disconnected block.
+
+        first_trans: dict
+            Maps each user in the block to their first trans_no in the block.
+        """
+        for user_id, trans_no in first_trans.items():
+            if trans_no == 0:
+                del self.latest_trans[user_id]
+            else:
+                self.latest_trans[user_id] = trans_no - 1
+        self.head_hash = prev_hash
+
+    def get_latest_trans(self, user_id: str) -> int:
+        """
+        Returns the latest trans_no for the user at the head, or -1 if
+        the user has no transactions there.
+        """
+        return self.latest_trans.get(user_id, -1)
+
 
 class ForkValidator:
     """
     Functions for validating blocks that are requested to be added
     to a ForkManager.
     """
-    def __init__(self, fork_manager):
+    def __init__(self, fork_manager, consensus: ConsensusEngine = None, block_size_bounds: Tuple[int, int] = None):
         self.fork_manager = fork_manager
         self.latest_trans = LatestTrans()
+        self.consensus = consensus
+        self.block_size_bounds = block_size_bounds
 
-    def validate_incoming_block(self, inc_block: BlockSimple) -> 'Fork':
+    def validate_incoming_block(self, inc_block: BlockSimple, verify_hashes: bool = True) -> 'Fork':
         """
         Validates a block that was received from a peer.
         First makes sure that its previous block hash is in fact there.
@@ -149,6 +533,10 @@ class ForkValidator:
         inc_block: BlockSimple
             The block to validated.
 
+        verify_hashes: bool
+            If False, the block hash and puzzle solution are not checked,
+            e.g. for blocks this node created and solved itself.
+
         Return
         ------
 
@@ -163,8 +551,21 @@ class ForkValidator:
         if inc_block.hash() in self.latest_trans:
             raise BlockWasAlreadyAddedError(inc_block.hash())
 
+        self.validate_block_size(inc_block)
         self.validate_transactions(inc_block)
-        validate_block_hashes(inc_block)
+        if verify_hashes:
+            validate_block_hashes(inc_block, self.consensus)
+
+    def validate_block_size(self, block: BlockSimple):
+        """
+        Ensures that the number of transactions in the block is within the
+        block size bounds, if there are any.
+        """
+        if self.block_size_bounds is None:
+            return
+        min_size, max_size = self.block_size_bounds
+        if not min_size <= len(block.transactions) <= max_size:
+            raise BlockSizeError(block.hash(), len(block.transactions), min_size, max_size)
 
     def validate_transactions(self, block):
         """
@@ -277,4 +678,32 @@ class ForkValidator:
             -1 otherwise.
         """    
         return self.latest_trans.get_latest_trans(user_id, start_block_hash)
+
+    def get_prev_hash(self, bhash: str) -> str:
+        """
+        Returns the hash of the block preceding the block with hash bhash.
+        """
+        return self.latest_trans.prev_hashes[bhash]
+
+    def get_first_trans(self, bhash: str) -> dict:
+        """
+        Returns the map from each user in the block with hash bhash to
+        their first trans_no in the block.
+        """
+        return self.latest_trans.first_trans_map[bhash]
+
+    def get_last_trans(self, bhash: str) -> dict:
+        """
+        Returns the map from each user in the block with hash bhash to
+        their last trans_no in the block.
+        """
+        return self.latest_trans.trans_map[bhash]
+
+    def collapse(self, checkpoint_hash: str, pruned_hashes: List[str]):
+        """
+        Drops the state kept for the given blocks before the checkpoint block,
+        keeping only a compacted snapshot of the latest transaction per user
+        at the checkpoint. See LatestTrans.collapse.
+        """
+        self.latest_trans.collapse(checkpoint_hash, pruned_hashes)
     
\ No newline at end of file
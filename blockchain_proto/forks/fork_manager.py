@@ -8,11 +8,13 @@ file, You can obtain one at https://mozilla.org/MPL/2.0/.
 
 Code for managing forks in the chain.
 """
-from typing import List
+from typing import List, Tuple
 from blockchain_proto.exceptions import BlockWasAlreadyAddedError, PrecBlockNotFoundError
-from blockchain_proto.forks.fork_helper import BlockDepthManager, ForkValidator
-from blockchain_proto.forks.fork import Fork
+from blockchain_proto.forks.fork_helper import BlockDepthManager, ForkValidator, TipState, ForkIndex, \
+    AssumeValidIndex
+from blockchain_proto.forks.fork import Fork, ReorgDiff
 from blockchain_proto.blockchain.block_simple import BlockSimple
+from blockchain_proto.blockchain.consensus import ConsensusEngine
 from blockchain_proto.consts import *
 
 
@@ -23,16 +25,42 @@ class ForkManager:
     It is responsible for maintaining the set of forks, the longest
     fork, validating incoming transactions with respect to the fork it
     was added to.
+
+    Parameters
+    ----------
+
+    finality_depth: int
+        Blocks in the longest fork more than this many blocks behind its head,
+        and older than where any other fork branches off, are final. The
+        per-block state for the blocks before the latest final block is
+        collapsed into it. Defaults to twice fork_len_disc.
+
+    assume_valid_hashes: list of str
+        Hashes of trusted checkpoint blocks. The puzzle solutions of these
+        blocks and their ancestors are not checked, see AssumeValidIndex.
+
+    consensus: ConsensusEngine
+        The consensus engine used to check the seals of incoming blocks,
+        proof of work if None.
+
+    block_size_bounds: (int, int)
+        If given, the minimum and maximum number of transactions in a block.
     """
-    def __init__(self):
+    def __init__(self, finality_depth: int = None, assume_valid_hashes: List[str] = None,
+                 consensus: ConsensusEngine = None, block_size_bounds: Tuple[int, int] = None):
         self.next_fork_id = 0
         self.longest_fork = None
         self.forks = {}
         self.fork_hashes = {}
+        self.fork_index = ForkIndex()
         self.fork_len_disc = 6
+        self.finality_depth = finality_depth if finality_depth is not None else 2 * self.fork_len_disc
         self.block_depth_manager = BlockDepthManager()
-        self.validator = ForkValidator(self)
-        
+        self.validator = ForkValidator(self, consensus, block_size_bounds)
+        self.tip_state = TipState()
+        self.reorg_diffs = []
+        self.assume_valid = AssumeValidIndex(assume_valid_hashes)
+
     def get_longest_fork(self) -> Fork:
         """
         Returns the longest fork.
@@ -118,6 +146,7 @@ class ForkManager:
 
         self.fork_hashes[bhash] = new_fork
         self.forks[new_fork.fork_id] = new_fork
+        self.fork_index.add(new_fork.fork_id, new_fork.num_blocks)
         self.next_fork_id += 1
         return new_fork
 
@@ -138,8 +167,9 @@ class ForkManager:
         fork.head_block_hash = block.hash()
         fork.num_blocks = self.block_depth_manager.get_depth(block.hash())
         self.fork_hashes[fork.head_block_hash] = fork
+        self.fork_index.update(fork.fork_id, fork.num_blocks)
 
-    def add_blocks(self, blocks_added: List[BlockSimple]) -> List[str]:
+    def add_blocks(self, blocks_added: List[BlockSimple], verify_hashes: bool = True) -> List[str]:
         """
         Adds the given blocks to the appropriate fork, or creates a new
         one if none exists
@@ -153,6 +183,10 @@ class ForkManager:
         blocks_added: [BlockSimple]
             The list of blocks, in order to add to the fork
 
+        verify_hashes: bool
+            If False, the block hashes and puzzle solutions are not checked,
+            e.g. for blocks whose headers were checked when syncing.
+
         Returns
         -------
 
@@ -161,9 +195,13 @@ class ForkManager:
             block was added else the error message.
         """
         add_status = []
+        if verify_hashes:
+            self.assume_valid.add_blocks(blocks_added)
         for block in blocks_added:
+            # the hashes of blocks assumed to be valid were checked when they were marked
+            verify_block = not self.assume_valid.pop(block.hash()) and verify_hashes
             try:
-                self.validator.validate_incoming_block(block)
+                self.validator.validate_incoming_block(block, verify_block)
             except PrecBlockNotFoundError as v:
                 add_status.append(str(v))
                 continue
@@ -171,20 +209,183 @@ class ForkManager:
                 add_status.append(str(v))
                 continue
 
-            self.block_depth_manager.add_block(block)
-            fork = self._find_insert_fork(block)
-            if fork is None: fork = self._add_new_fork(block)
-            else: self._change_fork_head(fork, block)
-            if self.longest_fork is None or fork.num_blocks > self.longest_fork.num_blocks:
-                self.longest_fork = fork
-            self.validator.add_block(block)
+            self._insert_block(block)
             add_status.append(1)
         
         return add_status
 
-    def get_block_hashes_in_fork(self, fork:Fork, block_map) -> List[str]:
+    def add_local_blocks(self, blocks_added: List[BlockSimple], self_check: bool = False) -> List[str]:
+        """
+        Adds blocks created and solved by this node. Since the node computed
+        the block hashes and puzzle solutions itself these are not verified
+        again unless self_check is set. The links and transaction order are
+        still checked as these are cheap.
+
+        Parameters
+        ----------
+
+        blocks_added: [BlockSimple]
+            The list of blocks, in order to add to the fork
+
+        self_check: bool
+            If True, the blocks are fully validated as in add_blocks, e.g.
+            for debugging.
+
+        Returns
+        -------
+
+        list: 
+            For each block, 1 the validation was successful and
+            block was added else the error message.
         """
-        Returns all the hashes for the given fork.
+        if self_check:
+            return self.add_blocks(blocks_added)
+
+        add_status = []
+        for block in blocks_added:
+            try:
+                self.validator.validate_incoming_block(block, verify_hashes=False)
+            except (PrecBlockNotFoundError, BlockWasAlreadyAddedError) as v:
+                add_status.append(str(v))
+                continue
+
+            self._insert_block(block)
+            add_status.append(1)
+
+        return add_status
+
+    def _insert_block(self, block: BlockSimple):
+        """
+        Records a validated block in the fork structures, and moves the tip
+        if the longest fork changed.
+
+        Parameters
+        ----------
+
+        block: BlockSimple
+            The block to insert.
+        """
+        self.block_depth_manager.add_block(block)
+        fork = self._find_insert_fork(block)
+        if fork is None: fork = self._add_new_fork(block)
+        else: self._change_fork_head(fork, block)
+        self.longest_fork = self.forks[self.fork_index.longest()]
+        self.validator.add_block(block)
+        if self.longest_fork.head_block_hash != self.tip_state.head_hash:
+            self._move_tip(self.longest_fork.head_block_hash)
+
+    def _hashes_back_to(self, bhash: str, ancestor_hash: str) -> List[str]:
+        """
+        Returns the hashes of the blocks from the given block back to, but
+        not including, the given ancestor.
+        """
+        ls = []
+        while bhash != ancestor_hash:
+            ls.append(bhash)
+            bhash = self.validator.get_prev_hash(bhash)
+        return ls
+
+    def get_ancestor(self, bhash: str, height: int) -> str:
+        """
+        Returns the hash of the ancestor at the given height (depth) of the
+        block with the given hash, in O(log depth).
+
+        Parameters
+        ----------
+
+        bhash: str
+            Hash of the block whose ancestor to return.
+
+        height: int
+            Height of the ancestor, with the first block at height 1.
+
+        Returns
+        -------
+
+        str:
+            The hash of the ancestor, or None if there is none at that height.
+        """
+        return self.block_depth_manager.get_ancestor(bhash, height)
+
+    def get_common_ancestor(self, bhash_a: str, bhash_b: str) -> str:
+        """
+        Returns the hash of the lowest common ancestor of the two blocks with
+        the given hashes, in O(log depth).
+
+        Parameters
+        ----------
+
+        bhash_a: str
+            Hash of the first block.
+
+        bhash_b: str
+            Hash of the second block.
+
+        Returns
+        -------
+
+        str:
+            The hash of the common ancestor, or NULL_BLOCK_HASH if there is none.
+        """
+        return self.block_depth_manager.get_common_ancestor(bhash_a, bhash_b)
+
+    def is_in_longest_fork(self, bhash: str) -> bool:
+        """
+        Returns True if the block with the given hash is in the chain
+        ending at the head of the longest fork.
+        """
+        if self.longest_fork is None or bhash not in self.block_depth_manager:
+            return False
+        return self.get_ancestor(self.longest_fork.head_block_hash,
+                                 self.block_depth_manager.get_depth(bhash)) == bhash
+
+    def _move_tip(self, new_head_hash: str):
+        """
+        Moves the materialized tip state to the given head by disconnecting
+        the blocks from the current head back to the common ancestor, and
+        then connecting the blocks from there to the new head. When the
+        longest fork is simply extended only the new block is connected.
+        The change is recorded as a ReorgDiff to be picked up with
+        pop_reorg_diffs.
+
+        Parameters
+        ----------
+
+        new_head_hash: str
+            Hash of the new head of the longest fork.
+        """
+        common_ancestor = self.get_common_ancestor(self.tip_state.head_hash, new_head_hash)
+        disconnected = self._hashes_back_to(self.tip_state.head_hash, common_ancestor)
+        connected = self._hashes_back_to(new_head_hash, common_ancestor)
+
+        for bhash in disconnected:
+            self.tip_state.disconnect_block(self.validator.get_prev_hash(bhash),
+                                            self.validator.get_first_trans(bhash))
+        connected.reverse()
+        for bhash in connected:
+            self.tip_state.connect_block(bhash, self.validator.get_last_trans(bhash))
+        self.reorg_diffs.append(ReorgDiff(common_ancestor, disconnected, connected))
+
+    def pop_reorg_diffs(self) -> List[ReorgDiff]:
+        """
+        Returns, and forgets, the changes to the chain ending at the head of
+        the longest fork since the last call, in the order they happened.
+
+        Returns
+        -------
+
+        list of ReorgDiff:
+            The changes to the chain.
+        """
+        reorg_diffs = self.reorg_diffs
+        self.reorg_diffs = []
+        return reorg_diffs
+
+    def get_block_hashes_to_release(self, fork: Fork, block_map) -> List[str]:
+        """
+        Returns the hashes of the blocks that belong only to the given fork,
+        i.e. the blocks from its head back to the first block which is also
+        an ancestor of the head of some other fork.
 
         Parameter
         ---------
@@ -199,28 +400,56 @@ class ForkManager:
         -------
 
         list(str):
-            The hashes of the blocks in the given fork. 
+            The hashes of the blocks, starting with the head of the fork.
         """
-        ls = []
-        cur_block = block_map[fork.head_block_hash]
-        while cur_block.hash() != fork.fork_start_block_hash:
-            ls.append(cur_block.hash())
-            cur_block = block_map[cur_block.prev_hash()]
-        ls.append(fork.fork_start_block_hash)
-        return ls                
+        ls = [fork.head_block_hash]
+        prev_hash = block_map[fork.head_block_hash].prev_hash()
+        while prev_hash != NULL_BLOCK_HASH and \
+              self.block_depth_manager.get_num_children(prev_hash) == 1:
+            ls.append(prev_hash)
+            prev_hash = block_map[prev_hash].prev_hash()
+        return ls
+
+    def num_forks_to_cleanup(self) -> int:
+        """
+        Returns the number of forks that cleanup_forks would drop.
+        """
+        if self.longest_fork is None:
+            return 0
+        return self.fork_index.count_shorter_than(self.longest_fork.num_blocks - self.fork_len_disc)
 
-    def cleanup_forks(self, block_map) -> List[str]:
+    def cleanup_forks(self, block_map, max_forks: int = None) -> List[str]:
         """
         Drop any fork that is more than 6 blocks shorter than the longest block,
         and release the transactions in the block to be added to the transaction
-        manager.
+        manager. The forks to drop are found using the fork index, so forks
+        that are kept are not looked at.
+
+        Parameters
+        ----------
+
+        block_map: dict
+            Map from block hashes to blocks.
+
+        max_forks: int
+            If given, at most this many forks are dropped, shortest first,
+            so that the time taken is bounded. The rest are dropped by
+            later calls.
+
+        Returns
+        -------
+
+        list(str):
+            The hashes of the blocks released.
         """
+        if self.longest_fork is None:
+            return []
         block_hashes_released = []
-        fork_list = list(self.forks.values())
-        for fork in fork_list:
-            if fork.num_blocks >= self.longest_fork.num_blocks - self.fork_len_disc:
-                continue
-            bhashes_in_fork = self.get_block_hashes_in_fork(fork, block_map)
+        discard_ids = self.fork_index.pop_shorter_than(
+            self.longest_fork.num_blocks - self.fork_len_disc, max_forks)
+        for fork_id in discard_ids:
+            fork = self.forks[fork_id]
+            bhashes_in_fork = self.get_block_hashes_to_release(fork, block_map)
             block_hashes_released.extend(bhashes_in_fork)
 
             for bhash in bhashes_in_fork:
@@ -230,8 +459,46 @@ class ForkManager:
             del self.forks[fork.fork_id]
             del self.fork_hashes[fork.head_block_hash]
 
+        self.prune_final_blocks()
         return block_hashes_released
 
+    def prune_final_blocks(self) -> str:
+        """
+        Finds the latest final block in the longest fork, i.e. the one
+        finality_depth blocks behind the head (but at least fork_len_disc + 1
+        so that forks which are still kept are not affected), or where the
+        oldest other fork branches off if that is older, found from the
+        branch points kept by the BlockDepthManager without looking at every
+        fork. The fork and validator state of the blocks before it is
+        dropped, so the memory used is bounded by the finality window plus
+        the number of users rather than by the length of the chain.
+
+        Returns
+        -------
+
+        str:
+            The hash of the latest final block, or None if nothing was pruned.
+        """
+        if self.longest_fork is None:
+            return None
+        head_hash = self.longest_fork.head_block_hash
+        final_depth = self.longest_fork.num_blocks - max(self.finality_depth, self.fork_len_disc + 1)
+        # every block at the end of a branch is the head of a fork, so the
+        # oldest branch point is the oldest common ancestor of the longest
+        # fork with another fork
+        branch_hash = self.block_depth_manager.get_oldest_branch_point()
+        if branch_hash == NULL_BLOCK_HASH:
+            return None
+        if branch_hash is not None:
+            final_depth = min(final_depth, self.block_depth_manager.get_depth(branch_hash))
+        if final_depth <= self.block_depth_manager.min_depth:
+            return None
+
+        checkpoint_hash = self.get_ancestor(head_hash, final_depth)
+        pruned_hashes = self.block_depth_manager.prune_below(checkpoint_hash)
+        self.validator.collapse(checkpoint_hash, pruned_hashes)
+        return checkpoint_hash
+
     def to_json(self) -> dict:
         """
         Returns a json version of the data in this fork
@@ -268,5 +535,4 @@ class ForkManager:
             The latest transaction no. if the transaction exists and
             -1 otherwise.
         """
-        if self.longest_fork is None: return -1
-        return self.validator.get_latest_trans(user_id, self.longest_fork.head_block_hash)
+        return self.tip_state.get_latest_trans(user_id)
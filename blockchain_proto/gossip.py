@@ -0,0 +1,380 @@
+"""
+Copyright 2022 M. M. Hassan Mahmud
+
+This Source Code Form is subject to the terms of the Mozilla Public
+License, v. 2.0. If a copy of the MPL was not distributed with this
+file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+
+Helpers for gossiping blocks and transactions to peers.
+"""
+from typing import List, Tuple
+from collections import OrderedDict
+import hashlib
+import pickle
+import random
+import time
+
+from blockchain_proto.blockchain.block_simple import BlockSimple
+from blockchain_proto.transactions.transaction import Transaction
+from blockchain_proto.consts import TRANS_BATCH_GOSSIP, BLOCK_BATCH_GOSSIP, SEEN_CACHE_SIZE, \
+    SEEN_CACHE_HITS, SEEN_CACHE_MISSES, SEEN_CACHE_HIT_RATE
+
+
+class GossipBatcher:
+    """
+    Packs the blocks and transactions to be gossiped into batch messages,
+    each a single frame with a pickled list of up to batch_size items,
+    instead of sending one message per item. A batch is sent once it is
+    full, or once the oldest item in it has waited for linger seconds.
+    Blocks are sent before transactions, unless trans_first, in the order
+    they were added.
+
+    Parameters
+    ----------
+
+    send: func
+        Function sending a multipart message, e.g. the send_multipart
+        method of the gossip out socket.
+
+    batch_size: int
+        Maximum number of items in a batch.
+
+    linger: float
+        Maximum number of seconds an item waits before being sent.
+
+    block_msg_type: bytes
+        Message type of the block batches.
+
+    trans_msg_type: bytes
+        Message type of the transaction batches.
+
+    trans_first: bool
+        If True, transactions are sent before blocks, e.g. so that peers
+        have the transactions of compact blocks when they arrive.
+
+    encode: func
+        If given, called with the message type and the pickled batch to
+        encode the payload, e.g. PayloadCodec.encode.
+    """
+    def __init__(self, send, batch_size: int = 256, linger: float = 0.01,
+                 block_msg_type: bytes = BLOCK_BATCH_GOSSIP, trans_msg_type: bytes = TRANS_BATCH_GOSSIP,
+                 trans_first: bool = False, encode=None):
+        self.send = send
+        self.batch_size = batch_size
+        self.linger = linger
+        self.block_msg_type = block_msg_type
+        self.trans_msg_type = trans_msg_type
+        self.trans_first = trans_first
+        self.encode = encode
+        self.blocks = []
+        self.trans = []
+        self.first_added_time = None
+
+    def __len__(self) -> int:
+        return len(self.blocks) + len(self.trans)
+
+    def add(self, blocks: List[BlockSimple], trans_list: List[Transaction], now: float = None):
+        """
+        Queues blocks and transactions to be gossiped, and sends the full batches.
+
+        Parameters
+        ----------
+
+        blocks: list of BlockSimple
+            The blocks to gossip.
+
+        trans_list: list of Transaction
+            The transactions to gossip.
+
+        now: float
+            The current time from time.monotonic, or None for now.
+        """
+        if len(blocks) == 0 and len(trans_list) == 0:
+            return
+        if self.first_added_time is None:
+            self.first_added_time = time.monotonic() if now is None else now
+        self.blocks.extend(blocks)
+        self.trans.extend(trans_list)
+        self._send_all(full_only=True)
+        if len(self) == 0:
+            self.first_added_time = None
+
+    def seconds_until_due(self, now: float = None) -> float:
+        """
+        Returns the number of seconds until the queued items must be sent,
+        or None if nothing is queued.
+        """
+        if self.first_added_time is None:
+            return None
+        now = time.monotonic() if now is None else now
+        return max(0.0, self.first_added_time + self.linger - now)
+
+    def flush_if_due(self, now: float = None):
+        """
+        Sends all the queued items if the oldest has waited for linger seconds.
+        """
+        due = self.seconds_until_due(now)
+        if due is not None and due <= 0:
+            self.flush()
+
+    def flush(self):
+        """
+        Sends all the queued items.
+        """
+        self._send_all(full_only=False)
+        self.first_added_time = None
+
+    def _send_all(self, full_only: bool):
+        """
+        Sends the batches of blocks and of transactions, in order.
+        """
+        batches = [(self.block_msg_type, self.blocks), (self.trans_msg_type, self.trans)]
+        if self.trans_first:
+            batches.reverse()
+        for msg_type, items in batches:
+            self._send_batches(msg_type, items, full_only)
+
+    def _send_batches(self, msg_type: bytes, items: list, full_only: bool):
+        """
+        Sends the items in batches of batch_size, and removes the items sent
+        from the list. If full_only, a last batch which is not full is kept.
+        """
+        num_to_send = len(items) - len(items) % self.batch_size if full_only else len(items)
+        for start in range(0, num_to_send, self.batch_size):
+            payload = pickle.dumps(items[start:min(start + self.batch_size, num_to_send)])
+            if self.encode is not None:
+                payload = self.encode(msg_type, payload)
+            self.send([msg_type, payload])
+        del items[0:num_to_send]
+
+
+class InventoryTracker:
+    """
+    Remembers which announced blocks and transactions were requested from a
+    peer recently, so that an item announced by several peers is only
+    requested once, unless it has not arrived within request_timeout
+    seconds.
+
+    Parameters
+    ----------
+
+    request_timeout: float
+        Number of seconds after which an item can be requested again.
+
+    max_entries: int
+        Number of items remembered above which expired ones are forgotten.
+    """
+    def __init__(self, request_timeout: float = 2.0, max_entries: int = 100000):
+        self.request_timeout = request_timeout
+        self.max_entries = max_entries
+        self.requested = {}
+
+    def to_request(self, item_ids: list, now: float = None) -> list:
+        """
+        Returns the ids in item_ids which were not requested within the
+        timeout, and records them as requested now.
+        """
+        now = time.monotonic() if now is None else now
+        if len(self.requested) > self.max_entries:
+            self.requested = {item_id: req_time for item_id, req_time in self.requested.items()
+                              if now - req_time < self.request_timeout}
+        ret_ids = []
+        for item_id in item_ids:
+            req_time = self.requested.get(item_id)
+            if req_time is None or now - req_time >= self.request_timeout:
+                self.requested[item_id] = now
+                ret_ids.append(item_id)
+        return ret_ids
+
+    def received(self, item_ids: list):
+        """
+        Forgets the given ids, once the items have arrived.
+        """
+        for item_id in item_ids:
+            self.requested.pop(item_id, None)
+
+
+class SeenCache:
+    """
+    Bounded cache of the gossip messages received recently, used to drop
+    duplicate messages before they are unpickled. Messages are keyed by a
+    16 byte blake2b digest of their frames, and the least recently seen
+    key is evicted once there are max_size of them.
+
+    Parameters
+    ----------
+
+    max_size: int
+        Maximum number of digests kept.
+    """
+    def __init__(self, max_size: int = 100000):
+        self.max_size = max_size
+        self.digests = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self.digests)
+
+    def check_and_add(self, frames: List[bytes]) -> bool:
+        """
+        Returns True if a message with the same frames was seen recently,
+        otherwise remembers the message and returns False.
+        """
+        hasher = hashlib.blake2b(digest_size=16)
+        for frame in frames:
+            hasher.update(len(frame).to_bytes(8, 'little'))
+            hasher.update(frame)
+        digest = hasher.digest()
+        if digest in self.digests:
+            self.digests.move_to_end(digest)
+            self.hits += 1
+            return True
+        self.misses += 1
+        self.digests[digest] = None
+        if len(self.digests) > self.max_size:
+            self.digests.popitem(last=False)
+        return False
+
+    def to_json(self) -> dict:
+        """
+        Returns a json representation of the cache counters.
+        """
+        num_checked = self.hits + self.misses
+        return {
+            SEEN_CACHE_SIZE: len(self.digests),
+            SEEN_CACHE_HITS: self.hits,
+            SEEN_CACHE_MISSES: self.misses,
+            SEEN_CACHE_HIT_RATE: self.hits / num_checked if num_checked > 0 else 0.0
+        }
+
+
+class PeerSelector:
+    """
+    Chooses the peers whose gossip this node subscribes to, so that each
+    node subscribes to about 2 * fanout peers instead of every peer, while
+    every node keeps subscribers. A node chooses up to fanout neighbours at
+    random among the known peers, subscribes to them and asks each of them
+    to subscribe to it in turn, see subscribe_requested. A node always
+    subscribes to the peers which asked it, so every link a node chooses
+    goes both ways, and a node has at least as many subscribers as
+    neighbours, whenever it joined. A neighbour which is lost is replaced
+    by another known peer, which is asked in turn. Messages reach the rest
+    of the peers by being relayed. A peer this node subscribes to which
+    gets disconnected is only lost if it is not reconnected within
+    loss_timeout seconds, as the connection is retried.
+
+    Parameters
+    ----------
+
+    fanout: int
+        Maximum number of neighbours, or None to subscribe to every peer.
+
+    loss_timeout: float
+        Number of seconds after which a disconnected peer is lost.
+
+    rng: random.Random
+        Random number generator, for tests.
+    """
+    def __init__(self, fanout: int = None, loss_timeout: float = 10.0, rng: random.Random = None):
+        self.fanout = fanout
+        self.loss_timeout = loss_timeout
+        self.rng = rng if rng is not None else random.Random()
+        self.known = []
+        self.neighbours = []
+        # peers which asked this node to subscribe to them
+        self.requested = []
+        # peer subscribed to -> time it got disconnected, while it is not reconnected
+        self.disconnected = {}
+
+    def _has_room(self) -> bool:
+        return self.fanout is None or len(self.neighbours) < self.fanout
+
+    def is_subscribed(self, address: str) -> bool:
+        return address in self.neighbours or address in self.requested
+
+    def _candidates(self) -> List[str]:
+        return [address for address in self.known if not self.is_subscribed(address)]
+
+    def add_peers(self, addresses: List[str]) -> List[str]:
+        """
+        Adds peers known from the registry, and returns the new neighbours,
+        to connect to and ask to subscribe to this node.
+        """
+        new_addresses = [address for address in addresses if address not in self.known]
+        self.known.extend(new_addresses)
+        candidates = self._candidates()
+        num_new = len(candidates) if self.fanout is None else max(0, self.fanout - len(self.neighbours))
+        chosen = self.rng.sample(candidates, min(num_new, len(candidates)))
+        self.neighbours.extend(chosen)
+        return chosen
+
+    def peer_joined(self, address: str) -> str:
+        """
+        Adds a peer that has come online, and returns it if it is a new
+        neighbour, to connect to and ask to subscribe to this node, or None.
+        The new peer chooses its own neighbours, which subscribe to it.
+        """
+        if address in self.known:
+            return None
+        self.known.append(address)
+        if self._has_room() and not self.is_subscribed(address):
+            self.neighbours.append(address)
+            return address
+        return None
+
+    def subscribe_requested(self, address: str) -> str:
+        """
+        Records that a peer asked this node to subscribe to it, and returns
+        it if it is not subscribed to yet, to connect to, or None.
+        """
+        if address not in self.known:
+            self.known.append(address)
+        if self.is_subscribed(address):
+            return None
+        self.requested.append(address)
+        return address
+
+    def peer_disconnected(self, address: str, now: float = None):
+        """
+        Records that a peer this node subscribes to got disconnected, see lost_peers.
+        """
+        if self.is_subscribed(address) and address not in self.disconnected:
+            self.disconnected[address] = time.monotonic() if now is None else now
+
+    def peer_reconnected(self, address: str):
+        """
+        Records that a peer this node subscribes to is connected again.
+        """
+        self.disconnected.pop(address, None)
+
+    def lost_peers(self, now: float = None) -> List[str]:
+        """
+        Returns the peers this node subscribes to which have been
+        disconnected for loss_timeout seconds, to pass to peer_lost.
+        """
+        now = time.monotonic() if now is None else now
+        return [address for address, disconnected_at in self.disconnected.items()
+                if now - disconnected_at >= self.loss_timeout]
+
+    def peer_lost(self, address: str) -> str:
+        """
+        Forgets a peer that went offline, and returns a known peer to connect
+        to and ask to subscribe to this node instead if it was a neighbour,
+        or None.
+        """
+        self.disconnected.pop(address, None)
+        if address in self.known:
+            self.known.remove(address)
+        if address in self.requested:
+            self.requested.remove(address)
+        if address not in self.neighbours:
+            return None
+        self.neighbours.remove(address)
+        candidates = self._candidates()
+        if len(candidates) == 0:
+            return None
+        replacement = self.rng.choice(candidates)
+        self.neighbours.append(replacement)
+        return replacement
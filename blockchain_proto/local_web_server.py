@@ -19,6 +19,7 @@ from blockchain_proto.consts import GET_UNADDED_TRANS, GET_BLOCKCHAIN, ADD_TRANS
     GET_BLOCKCHAIN_ROUTE, GET_UNADDED_TRANS_ROUTE, ADD_TRANS_ROUTE
 from blockchain_proto.transactions.transaction import Transaction
 from blockchain_proto.log_messages import log_info
+from blockchain_proto.codec import PayloadCodec
 
 
 log = logging.getLogger('werkzeug')
@@ -52,6 +53,8 @@ class LIWebServer:
     def __init__(self, args, context):
         self.context = context
         self.server_port = str(int(args.base_port) + 2)
+        # decodes the responses of the node, which may be compressed
+        self.codec = PayloadCodec()
         self.client_sock = self.context.socket(zmq.DEALER)
         self.client_sock.connect("inproc://local_interface")
 
@@ -63,7 +66,7 @@ class LIWebServer:
         """
         self.client_sock.send_multipart([GET_BLOCKCHAIN])    
         data = self.client_sock.recv_multipart()
-        ret_val = pickle.loads(data[1])
+        ret_val = pickle.loads(self.codec.decode(data[1]))
         return ret_val
 
     @cross_origin()
@@ -74,7 +77,7 @@ class LIWebServer:
         """
         self.client_sock.send_multipart([GET_UNADDED_TRANS])    
         data = self.client_sock.recv_multipart()
-        ret_val = pickle.loads(data[1])
+        ret_val = pickle.loads(self.codec.decode(data[1]))
         return ret_val
 
     @cross_origin()
@@ -90,7 +93,7 @@ class LIWebServer:
             return "Transactions not added:\n" + "\n".join(invalid_list)
         self.client_sock.send_multipart([ADD_TRANS, pickle.dumps(trans_list)])    
         add_trans_response = self.client_sock.recv_multipart()
-        return pickle.loads(add_trans_response[1])
+        return pickle.loads(self.codec.decode(add_trans_response[1]))
 
     def run_li_ws(self):
         """
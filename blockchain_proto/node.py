@@ -8,7 +8,7 @@ file, You can obtain one at https://mozilla.org/MPL/2.0/.
 
 Implements a node in the blockchain.
 """
-from typing import List, Tuple
+from typing import List, Tuple, Dict
 import logging
 import pickle
 import argparse
@@ -17,6 +17,7 @@ import threading
 import json
 
 import zmq
+from zmq.utils.monitor import recv_monitor_message
 import numpy as np
 from datetime import datetime
 from dateutil.parser import parse
@@ -27,12 +28,21 @@ import blockchain_proto.setup_logger
 from blockchain_proto.log_messages import log_debug, log_info, log_error, log_warning
 from blockchain_proto.consts import TRANS_GOSSIP, BLOCK_GOSSIP, \
         GET_BLOCKCHAIN, GET_UNADDED_TRANS, ADD_TRANS, NEW_PEER, BLOCKS_AND_TRANS, \
-        node_id_global
+        TRANS_BATCH_GOSSIP, BLOCK_BATCH_GOSSIP, INV_BLOCKS_GOSSIP, INV_TRANS_GOSSIP, GET_DATA, \
+        SEEN_CACHE, NULL_BLOCK_HASH, GET_HEADERS, SYNC_HEADERS, GET_BLOCK_BODIES, SYNC_BLOCKS, GET_MEMPOOL, SYNC_TRANS, \
+        COMPACT_BLOCKS_GOSSIP, GET_BLOCK_TRANS, BLOCK_TRANS_REPLY, SUBSCRIBE_REQUEST, PAYLOAD_CODEC, DEFAULT_CLEANUP_INTERVAL, \
+        DEFAULT_CLEANUP_BUDGET, node_id_global
 from blockchain_proto.blockchain.blockchain_ds import BlockChain
+from blockchain_proto.blockchain.consensus import CONSENSUS_ENGINES, get_consensus_engine
+from blockchain_proto.blockchain.block_size import FixedBlockSize, AdaptiveBlockSize
+from blockchain_proto.blockchain.compact_block import CompactBlock, CompactBlockAssembler
 from blockchain_proto.local_web_server import LIWebServer
 from blockchain_proto.node_test import test_local
 from blockchain_proto.blockchain.puzzle import sha_256_hash_string
 from blockchain_proto.transactions.transaction import Transaction
+from blockchain_proto.gossip import GossipBatcher, InventoryTracker, SeenCache, PeerSelector
+from blockchain_proto.sync import HeaderSync, BlockDownloadScheduler
+from blockchain_proto.codec import PayloadCodec, parse_thresholds
 
 
 class Node:
@@ -64,20 +74,93 @@ class Node:
 
         self.gossip_in_socket.setsockopt_string(zmq.SUBSCRIBE, TRANS_GOSSIP.decode()) 
         self.gossip_in_socket.setsockopt_string(zmq.SUBSCRIBE, BLOCK_GOSSIP.decode()) 
+        self.gossip_in_socket.setsockopt_string(zmq.SUBSCRIBE, TRANS_BATCH_GOSSIP.decode())
+        self.gossip_in_socket.setsockopt_string(zmq.SUBSCRIBE, BLOCK_BATCH_GOSSIP.decode())
+        self.gossip_in_socket.setsockopt_string(zmq.SUBSCRIBE, INV_BLOCKS_GOSSIP.decode())
+        self.gossip_in_socket.setsockopt_string(zmq.SUBSCRIBE, INV_TRANS_GOSSIP.decode())
+        self.gossip_in_socket.setsockopt_string(zmq.SUBSCRIBE, COMPACT_BLOCKS_GOSSIP.decode())
 
         self.gossip_out_address = f"tcp://*:{self.gossip_out_port}".encode()
         self.gossip_out_public_address = f"tcp://localhost:{self.gossip_out_port}".encode()
         self.new_peer_notify_address = f"tcp://*:{self.new_peer_notify_port}".encode()
         self.new_peer_notify_public_address = f"tcp://localhost:{self.new_peer_notify_port}".encode()
+
+        # payloads sent to peers and the local interface are compressed if
+        # their message type is given a threshold
+        self.codec = PayloadCodec(parse_thresholds(args.compress), args.compress_level)
+
+        # in inventory mode only the block hashes and transaction ids are
+        # gossiped, along with the address to request the bodies from
+        self.gossip_mode = args.gossip_mode
+        if self.gossip_mode == 'inventory':
+            self.gossip_batcher = GossipBatcher(self._send_inventory,
+                                                args.gossip_batch_size,
+                                                args.gossip_linger_ms / 1000,
+                                                block_msg_type=INV_BLOCKS_GOSSIP,
+                                                trans_msg_type=INV_TRANS_GOSSIP,
+                                                encode=self.codec.encode)
+        # in compact mode transactions are pushed, and blocks are gossiped as
+        # their headers and transaction ids, to be rebuilt from the peers' free
+        # transactions, so the transactions are sent first
+        elif self.gossip_mode == 'compact':
+            self.gossip_batcher = GossipBatcher(self._send_inventory,
+                                                args.gossip_batch_size,
+                                                args.gossip_linger_ms / 1000,
+                                                block_msg_type=COMPACT_BLOCKS_GOSSIP,
+                                                trans_first=True,
+                                                encode=self.codec.encode)
+        else:
+            self.gossip_batcher = GossipBatcher(self.gossip_out_socket.send_multipart,
+                                                args.gossip_batch_size,
+                                                args.gossip_linger_ms / 1000,
+                                                encode=self.codec.encode)
+        self.inventory_tracker = InventoryTracker()
+        self.compact_assembler = CompactBlockAssembler(lambda trans_ids: self.blockchain.get_inventory([], trans_ids)[1])
+        self.seen_cache = SeenCache(args.seen_cache_size)
+        # with a bounded fanout, messages reach the peers this node is not
+        # subscribed to by being relayed
+        self.peer_selector = PeerSelector(args.fanout, args.peer_loss_timeout)
+        self.relay = args.relay or args.fanout is not None
+        self.gossip_monitor_socket = None
+        self.peer_request_sockets = {}
     
-        self.peer_address_list = []
-        self.peer_notify_address_list = []
+        # gossip out address -> new peer notify address of each peer
+        self.peers = {}
         self.data_received = []
 
-        self.blockchain = BlockChain(args.trans_per_block, args.difficulty)
+        self.blockchain = BlockChain(args.trans_per_block, args.difficulty, args.mempool_wal,
+                                     args.finality_depth,
+                                     cleanup_interval=args.cleanup_interval,
+                                     cleanup_budget=args.cleanup_budget,
+                                     self_check=args.self_check,
+                                     assume_valid_hashes=args.assume_valid,
+                                     consensus=get_consensus_engine(args.consensus),
+                                     block_size_policy=self.create_block_size_policy(args),
+                                     max_block_wait=args.max_block_wait)
+        self.idle_poll_ms = args.idle_poll_ms
+
+        self.header_page_size = args.header_page_size
+        self.body_chunk_size = args.body_chunk_size
+        self.max_body_chunks_in_flight = args.max_body_chunks_in_flight
+        self.body_request_timeout = args.body_request_timeout
+        self.sync_trans_chunk_size = args.sync_trans_chunk_size
+        self.header_sync = None
+        self.sync_generation = 0
 
         self.initialize()
 
+    def create_block_size_policy(self, args):
+        """
+        Creates the policy for the number of transactions per block from the
+        command line arguments.
+        """
+        if args.block_size_policy == 'adaptive':
+            return AdaptiveBlockSize(args.min_trans_per_block,
+                                     args.max_trans_per_block,
+                                     args.target_block_interval,
+                                     initial_size=args.trans_per_block)
+        return FixedBlockSize(args.trans_per_block)
+
     def initialize(self): 
         """
         Initialize the sockets by binding and connecting them,
@@ -88,84 +171,177 @@ class Node:
         self.gossip_out_socket.bind(self.gossip_out_address)
         self.local_interface_socket.bind(f"inproc://local_interface")
         self.special_requests_socket.bind(self.new_peer_notify_address)
-        self.peer_address_list, self.peer_notify_address_list = self.register()
+        self.peers = self.register()
         self.connect_to_peers()
         self.send_iam_online()
+        self.start_sync()
 
-    def register(self) -> Tuple[List[str], List[str]]:
+    def register(self) -> Dict[str, str]:
         """
         Registers this node with the registration service, and 
-        returns the list of addresses of peers and the address of 
-        the publish address of the registry service.
+        returns the addresses of the peers.
 
         Returns
         -------
 
-        (list str, list str):
-            The list of addresses of peers and the address of the , 
-            publish endpoint of the registry service.
+        dict:
+            The gossip out address of each peer to its new peer notify
+            address.
         """
         log_info(logging, f"Registering node with registry at: {self.registry_address}")
         self.registry_socket.send_multipart([self.gossip_out_public_address, self.new_peer_notify_public_address])
         registration_reply = self.registry_socket.recv_multipart()
         log_debug(logging, str(registration_reply))
 
-        # get the address of other peers
-        peer_address_list = list(set(pickle.loads(registration_reply[1])))
+        # get the address and notification address of the other peers,
+        # which the registry lists in the same order
+        peer_address_list = pickle.loads(registration_reply[1])
+        peer_notify_address_list = pickle.loads(registration_reply[2])
         log_info(logging, f"Received address list {peer_address_list}")
-        if self.gossip_out_public_address in peer_address_list:
-            peer_address_list.remove(self.gossip_out_public_address)
-
-        # get the notification address of the other peers
-        peer_notify_address_list = list(set(pickle.loads(registration_reply[2])))
         log_info(logging, f"Received new peer notify address list {peer_notify_address_list}")
-        if self.new_peer_notify_public_address in peer_notify_address_list:
-            peer_notify_address_list.remove(self.new_peer_notify_public_address)
-
-        return [pa.decode() for pa in peer_address_list], [pna.decode() for pna in peer_notify_address_list]
+        return {peer_address.decode(): peer_notify_address.decode()
+                for peer_address, peer_notify_address in zip(peer_address_list, peer_notify_address_list)
+                if peer_address != self.gossip_out_public_address}
 
     def connect_to_peers(self):
         """
-        Connects to the peer in self.peer_address_list
+        Connects to the peers in self.peers chosen by the peer selector, all
+        of them unless the fanout is bounded. With a bounded fanout, the
+        peers chosen are asked to subscribe to this node in turn, and
+        disconnections and reconnections are monitored so lost neighbours
+        are replaced, see forget_lost_peers.
         """
-        for peer_address in self.peer_address_list:
+        if self.peer_selector.fanout is not None:
+            self.gossip_monitor_socket = self.gossip_in_socket.get_monitor_socket(
+                zmq.EVENT_DISCONNECTED | zmq.EVENT_CONNECTED)
+        for peer_address in self.peer_selector.add_peers(list(self.peers)):
             log_info(logging, f"Connecting to peer {peer_address}")
+            self._subscribe(peer_address)
+
+    def _subscribe(self, peer_address: str):
+        """
+        Subscribes to the gossip of a neighbour chosen by the peer selector,
+        and with a bounded fanout asks it to subscribe to this node, so
+        that every node has subscribers, see PeerSelector.
+        """
+        self.gossip_in_socket.connect(peer_address)
+        if self.peer_selector.fanout is not None and peer_address in self.peers:
+            self._get_peer_request_socket(self.peers[peer_address].encode()).send_multipart(
+                [SUBSCRIBE_REQUEST, self.gossip_out_public_address, self.new_peer_notify_public_address])
+
+    def handle_subscribe_request(self, request: List[bytes]):
+        """
+        Subscribes to the gossip of a peer which chose this node as one of
+        its neighbours.
+
+        Parameters
+        ----------
+
+        request: list of bytes
+            The request received on the special requests socket, with the
+            gossip out and new peer notify addresses of the peer.
+        """
+        peer_address = request[2].decode()
+        self.peers.setdefault(peer_address, request[3].decode())
+        if self.peer_selector.subscribe_requested(peer_address) is not None:
+            log_info(logging, f"Connecting to peer {peer_address} at its request.")
             self.gossip_in_socket.connect(peer_address)
-            
+
+    def handle_gossip_monitor_event(self):
+        """
+        Records that the gossip out socket of a neighbour got disconnected or
+        reconnected. zmq retries the connection by itself, so a neighbour is
+        only forgotten by forget_lost_peers if it stays disconnected.
+        """
+        event = recv_monitor_message(self.gossip_monitor_socket)
+        peer_address = event['endpoint'].decode()
+        if event['event'] == zmq.EVENT_CONNECTED:
+            self.peer_selector.peer_reconnected(peer_address)
+        else:
+            self.peer_selector.peer_disconnected(peer_address)
+
+    def forget_lost_peers(self):
+        """
+        Forgets the neighbours which stayed disconnected for longer than the
+        loss timeout, so that they are no longer synced with or asked for
+        block bodies, and replaces them by other known peers.
+        """
+        for peer_address in self.peer_selector.lost_peers():
+            replacement = self.peer_selector.peer_lost(peer_address)
+            self.gossip_in_socket.disconnect(peer_address)
+            peer_notify_address = self.peers.pop(peer_address, None)
+            if peer_notify_address is not None and self.header_sync is not None:
+                self.header_sync.downloader.remove_peer(peer_notify_address.encode())
+            log_info(logging, f"Lost peer {peer_address}.")
+            if replacement is not None:
+                log_info(logging, f"Connecting to peer {replacement} instead.")
+                self._subscribe(replacement)
+
+
     def send_iam_online(self):
         """
         Notifies peers that is online and it should start receiving messages.
         """
         log_info(logging, "Notifying peers that \"I'm online\".")
         notify_socket = self.context.socket(zmq.DEALER)
-        for peer_notify_address in self.peer_notify_address_list:
+        for peer_notify_address in self.peers.values():
             log_info(logging, f"Sending I am online to {peer_notify_address}")
             notify_socket.connect(peer_notify_address)
             notify_socket.send_multipart([NEW_PEER, self.gossip_out_public_address, self.new_peer_notify_public_address])
 
         log_info(logging, "Done notifying peers.")
 
-    def handle_gossip_in(self, data: List[bytes]):
+    def handle_gossip_in(self, data: list):
         """
         Method to handle the data that was gossiped in.
 
         Parameters
         ----------
 
-        data: list bytes
+        data: list of bytes or zmq.Frame
             The data recieved from the gossip_in_socket. The first
-            element determines the type of the data, the second
-            element gives a pickled object of the given type.
+            element determines the type of the data, the last
+            element gives a pickled object of the given type, encoded
+            by the PayloadCodec.
+            Messages seen recently, e.g. the same item gossiped by several
+            peers, are dropped without being unpickled. In relay mode the
+            frames are not copied out of zmq, and the blocks and
+            transactions that pass validation are re-published.
         """
+        if self.seen_cache.check_and_add(data):
+            return
+        msg_type = bytes(data[0])
         try:
-            if data[0] == TRANS_GOSSIP:
-                trans = pickle.loads(data[1])
+            if msg_type == TRANS_GOSSIP:
+                trans = self._loads(data[1])
                 log_info(logging, f"Adding transaction... {str(trans)}")
                 self.blockchain.add_transaction(trans)
-            elif data[0] == BLOCK_GOSSIP: 
-                    self.blockchain.add_incoming_block(pickle.loads(data[1]))
+                self._relay(data)
+            elif msg_type == BLOCK_GOSSIP: 
+                    block = self._loads(data[1])
+                    if isinstance(self.blockchain.add_incoming_block(block), BlockSimple):
+                        self._relay(data)
+                    self._sync_if_behind([block])
+            elif msg_type == TRANS_BATCH_GOSSIP:
+                # transactions that were already added are returned and ignored
+                trans_list = self._loads(data[1])
+                _, already_added = self.blockchain.add_transactions(trans_list)
+                already_added = set((trans.user_id, trans.trans_no) for trans in already_added)
+                self._relay(data, [trans for trans in trans_list
+                                   if (trans.user_id, trans.trans_no) not in already_added], len(trans_list))
+            elif msg_type == BLOCK_BATCH_GOSSIP:
+                # blocks that were already added are skipped
+                blocks = self._loads(data[1])
+                self._relay(data, self.blockchain.add_incoming_blocks(blocks), len(blocks))
+                self._sync_if_behind(blocks)
+            elif msg_type == INV_BLOCKS_GOSSIP:
+                self.request_missing_inventory(bytes(data[1]), self._loads(data[2]), [])
+            elif msg_type == INV_TRANS_GOSSIP:
+                self.request_missing_inventory(bytes(data[1]), [], self._loads(data[2]))
+            elif msg_type == COMPACT_BLOCKS_GOSSIP:
+                self.add_compact_blocks(data)
             else:
-                log_error(logging, f"Unknown gossip message type {data[0]}")
+                log_error(logging, f"Unknown gossip message type {msg_type}")
         except BlockWasAlreadyAddedError as e:
             # Will happen in a normal course of operation
             pass
@@ -176,6 +352,47 @@ class Node:
             # unexpected Exception
             log_error(logging, "When trying to handle gossiped-in message encountered: {e}")
 
+    def _relay(self, data: list, items_accepted: list = None, num_items: int = 0):
+        """
+        In relay mode, re-publishes a gossiped-in message after validation so
+        that it reaches peers which are not connected to its sender. If all
+        the items of a batch were accepted, or it is not a batch, the frames
+        received are sent as they are without copying. Otherwise only the
+        accepted items are sent, in a new batch with the same other frames.
+
+        Parameters
+        ----------
+
+        data: list of bytes or zmq.Frame
+            The message received.
+
+        items_accepted: list
+            For a batch, the blocks or transactions which were added.
+
+        num_items: int
+            For a batch, the number of blocks or transactions in it.
+        """
+        if not self.relay:
+            return
+        if items_accepted is None or len(items_accepted) == num_items:
+            self.gossip_out_socket.send_multipart(data, copy=False)
+        elif len(items_accepted) > 0:
+            self.gossip_out_socket.send_multipart([bytes(frame) for frame in data[:-1]] +
+                                                  [self._dumps(bytes(data[0]), items_accepted)])
+
+    def _dumps(self, msg_type: bytes, obj) -> bytes:
+        """
+        Pickles the payload of a message of the given type and encodes it
+        with the PayloadCodec, compressing it if it is large enough.
+        """
+        return self.codec.encode(msg_type, pickle.dumps(obj))
+
+    def _loads(self, data):
+        """
+        Decodes and unpickles the payload of a message sent with _dumps.
+        """
+        return pickle.loads(self.codec.decode(data))
+
     def handle_local_interface_request(self, request: List[bytes]):
         """
         Method to handle information received from the local
@@ -192,16 +409,18 @@ class Node:
             The second element gives the type of information requested.
         """
         if request[1] == GET_BLOCKCHAIN:
-            bc_json_str = json.dumps(self.blockchain.to_json(), indent=4)
+            bc_json_str = json.dumps({**self.blockchain.to_json(), SEEN_CACHE: self.seen_cache.to_json(),
+                                      PAYLOAD_CODEC: self.codec.to_json()},
+                                     indent=4)
             self.local_interface_socket.send_multipart(
-                [request[0], b'', pickle.dumps(bc_json_str)]
+                [request[0], b'', self._dumps(GET_BLOCKCHAIN, bc_json_str)]
             )
 
         elif request[1] == GET_UNADDED_TRANS:
             trans = json.dumps(self.blockchain.get_trans_not_added_json(), indent=4)
             log_info(logging, f"Returning Un-added transactions {trans}.")
             self.local_interface_socket.send_multipart(
-                [request[0], b'', pickle.dumps(trans)]
+                [request[0], b'', self._dumps(GET_UNADDED_TRANS, trans)]
             )
 
         elif request[1] == ADD_TRANS:
@@ -225,35 +444,31 @@ class Node:
         trans_list: list of transactions
             The list of transactions to be added.
         """
+        log_info(logging, f"Adding {len(trans_list)} transactions...")
+        new_blocks, already_added = self.blockchain.add_transactions(trans_list)
+        already_added = set((trans.user_id, trans.trans_no) for trans in already_added)
+
         response_list = []
-        new_blocks = []
         for trans in trans_list:
-            log_info(logging, f"Adding transaction... {str(trans)}")
-            try: 
-                blocks_created = self.blockchain.add_transaction(trans)
-            except TransWasAlreadyAddedError as e:
-                blocks_created = str(e)
-
-            if isinstance(blocks_created, list):
-                resp_str = f"Added transaction User ID: {trans.user_id}, Trans No: {trans.trans_no}" 
-                if len(blocks_created) > 0: resp_str = resp_str + f" and created {len(blocks_created)} block(s)."
-                else: resp_str = resp_str + "."
-                new_blocks.extend(blocks_created)
+            if (trans.user_id, trans.trans_no) in already_added:
+                resp_str = str(TransWasAlreadyAddedError(trans.user_id, trans.trans_no))
             else:
-                resp_str = blocks_created
+                resp_str = f"Added transaction User ID: {trans.user_id}, Trans No: {trans.trans_no}."
             response_list.append(resp_str)
+        if len(new_blocks) > 0:
+            response_list.append(f"Created {len(new_blocks)} block(s).")
 
         response_str = "\n".join(response_list)
 
         self.local_interface_socket.send_multipart(
-            [zmq_sock_address, b'', pickle.dumps(response_str)]
+            [zmq_sock_address, b'', self._dumps(ADD_TRANS, response_str)]
         )
 
         self._gossip_blocks_and_trans(new_blocks, trans_list)
 
     def _gossip_blocks_and_trans(self, blocks_list: List[BlockSimple], trans_list: List[Transaction]):
         """
-        Gossips a list of blocks and transactions to peers.
+        Gossips a list of blocks and transactions to peers, in batches.
 
         Parameters
         ----------
@@ -264,38 +479,173 @@ class Node:
         trans_list: list of Transaction
             The transactions to be gossiped to the peers.
         """
-        print("gossiping")
-        for block in blocks_list:
-            self.gossip_out_socket.send_multipart([BLOCK_GOSSIP, pickle.dumps(block)])
+        if self.gossip_mode == 'inventory':
+            blocks_list = [block.hash() for block in blocks_list]
+            trans_list = [(trans.user_id, trans.trans_no) for trans in trans_list]
+        elif self.gossip_mode == 'compact':
+            blocks_list = [CompactBlock.from_block(block) for block in blocks_list]
+        self.gossip_batcher.add(blocks_list, trans_list)
+
+    def _send_inventory(self, msg: List[bytes]):
+        """
+        Publishes an inventory or compact blocks message, adding the address
+        where peers can request the bodies of the blocks and transactions
+        announced. Transaction batches are published as they are.
+        """
+        if msg[0] == TRANS_BATCH_GOSSIP:
+            self.gossip_out_socket.send_multipart(msg)
+        else:
+            self.gossip_out_socket.send_multipart([msg[0], self.new_peer_notify_public_address, msg[1]])
 
-        for trans in trans_list:
-            self.gossip_out_socket.send_multipart([TRANS_GOSSIP, pickle.dumps(trans)])
+    def _get_peer_request_socket(self, peer_notify_address: bytes):
+        """
+        Returns a DEALER socket connected to the given peer's special requests socket,
+        creating it the first time.
+        """
+        if peer_notify_address not in self.peer_request_sockets:
+            peer_socket = self.context.socket(zmq.DEALER)
+            peer_socket.connect(peer_notify_address.decode())
+            self.peer_request_sockets[peer_notify_address] = peer_socket
+        return self.peer_request_sockets[peer_notify_address]
+
+    def request_missing_inventory(self, peer_notify_address: bytes, block_hashes: List[str],
+                                  trans_ids: List[Tuple[str, int]]):
+        """
+        Requests from the peer that announced them the blocks and transactions
+        this node does not have, and has not requested recently from another peer.
+
+        Parameters
+        ----------
+
+        peer_notify_address: bytes
+            Address of the special requests socket of the peer.
+
+        block_hashes: list of str
+            The hashes of the blocks announced.
+
+        trans_ids: list of (str, int)
+            The (user_id, trans_no)'s of the transactions announced.
+        """
+        block_hashes, trans_ids = self.blockchain.get_missing_inventory(block_hashes, trans_ids)
+        block_hashes = self.inventory_tracker.to_request(block_hashes)
+        trans_ids = self.inventory_tracker.to_request(trans_ids)
+        if len(block_hashes) == 0 and len(trans_ids) == 0:
+            return
+        self._get_peer_request_socket(peer_notify_address).send_multipart(
+            [GET_DATA, self.new_peer_notify_public_address, self._dumps(GET_DATA, [block_hashes, trans_ids])])
+
+    def send_requested_inventory(self, request: List[bytes]):
+        """
+        Sends the blocks and transactions a peer requested with GET_DATA,
+        to be added as BLOCKS_AND_TRANS.
+
+        request: list of bytes
+            Request received from the peer, with the address to reply to and
+            the pickled block hashes and transaction ids.
+        """
+        block_hashes, trans_ids = self._loads(request[3])
+        blocks, trans_list = self.blockchain.get_inventory(block_hashes, trans_ids)
+        self._get_peer_request_socket(request[2]).send_multipart(
+            [BLOCKS_AND_TRANS, self._dumps(BLOCKS_AND_TRANS, [blocks, trans_list])])
+
+
+    def add_compact_blocks(self, data: list):
+        """
+        Rebuilds the gossiped-in compact blocks from the free transactions of
+        this node and adds them. If some of their transactions are missing,
+        they are requested from the peer that sent the compact blocks, with
+        GET_BLOCK_TRANS, and the blocks are added once they arrive.
+
+        Parameters
+        ----------
+
+        data: list of bytes or zmq.Frame
+            The message received, with the address of the special requests
+            socket of the sender and the pickled compact blocks.
+        """
+        compact_blocks = self._loads(data[2])
+        new_compact_blocks = [compact for compact in compact_blocks if compact.hash() not in self.blockchain.block_map]
+        if len(new_compact_blocks) == 0:
+            return
+        blocks, request_id, missing = self.compact_assembler.add(new_compact_blocks)
+        if request_id is not None:
+            log_info(logging, f"Requesting {sum(len(trans_ids) for trans_ids in missing.values())} " +
+                              f"transactions missing from {len(missing)} compact blocks.")
+            self._get_peer_request_socket(bytes(data[1])).send_multipart(
+                [GET_BLOCK_TRANS, self.new_peer_notify_public_address, self._dumps(GET_BLOCK_TRANS, (request_id, missing))])
+            return
+        blocks_added = self.blockchain.add_incoming_blocks(blocks)
+        self._relay(data, [CompactBlock.from_block(block) for block in blocks_added], len(compact_blocks))
+        self._sync_if_behind(blocks)
+
+    def send_block_transactions(self, request: List[bytes]):
+        """
+        Sends the transactions of blocks that a peer requested with
+        GET_BLOCK_TRANS to rebuild them from compact blocks.
+
+        request: list of bytes
+            Request received from the peer, with the address to reply to and
+            the pickled request id and dict from block hash to the ids of
+            the transactions requested.
+        """
+        request_id, missing = self._loads(request[3])
+        block_trans = {bhash: self.blockchain.get_block_transactions(bhash, trans_ids)
+                       for bhash, trans_ids in missing.items()}
+        self._get_peer_request_socket(request[2]).send_multipart(
+            [BLOCK_TRANS_REPLY, self.new_peer_notify_public_address,
+             self._dumps(BLOCK_TRANS_REPLY, (request_id, block_trans))])
+
+    def add_compact_block_trans(self, request: List[bytes]):
+        """
+        Adds the blocks rebuilt with the transactions sent by a peer in reply
+        to a GET_BLOCK_TRANS request. The blocks which still cannot be rebuilt
+        are requested in full with GET_DATA. In relay mode the blocks added
+        are gossiped on as compact blocks.
+
+        request: list of bytes
+            Reply received from the peer, with its address and the pickled
+            request id and dict from block hash to transactions.
+        """
+        request_id, block_trans = self._loads(request[3])
+        blocks, failed_hashes = self.compact_assembler.trans_received(request_id, block_trans)
+        blocks_added = self.blockchain.add_incoming_blocks(blocks)
+        log_info(logging, f"Added {len(blocks_added)} blocks rebuilt from compact blocks.")
+        if len(failed_hashes) > 0:
+            log_warning(logging, f"Could not rebuild {len(failed_hashes)} compact blocks, requesting them in full.")
+            self.request_missing_inventory(request[2], failed_hashes, [])
+        if self.relay:
+            self._gossip_blocks_and_trans(blocks_added, [])
+        self._sync_if_behind(blocks)
 
-        
     def add_blocks_trans(self, request: List[bytes]):
         """
-        Adds blocks and transactions received from a new peer that has just connected.
+        Adds blocks and transactions received from a new peer that has just connected,
+        or sent by a peer in reply to a GET_DATA request. In relay mode the
+        blocks and transactions accepted are gossiped on, so that in
+        inventory mode they are announced to the peers subscribed to this
+        node rather than stopping one hop from where they were created.
 
         request: list of bytes
             Data recevied from the peer.
         """
-        blocks_trans = pickle.loads(request[2])
+        blocks_trans = self._loads(request[2])
+        self.inventory_tracker.received([block.hash() for block in blocks_trans[0]])
+        self.inventory_tracker.received([(trans.user_id, trans.trans_no) for trans in blocks_trans[1]])
         log_info(logging, f"Adding {len(blocks_trans[0])} blocks from peer.")
-        for block in blocks_trans[0]:
-            try:
-                self.blockchain.add_incoming_block(block)
-            except BlockWasAlreadyAddedError as v:
-                # This can happen naturally - so ignore
-                pass 
+        # blocks that were already added are skipped, which can happen
+        # naturally
+        blocks_added = self.blockchain.add_incoming_blocks(blocks_trans[0])
+        log_info(logging, f"Added {len(blocks_added)} blocks from peer.")
+        self._sync_if_behind(blocks_trans[0])
 
         log_info(logging, f"Adding {len(blocks_trans[1])} transactions from peer.")
-        for trans in blocks_trans[1]:
-            try:
-                self.blockchain.add_transaction(trans)
-            except TransWasAlreadyAddedError as v:
-                # This can happen naturally - so ignore
-                pass 
-            
+        # transactions that were already added are returned, which can
+        # happen naturally - so ignore
+        _, already_added = self.blockchain.add_transactions(blocks_trans[1])
+        if self.relay:
+            already_added = set((trans.user_id, trans.trans_no) for trans in already_added)
+            self._gossip_blocks_and_trans(blocks_added, [trans for trans in blocks_trans[1]
+                                                         if (trans.user_id, trans.trans_no) not in already_added])
 
     def handle_new_peer(self, new_peer_info: List[bytes]):
         """
@@ -307,16 +657,161 @@ class Node:
         new_peer_info: list of bytes
             The data recieved from the gossip_in_socket
         """
-        self.peer_address_list.append(new_peer_info[2].decode())
-        self.peer_notify_address_list.append(new_peer_info[3].decode())
+        peer_address = new_peer_info[2].decode()
+        peer_notify_address = new_peer_info[3].decode()
+        self.peers[peer_address] = peer_notify_address
+
+        connect_address = self.peer_selector.peer_joined(peer_address)
+        if connect_address is not None:
+            self._subscribe(connect_address)
+        if self.header_sync is not None:
+            self.header_sync.downloader.add_peer(peer_notify_address.encode())
+
+        # the new peer syncs with one of its peers by itself, see start_sync
+        log_info(logging, f"New peer has come online {peer_address}, " +
+                          f"subscribed: {connect_address is not None}.")
+
+    def start_sync(self, exclude_peer: bytes = None):
+        """
+        Starts syncing headers-first with a randomly chosen peer, if there
+        are any: the headers of its longest fork after the latest block this
+        node has in common with it are fetched and checked in pages, then
+        the block bodies in chunks from all the peers at once, then the free
+        transactions this node does not have.
+
+        Parameters
+        ----------
+
+        exclude_peer: bytes
+            If given, the address of a peer not to sync with, e.g. because
+            the last sync with it failed.
+        """
+        peer_addresses = [address.encode() for address in self.peers.values()
+                          if address.encode() != exclude_peer]
+        if len(peer_addresses) == 0:
+            self.header_sync = None
+            return
+        sync_peer_address = random.choice(peer_addresses)
+        self.sync_generation += 1
+        downloader = BlockDownloadScheduler(peer_addresses,
+                                            self.body_chunk_size,
+                                            self.max_body_chunks_in_flight,
+                                            self.body_request_timeout)
+        self.header_sync = HeaderSync(sync_peer_address,
+                                      self.blockchain.block_map,
+                                      self.blockchain.get_block_locator(),
+                                      self.blockchain.get_trans_summary,
+                                      self.blockchain.consensus,
+                                      self.header_page_size,
+                                      downloader,
+                                      self.blockchain.fork_manager.assume_valid.checkpoint_hashes,
+                                      self.sync_generation)
+        log_info(logging, f"Syncing with peer {sync_peer_address}.")
+        self._send_sync_requests()
+
+    def _sync_if_behind(self, blocks: List[BlockSimple]):
+        """
+        Starts a sync if one of the blocks received follows a block this node
+        does not have, e.g. because it missed some blocks while offline.
+        """
+        if self.header_sync is None and \
+           any(block.prev_hash() != NULL_BLOCK_HASH and block.prev_hash() not in self.blockchain.block_map
+               for block in blocks):
+            log_info(logging, "Received a block after blocks this node does not have.")
+            self.start_sync()
+
+    def _send_sync_requests(self):
+        """
+        Sends the requests that the header sync is ready to make to the
+        peers, including those for block bodies which timed out.
+        """
+        for peer_address, msg_type, data in self.header_sync.next_requests():
+            self._get_peer_request_socket(peer_address).send_multipart(
+                [msg_type, self.new_peer_notify_public_address, self._dumps(msg_type, data)])
 
-        self.gossip_in_socket.connect(self.peer_address_list[-1])
-        send_blocks_trans_socket = self.context.socket(zmq.DEALER)
-        send_blocks_trans_socket.connect(self.peer_notify_address_list[-1])
-        data = pickle.dumps( [self.blockchain.get_block_list(), self.blockchain.get_trans_not_added()])
-        send_blocks_trans_socket.send_multipart([BLOCKS_AND_TRANS, data])
+    def handle_sync_reply(self, request: List[bytes]):
+        """
+        Passes a reply from a peer to the header sync, adds the blocks
+        and transactions that are ready, and sends the next requests.
 
-        log_info(logging, f"Connected to new peer that has come online {self.peer_address_list[-1]} and sent it my blocks/trans.")
+        Parameters
+        ----------
+
+        request: list of bytes
+            The reply received on the special requests socket.
+        """
+        if self.header_sync is None:
+            log_warning(logging, f"Ignoring {request[1]} received when not syncing.")
+            return
+        try:
+            data = self._loads(request[2])
+            if request[1] == SYNC_HEADERS:
+                headers, start_height, locator = data
+            elif request[1] == SYNC_BLOCKS:
+                chunk_id, blocks, generation = data
+            else:
+                trans_list, is_last, generation, peer = data
+        except Exception as e:
+            log_error(logging, f"Dropping malformed {request[1]} reply: {e}")
+            return
+        try:
+            if request[1] == SYNC_HEADERS:
+                self.header_sync.headers_received(headers, start_height, locator)
+            elif request[1] == SYNC_BLOCKS:
+                blocks = self.header_sync.blocks_received(chunk_id, blocks, generation)
+            else:
+                trans_list = self.header_sync.trans_received(trans_list, is_last, generation, peer)
+        except ValueError as e:
+            # the sync peer sent an invalid chain or switched forks, start
+            # over with another peer
+            log_error(logging, f"Sync with {self.header_sync.sync_peer} failed: {e}")
+            self.start_sync(exclude_peer=self.header_sync.sync_peer)
+            return
+        except Exception as e:
+            log_error(logging, f"Dropping malformed {request[1]} reply: {e}")
+            return
+        if request[1] == SYNC_BLOCKS:
+            self.blockchain.add_incoming_blocks(blocks, headers_checked=True)
+        elif request[1] == SYNC_TRANS:
+            self.blockchain.add_transactions(trans_list)
+        if self.header_sync.is_done():
+            log_info(logging, f"Synced {len(self.blockchain.main_chain)} blocks with {self.header_sync.sync_peer}.")
+            self.header_sync = None
+        else:
+            self._send_sync_requests()
+
+    def handle_sync_request(self, request: List[bytes]):
+        """
+        Replies to a request from a peer that is syncing with this node:
+        a page of headers after the latest block in its locator, a chunk of
+        block bodies, or the free transactions it does not have in chunks.
+
+        Parameters
+        ----------
+
+        request: list of bytes
+            The request received on the special requests socket, with the
+            address to reply to and the pickled arguments.
+        """
+        peer_socket = self._get_peer_request_socket(request[2])
+        data = self._loads(request[3])
+        if request[1] == GET_HEADERS:
+            start_height, headers = self.blockchain.get_headers_after(*data)
+            peer_socket.send_multipart([SYNC_HEADERS, self._dumps(SYNC_HEADERS, (headers, start_height, data[0]))])
+        elif request[1] == GET_BLOCK_BODIES:
+            chunk_id, block_hashes, generation = data
+            blocks, _ = self.blockchain.get_inventory(block_hashes, [])
+            peer_socket.send_multipart([SYNC_BLOCKS, self._dumps(SYNC_BLOCKS, (chunk_id, blocks, generation))])
+        else:
+            # only the transactions not in the peer's summary, if it sent one
+            summary, generation = data
+            trans_list = self.blockchain.get_trans_not_added() if summary is None \
+                else self.blockchain.get_trans_not_in(summary)
+            chunk_size = self.sync_trans_chunk_size
+            for start in range(0, max(len(trans_list), 1), chunk_size):
+                is_last = start + chunk_size >= len(trans_list)
+                chunk = (trans_list[start:start + chunk_size], is_last, generation, self.new_peer_notify_public_address)
+                peer_socket.send_multipart([SYNC_TRANS, self._dumps(SYNC_TRANS, chunk)])
 
     def run(self):
         """
@@ -329,6 +824,8 @@ class Node:
         poller.register(self.local_interface_socket, zmq.POLLIN)
         poller.register(self.gossip_in_socket, zmq.POLLIN)
         poller.register(self.special_requests_socket, zmq.POLLIN)
+        if self.gossip_monitor_socket is not None:
+            poller.register(self.gossip_monitor_socket, zmq.POLLIN)
 
         log_info(logging, "**** Hello There! ****")
         log_info(logging, "Local BC-Proto node is now running...")
@@ -336,11 +833,39 @@ class Node:
                           f"New-Peer-Port: {self.new_peer_notify_port}, " +
                           f"Using registry at: {self.registry_address}")
 
+        idle_work_left = False
         while True:
-            socks = dict(poller.poll())
+            # seal a partial block if transactions have waited for too long
+            new_blocks = self.blockchain.tick()
+            if len(new_blocks) > 0:
+                log_info(logging, f"Sealed {len(new_blocks)} block(s) after waiting for transactions.")
+                self._gossip_blocks_and_trans(new_blocks, [])
+
+            # request again the headers, bodies and transactions that timed out when syncing
+            if self.header_sync is not None:
+                self._send_sync_requests()
+
+            self.forget_lost_peers()
+
+            # send the gossip batches that have waited long enough
+            self.gossip_batcher.flush_if_due()
+
+            # only wait as long as there is no pending housekeeping to do
+            # or gossip to send
+            timeout = 0 if idle_work_left else self.idle_poll_ms
+            gossip_due = self.gossip_batcher.seconds_until_due()
+            if gossip_due is not None:
+                timeout = min(timeout, int(gossip_due * 1000))
+            socks = dict(poller.poll(timeout))
+            if len(socks) == 0:
+                idle_work_left = self.blockchain.run_idle_tasks()
+                continue
+
+            if self.gossip_monitor_socket is not None and self.gossip_monitor_socket in socks:
+                self.handle_gossip_monitor_event()
 
             if self.gossip_in_socket in socks:
-                data = self.gossip_in_socket.recv_multipart()
+                data = self.gossip_in_socket.recv_multipart(copy=not self.relay)
                 self.handle_gossip_in(data)
 
             if self.local_interface_socket in socks:
@@ -352,8 +877,20 @@ class Node:
                 request = self.special_requests_socket.recv_multipart()
                 if request[1] == NEW_PEER:
                     self.handle_new_peer(request)
+                elif request[1] == SUBSCRIBE_REQUEST:
+                    self.handle_subscribe_request(request)
                 elif request[1] == BLOCKS_AND_TRANS:
                     self.add_blocks_trans(request)
+                elif request[1] == GET_DATA:
+                    self.send_requested_inventory(request)
+                elif request[1] == GET_BLOCK_TRANS:
+                    self.send_block_transactions(request)
+                elif request[1] == BLOCK_TRANS_REPLY:
+                    self.add_compact_block_trans(request)
+                elif request[1] in (GET_HEADERS, GET_BLOCK_BODIES, GET_MEMPOOL):
+                    self.handle_sync_request(request)
+                elif request[1] in (SYNC_HEADERS, SYNC_BLOCKS, SYNC_TRANS):
+                    self.handle_sync_reply(request)
                 else:
                     log_error(logging, f"Unknown message type in additional_request socket: {request[1]}")
 
@@ -377,6 +914,110 @@ def parseargs():
     parser.add_argument('--difficulty',
                         help='Difficulty level for the puzzles in the blockchain.',
                         default=2, type=int, required=False)
+    parser.add_argument('--block-size-policy',
+                        help="'fixed' for trans-per-block transactions in every block, 'adaptive' to " +
+                        "grow or shrink blocks within the min/max bounds based on the backlog of " +
+                        "transactions and the time between blocks.",
+                        choices=['fixed', 'adaptive'], default='fixed', required=False)
+    parser.add_argument('--min-trans-per-block',
+                        help='Minimum number of transactions per block for the adaptive policy.',
+                        default=1, type=int, required=False)
+    parser.add_argument('--max-trans-per-block',
+                        help='Maximum number of transactions per block for the adaptive policy.',
+                        default=100, type=int, required=False)
+    parser.add_argument('--target-block-interval',
+                        help='Target number of seconds between blocks for the adaptive policy.',
+                        default=5.0, type=float, required=False)
+    parser.add_argument('--max-block-wait',
+                        help='If given, number of seconds after which waiting transactions are sealed ' +
+                        'into a block even if there are not enough of them for a full block.',
+                        default=None, type=float, required=False)
+    parser.add_argument('--mempool-wal',
+                        help='If given, path of a log file used to keep the transactions ' +
+                        'not yet added to a block across restarts.',
+                        default=None, required=False)
+    parser.add_argument('--finality-depth',
+                        help='Number of blocks behind the head of the longest fork after which ' +
+                        'blocks are final and the state kept for validating forks is compacted.',
+                        default=None, type=int, required=False)
+    parser.add_argument('--cleanup-interval',
+                        help='Number of blocks added after which forks that have become too short ' +
+                        'are cleaned up. They are also cleaned up when the node is idle.',
+                        default=DEFAULT_CLEANUP_INTERVAL, type=int, required=False)
+    parser.add_argument('--cleanup-budget',
+                        help='Maximum number of forks dropped in each cleanup.',
+                        default=DEFAULT_CLEANUP_BUDGET, type=int, required=False)
+    parser.add_argument('--idle-poll-ms',
+                        help='Milliseconds without any messages after which the node runs its ' +
+                        'housekeeping tasks.',
+                        default=50, type=int, required=False)
+    parser.add_argument('--self-check',
+                        help="Flag - if set, blocks created by this node are fully validated, including " +
+                        "their hashes and puzzle solutions, before being added.",
+                        action='store_true', required=False)
+    parser.add_argument('--assume-valid',
+                        help='Hashes of trusted checkpoint blocks. The puzzle solutions of these blocks ' +
+                        'and their ancestors are not checked when syncing with a peer.',
+                        nargs='*', default=None, required=False)
+    parser.add_argument('--consensus',
+                        help="Consensus engine for sealing and checking blocks. 'instant-seal' is for " +
+                        "development clusters only, its blocks are rejected by 'pow' nodes.",
+                        choices=list(CONSENSUS_ENGINES), default='pow', required=False)
+    parser.add_argument('--gossip-batch-size',
+                        help='Maximum number of blocks or transactions gossiped in one message.',
+                        default=256, type=int, required=False)
+    parser.add_argument('--gossip-linger-ms',
+                        help='Maximum number of milliseconds a block or transaction waits to be ' +
+                        'gossiped, so that it can be batched with others.',
+                        default=10, type=float, required=False)
+    parser.add_argument('--gossip-mode',
+                        help="'push' gossips the blocks and transactions themselves, 'inventory' only " +
+                        "announces their hashes and ids, and peers request the ones they lack. 'compact' " +
+                        "pushes transactions, and blocks as their headers and transaction ids, which " +
+                        "peers rebuild from their free transactions, requesting the ones they lack.",
+                        choices=['push', 'inventory', 'compact'], default='push', required=False)
+    parser.add_argument('--header-page-size',
+                        help='Number of block headers requested at a time when syncing with a peer.',
+                        default=2000, type=int, required=False)
+    parser.add_argument('--body-chunk-size',
+                        help='Number of block bodies requested at a time when syncing with a peer.',
+                        default=64, type=int, required=False)
+    parser.add_argument('--max-body-chunks-in-flight',
+                        help='Maximum number of chunks of block bodies requested from a peer and not ' +
+                        'yet received when syncing.',
+                        default=4, type=int, required=False)
+    parser.add_argument('--body-request-timeout',
+                        help='Number of seconds after which a chunk of block bodies, a page of headers ' +
+                        'or the free transactions requested when syncing are requested again, from ' +
+                        'another peer if possible.',
+                        default=10.0, type=float, required=False)
+    parser.add_argument('--sync-trans-chunk-size',
+                        help='Number of free transactions sent at a time to a peer syncing with this node.',
+                        default=1000, type=int, required=False)
+    parser.add_argument('--relay',
+                        help="Flag - if set, blocks and transactions gossiped in are re-published once " +
+                        "validated, so they reach peers that are not connected to their sender.",
+                        action='store_true', required=False)
+    parser.add_argument('--fanout',
+                        help='If given, the number of peers whose gossip this node chooses to subscribe ' +
+                        'to, which are asked to subscribe to it in turn, instead of all of them. ' +
+                        'Implies --relay.',
+                        default=None, type=int, required=False)
+    parser.add_argument('--peer-loss-timeout',
+                        help='With --fanout, number of seconds after which a peer whose gossip this ' +
+                        'node subscribes to is forgotten if it stays disconnected.',
+                        default=10.0, type=float, required=False)
+    parser.add_argument('--compress',
+                        help="Message types whose payloads are compressed with zlib, each as " +
+                        "'msg_type:min_bytes' so that only payloads of at least min_bytes are compressed, " +
+                        "e.g. 'blocks_trans:4096 sync_blocks:4096 sync_trans:4096 get_blockchain:16384'.",
+                        nargs='*', default=None, required=False)
+    parser.add_argument('--compress-level',
+                        help='zlib compression level, from 1 (fastest) to 9 (smallest).',
+                        default=6, type=int, choices=range(1, 10), required=False)
+    parser.add_argument('--seen-cache-size',
+                        help='Number of recently gossiped-in messages remembered to drop duplicates.',
+                        default=100000, type=int, required=False)
     parser.add_argument('--node-id',
                         help="ID of node - used only for displaying messages.",
                         default=1,                            
@@ -17,6 +17,7 @@ import numpy as np
 from blockchain_proto.transactions.transaction import Transaction
 from blockchain_proto.consts import ADD_TRANS, GET_UNADDED_TRANS
 from blockchain_proto.log_messages import log_debug
+from blockchain_proto.codec import PayloadCodec
 
 
 def create_transactions_for_test(user_nums, base_trans, trans_per_user):
@@ -63,5 +64,5 @@ def test_local(user_id, context):
     local_interface_socket.send_multipart([GET_UNADDED_TRANS])
     unadded_trans = local_interface_socket.recv_multipart()
     
-    log_debug(logging, f"Transactions not yet added: {pickle.loads(unadded_trans[1])}")
+    log_debug(logging, f"Transactions not yet added: {pickle.loads(PayloadCodec().decode(unadded_trans[1]))}")
 
@@ -42,10 +42,9 @@ def run(registry_port=5001):
                                         pickle.dumps(address_list), 
                                         pickle.dumps(notify_address_list)])
 
+        # the addresses of a peer are kept at the same position in both lists
         if message[1] not in address_list:
             address_list.append(message[1])
-
-        if message[2] not in notify_address_list:
             notify_address_list.append(message[2])
 
 
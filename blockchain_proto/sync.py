@@ -0,0 +1,470 @@
+"""
+Copyright 2022 M. M. Hassan Mahmud
+
+This Source Code Form is subject to the terms of the Mozilla Public
+License, v. 2.0. If a copy of the MPL was not distributed with this
+file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+
+Implements the headers-first sync of a peer that has just come online
+with one of the existing peers, with the block bodies downloaded from
+all the peers at once.
+"""
+from collections import defaultdict
+from typing import List, Tuple
+import time
+
+from blockchain_proto.blockchain.block_simple import BlockHeader, BlockSimple
+from blockchain_proto.blockchain.block_helper import create_block_hash, validate_block_hash
+from blockchain_proto.blockchain.consensus import ConsensusEngine, PROOF_OF_WORK
+from blockchain_proto.transactions.transaction import Transaction
+from blockchain_proto.consts import NULL_BLOCK_HASH, GET_HEADERS, GET_BLOCK_BODIES, GET_MEMPOOL
+
+SYNC_HEADERS_STATE = 'headers'
+SYNC_MEMPOOL_STATE = 'mempool'
+SYNC_DONE_STATE = 'done'
+
+
+def validate_header(header: BlockHeader, engine: ConsensusEngine = None, check_seal: bool = True):
+    """
+    Makes sure that the block hash in the header matches the rest of the
+    header and, if check_seal is set, that the block was sealed correctly,
+    without the transactions of the block. Raises a ValueError if not.
+    """
+    block_hash = create_block_hash(header.transactions_hash,
+                                   header.prev_block_hash,
+                                   header.timestamp,
+                                   header.difficulty,
+                                   header.nonce)
+    if block_hash != header.block_hash:
+        raise ValueError(f"Invalid header: block-hash in header is {header.block_hash}"
+                         f" block hash calculated is {block_hash}.")
+    if not check_seal:
+        return
+    (engine if engine is not None else PROOF_OF_WORK).verify_seal(BlockSimple(header, []),
+                                                                  header.transactions_hash)
+
+
+class BlockDownloadScheduler:
+    """
+    Spreads the requests for block bodies over several peers at once. The
+    bodies are requested in chunks of chunk_size blocks, with at most
+    max_chunks_per_peer chunks requested from each peer and not yet
+    received. A chunk which is not received within timeout seconds, and the
+    blocks a peer leaves out of a chunk or sends invalid, are requested
+    again, from another peer if there is one. The blocks received are kept
+    in a reorder buffer, and returned in the order their hashes were added.
+
+    Parameters
+    ----------
+
+    peers: list
+        Ids of the peers to request bodies from, e.g. their addresses.
+
+    chunk_size: int
+        Maximum number of block bodies requested at a time.
+
+    max_chunks_per_peer: int
+        Maximum number of chunks requested from a peer and not yet received.
+
+    timeout: float
+        Number of seconds after which a chunk is requested again.
+    """
+    def __init__(self, peers: list, chunk_size: int = 64, max_chunks_per_peer: int = 4,
+                 timeout: float = 10.0):
+        self.peers = []
+        self.peer_chunks = {}
+        for peer in peers:
+            self.add_peer(peer)
+        self.chunk_size = chunk_size
+        self.max_chunks_per_peer = max_chunks_per_peer
+        self.timeout = timeout
+        # hashes of the blocks not returned yet, in order
+        self.pending = []
+        self.pending_set = set()
+        self.order = {}
+        self.next_order = 0
+        self.to_request = []
+        # chunk id -> (peer, hashes, time requested)
+        self.chunks = {}
+        self.next_chunk_id = 0
+        self.received = {}
+        # hash -> peers which did not send the block when asked
+        self.failed = defaultdict(set)
+        self.next_peer = 0
+
+    def __len__(self) -> int:
+        return len(self.pending)
+
+    def add_peer(self, peer):
+        """
+        Adds a peer to request bodies from.
+        """
+        if peer not in self.peer_chunks:
+            self.peers.append(peer)
+            self.peer_chunks[peer] = 0
+
+    def remove_peer(self, peer):
+        """
+        Stops requesting bodies from a peer, and requests the chunks it
+        was asked for again.
+        """
+        if peer not in self.peer_chunks:
+            return
+        for chunk_id in [chunk_id for chunk_id, chunk in self.chunks.items() if chunk[0] == peer]:
+            self._requeue(chunk_id)
+        self.peers.remove(peer)
+        del self.peer_chunks[peer]
+
+    def add_hashes(self, block_hashes: List[str]):
+        """
+        Adds the hashes of blocks to download, in the order the blocks are to be returned.
+        """
+        new_hashes = [bhash for bhash in block_hashes if bhash not in self.pending_set]
+        for bhash in new_hashes:
+            self.order[bhash] = self.next_order
+            self.next_order += 1
+        self.pending.extend(new_hashes)
+        self.pending_set.update(new_hashes)
+        self.to_request.extend(new_hashes)
+
+    def next_requests(self, now: float = None) -> List[Tuple[object, int, List[str]]]:
+        """
+        Requests again the chunks which timed out, and returns the chunks
+        to request now as (peer, chunk id, block hashes), going round the
+        peers which have room for more chunks.
+        """
+        now = time.monotonic() if now is None else now
+        for chunk_id in [chunk_id for chunk_id, chunk in self.chunks.items() if now - chunk[2] >= self.timeout]:
+            self._requeue(chunk_id)
+
+        requests = []
+        num_idle = 0
+        while len(self.to_request) > 0 and len(self.peers) > 0 and num_idle < len(self.peers):
+            peer = self.peers[self.next_peer % len(self.peers)]
+            self.next_peer += 1
+            chunk = self._take_chunk(peer) if self.peer_chunks[peer] < self.max_chunks_per_peer else []
+            if len(chunk) == 0:
+                num_idle += 1
+                continue
+            num_idle = 0
+            chunk_id = self.next_chunk_id
+            self.next_chunk_id += 1
+            self.chunks[chunk_id] = (peer, chunk, now)
+            self.peer_chunks[peer] += 1
+            requests.append((peer, chunk_id, chunk))
+        return requests
+
+    def blocks_received(self, chunk_id: int, blocks: List[BlockSimple]) -> List[BlockSimple]:
+        """
+        Takes the blocks sent for a chunk, and returns the blocks that can
+        now be returned in order, i.e. those whose earlier blocks have all
+        been received. Blocks which were not asked for or whose transactions
+        do not match their hash are ignored. Blocks sent after their chunk
+        timed out are still used.
+        """
+        for block in blocks:
+            bhash = block.hash()
+            if bhash not in self.pending_set or bhash in self.received:
+                continue
+            try:
+                validate_block_hash(block)
+            except ValueError:
+                continue
+            self.received[bhash] = block
+        if chunk_id in self.chunks:
+            self._requeue(chunk_id)
+
+        num_ready = 0
+        while num_ready < len(self.pending) and self.pending[num_ready] in self.received:
+            num_ready += 1
+        ready_hashes = self.pending[0:num_ready]
+        del self.pending[0:num_ready]
+        self.pending_set.difference_update(ready_hashes)
+        for bhash in ready_hashes:
+            self.failed.pop(bhash, None)
+            del self.order[bhash]
+        return [self.received.pop(bhash) for bhash in ready_hashes]
+
+    def _take_chunk(self, peer) -> List[str]:
+        """
+        Removes from to_request and returns up to chunk_size hashes to
+        request from the peer, skipping the blocks it failed to send unless
+        every peer failed to send them.
+        """
+        chunk = []
+        left = []
+        for i, bhash in enumerate(self.to_request):
+            if len(chunk) == self.chunk_size:
+                left.extend(self.to_request[i:])
+                break
+            if bhash not in self.pending_set or bhash in self.received:
+                continue
+            failed = self.failed.get(bhash)
+            if failed is not None and peer in failed:
+                if len(failed.intersection(self.peers)) < len(self.peers):
+                    left.append(bhash)
+                    continue
+                failed.clear()
+            chunk.append(bhash)
+        self.to_request = left
+        return chunk
+
+    def _requeue(self, chunk_id: int):
+        """
+        Removes a chunk which was received or timed out, and puts the blocks
+        of the chunk which were not received back in to_request, which is
+        kept in the order the hashes were added so the earliest blocks,
+        which hold up the others, are requested first.
+        """
+        peer, chunk, _ = self.chunks.pop(chunk_id)
+        self.peer_chunks[peer] -= 1
+        missing = [bhash for bhash in chunk if bhash in self.pending_set and bhash not in self.received]
+        for bhash in missing:
+            self.failed[bhash].add(peer)
+        if len(missing) > 0:
+            self.to_request = sorted([bhash for bhash in self.to_request if bhash in self.pending_set] + missing,
+                                     key=self.order.__getitem__)
+
+
+class HeaderSync:
+    """
+    State machine for syncing with a peer headers-first, instead of
+    receiving its whole chain and mempool in one message. The headers of
+    the sync peer's longest fork after the latest block in the block locator
+    are fetched in pages of header_page_size and checked to form a chain of
+    correctly sealed blocks. The seals of a trusted checkpoint block and of
+    the headers before it are not checked, as in AssumeValidIndex, so while
+    a checkpoint has not been received the seals of the headers are only
+    checked once all headers have arrived. As soon as the headers are
+    checked, the bodies of their blocks are downloaded from all the peers
+    by the BlockDownloadScheduler, checked to match the headers and returned
+    in chain order, so their seals need not be checked again when they are
+    added. Once all headers and bodies have arrived,
+    the sync peer's free transactions which are not in the summary from
+    get_trans_summary are fetched in chunks. So a node which was briefly
+    offline only fetches what it missed.
+
+    The owner sends the requests returned by next_requests and passes the
+    replies to headers_received, blocks_received and trans_received. A page
+    of headers or the free transactions not received within the timeout
+    of the downloader are requested again, from another of its peers if
+    there is one, which becomes the sync peer.
+
+    Parameters
+    ----------
+
+    sync_peer: object
+        Id of the peer to fetch the headers and free transactions from.
+
+    known_hashes: container of str
+        Hashes of the blocks that this node already has, e.g. its BlockMap.
+        Their bodies are not fetched.
+
+    locator: list of str
+        Block locator of this node, see BlockChain.get_block_locator.
+
+    get_trans_summary: func
+        Returns the summary of the transactions this node has, see
+        BlockChain.get_trans_summary. If None, all free transactions
+        are fetched.
+
+    engine: ConsensusEngine
+        The consensus engine to check the headers with, proof of work if None.
+
+    header_page_size: int
+        Number of headers requested at a time.
+
+    downloader: BlockDownloadScheduler
+        Scheduler for downloading the block bodies. If None, they are
+        downloaded from the sync peer only.
+
+    assume_valid_hashes: container of str
+        Hashes of the trusted checkpoint blocks, see AssumeValidIndex.
+
+    generation: int
+        Id of the sync, sent with the requests for block bodies and free
+        transactions so that the replies to the requests of an earlier sync,
+        e.g. with reused chunk ids, are ignored.
+    """
+    def __init__(self, sync_peer, known_hashes=(), locator: List[str] = None, get_trans_summary=None,
+                 engine: ConsensusEngine = None, header_page_size: int = 2000,
+                 downloader: BlockDownloadScheduler = None, assume_valid_hashes=(), generation: int = 0):
+        self.sync_peer = sync_peer
+        self.known_hashes = known_hashes
+        self.get_trans_summary = get_trans_summary
+        self.engine = engine
+        self.header_page_size = header_page_size
+        self.generation = generation
+        self.downloader = downloader if downloader is not None else BlockDownloadScheduler([sync_peer])
+        # the checkpoints not received yet, and the headers received whose
+        # seals are not checked yet, in order
+        self.checkpoints = set(bhash for bhash in assume_valid_hashes if bhash not in known_hashes)
+        self.unchecked_headers = []
+        self.state = SYNC_HEADERS_STATE
+        # the locator of the next page of headers, the hash of the last
+        # header received once there is one
+        self.locator = list(locator) if locator is not None else []
+        self.start_height = None
+        self.num_headers = 0
+        self.last_hash = None
+        self.headers_done = False
+        # times the current page of headers and the free transactions were
+        # requested, None if they are not waiting for a reply
+        self.header_request_time = None
+        self.mempool_request_time = None
+
+    def is_done(self) -> bool:
+        return self.state == SYNC_DONE_STATE
+
+    def next_requests(self, now: float = None) -> List[Tuple[object, bytes, object]]:
+        """
+        Returns the requests to send now, as tuples of the peer, the message
+        type and the object to pickle: the locator and count of a page of
+        headers for GET_HEADERS, the chunk id, block hashes and generation
+        for GET_BLOCK_BODIES, and the transaction summary, or None, and
+        generation for GET_MEMPOOL.
+        The requests which timed out are made again, see BlockDownloadScheduler.
+        """
+        now = time.monotonic() if now is None else now
+        request_time = self.header_request_time if self.state == SYNC_HEADERS_STATE else self.mempool_request_time
+        if request_time is not None and now - request_time >= self.downloader.timeout:
+            self._switch_sync_peer()
+            self.header_request_time = None
+            self.mempool_request_time = None
+
+        requests = []
+        if self.state == SYNC_HEADERS_STATE:
+            if not self.headers_done and self.header_request_time is None:
+                self.header_request_time = now
+                requests.append((self.sync_peer, GET_HEADERS, (self.locator, self.header_page_size)))
+            for peer, chunk_id, chunk in self.downloader.next_requests(now):
+                requests.append((peer, GET_BLOCK_BODIES, (chunk_id, chunk, self.generation)))
+        elif self.state == SYNC_MEMPOOL_STATE and self.mempool_request_time is None:
+            self.mempool_request_time = now
+            summary = self.get_trans_summary() if self.get_trans_summary is not None else None
+            requests.append((self.sync_peer, GET_MEMPOOL, (summary, self.generation)))
+        return requests
+
+    def _switch_sync_peer(self):
+        """
+        Makes the next peer of the downloader the sync peer, and stops
+        downloading bodies from the one which did not reply, if there is
+        another peer.
+        """
+        other_peers = [peer for peer in self.downloader.peers if peer != self.sync_peer]
+        if len(other_peers) == 0:
+            return
+        self.downloader.remove_peer(self.sync_peer)
+        self.sync_peer = other_peers[0]
+
+    def headers_received(self, headers: List[BlockHeader], start_height: int, locator: List[str] = None):
+        """
+        Checks a page of headers, which must continue the chain of the
+        headers received so far, or for the first page start from a block
+        this node has. Raises a ValueError if it does not, or if a header is
+        invalid. A page shorter than header_page_size is the last one.
+
+        Parameters
+        ----------
+
+        headers: list of BlockHeader
+            The page of headers, in chain order.
+
+        start_height: int
+            The height of the first header in the peer's longest fork.
+
+        locator: list of str
+            The locator the page was requested with. If given and it is not
+            the one of the current request, e.g. for the reply to a request
+            of an earlier sync, the page is ignored.
+        """
+        if locator is not None and locator != self.locator:
+            return
+        if self.last_hash is None:
+            self.start_height = start_height
+            if len(headers) > 0:
+                prev_hash = headers[0].prev_block_hash
+                if prev_hash != NULL_BLOCK_HASH and prev_hash not in self.known_hashes:
+                    raise ValueError(f"Invalid header: block {headers[0].block_hash} follows unknown "
+                                     f"block {prev_hash}.")
+            else:
+                prev_hash = None
+        else:
+            prev_hash = self.last_hash
+        for header in headers:
+            if header.prev_block_hash != prev_hash:
+                raise ValueError(f"Invalid header: block {header.block_hash} does not follow {prev_hash}.")
+            validate_header(header, self.engine, check_seal=False)
+            prev_hash = header.block_hash
+        self.last_hash = prev_hash
+        if prev_hash is not None:
+            self.locator = [prev_hash]
+        self.num_headers += len(headers)
+        self.header_request_time = None
+        self.headers_done = len(headers) < self.header_page_size
+        self.unchecked_headers.extend(headers)
+        self._check_seals()
+        self._update_state()
+
+    def _check_seals(self):
+        """
+        Passes the headers received whose seals are checked, or need not be,
+        to the downloader: the last checkpoint received and the headers
+        before it, which are all its ancestors as the headers form a chain,
+        and, once there are no checkpoints left to receive, the headers after
+        it, whose seals are checked. Raises a ValueError if a seal is invalid.
+        """
+        num_assumed_valid = 0
+        for i, header in enumerate(self.unchecked_headers):
+            if header.block_hash in self.checkpoints:
+                self.checkpoints.remove(header.block_hash)
+                num_assumed_valid = i + 1
+        checked = self.unchecked_headers[0:num_assumed_valid]
+        del self.unchecked_headers[0:num_assumed_valid]
+        if self.headers_done or len(self.checkpoints) == 0:
+            for header in self.unchecked_headers:
+                validate_header(header, self.engine)
+            checked.extend(self.unchecked_headers)
+            self.unchecked_headers = []
+        self.downloader.add_hashes([header.block_hash for header in checked
+                                    if header.block_hash not in self.known_hashes])
+
+    def blocks_received(self, chunk_id: int, blocks: List[BlockSimple], generation: int = None) -> List[BlockSimple]:
+        """
+        Takes the block bodies sent for a chunk, and returns the blocks that
+        can now be added in chain order, see BlockDownloadScheduler.blocks_received.
+        Their headers were checked, so they can be added without checking
+        their hashes and seals again, see BlockChain.add_incoming_blocks.
+        If the generation is given and is not the one of this sync, the
+        blocks are ignored.
+        """
+        if generation is not None and generation != self.generation:
+            return []
+        ready_blocks = self.downloader.blocks_received(chunk_id, blocks)
+        self._update_state()
+        return ready_blocks
+
+    def trans_received(self, trans_list: List[Transaction], is_last: bool, generation: int = None,
+                       peer=None) -> List[Transaction]:
+        """
+        Takes a chunk of the peer's free transactions and returns it. The
+        sync is done after the last chunk. Chunks received when not fetching
+        the free transactions, or whose generation or sending peer, if given,
+        are not those of this sync and its sync peer, are ignored: e.g. late
+        replies to an earlier sync or to a sync peer which timed out.
+        """
+        if self.state != SYNC_MEMPOOL_STATE or \
+           (generation is not None and generation != self.generation) or \
+           (peer is not None and peer != self.sync_peer):
+            return []
+        if is_last:
+            self.state = SYNC_DONE_STATE
+        return trans_list
+
+    def _update_state(self):
+        """
+        Moves on to fetching the mempool once all headers and bodies arrived.
+        """
+        if self.state == SYNC_HEADERS_STATE and self.headers_done and len(self.downloader) == 0:
+            self.state = SYNC_MEMPOOL_STATE
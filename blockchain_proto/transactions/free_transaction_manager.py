@@ -10,10 +10,9 @@ in a blockchain.
 """
 from typing import List, Tuple
 from collections import defaultdict
-import numpy as np
-from collections import defaultdict
 from blockchain_proto.transactions.transaction import Transaction
-from blockchain_proto.forks.fork_manager import ForkManager
+from blockchain_proto.transactions.interval_set import IntervalSet
+from blockchain_proto.transactions.mempool_wal import MempoolWAL
 from blockchain_proto.consts import TRANS_NOT_YET_ADDED
 from blockchain_proto.exceptions import TransWasAlreadyAddedError
 
@@ -22,19 +21,90 @@ class FreeTransactionManager:
     Maintains the transactions at this node that has not
     yet been added to any block in any fork - i.e. transactions
     that are free.
+
+    For each user the trans_no's of the free (pending) transactions
+    and of the transactions already confirmed in a block are kept as
+    IntervalSets, so duplicate checks are O(log intervals) and take
+    constant memory when the numbering is dense and in order.
+
+    Parameters
+    ----------
+
+    wal: MempoolWAL
+        Optional write-ahead log to which admitted and removed transactions
+        are logged. If given, the free transactions in the log are replayed
+        into this manager when it is created.
     """
-    def __init__(self):
-        self.user_curr_trans = defaultdict(lambda : [])
-        self.user_curr_trans_no = defaultdict(lambda : [])
-        self.user_max_trans = defaultdict(lambda : -1)
+    def __init__(self, wal: MempoolWAL = None):
+        self.user_curr_trans = defaultdict(lambda : {})
+        self.user_pending = defaultdict(IntervalSet)
+        self.user_confirmed = defaultdict(IntervalSet)
         self.size = 0
+        self.wal = wal
+        if self.wal is not None:
+            for trans in self.wal.replay():
+                if not self.trans_was_added(trans):
+                    self._add_pending(trans)
 
     def trans_was_added(self, trans:Transaction) -> bool:
         return  \
-            (trans.user_id in self.user_max_trans and
-             trans.trans_no <= self.user_max_trans[trans.user_id]) or \
-            (trans.user_id in self.user_curr_trans_no and
-             trans.trans_no in self.user_curr_trans_no[trans.user_id])
+            (trans.user_id in self.user_confirmed and
+             trans.trans_no in self.user_confirmed[trans.user_id]) or \
+            (trans.user_id in self.user_pending and
+             trans.trans_no in self.user_pending[trans.user_id])
+
+    def trans_was_confirmed(self, user_id: str, trans_no: int) -> bool:
+        """
+        Returns True if the transaction with the given user_id and trans_no
+        has been recorded as being in a block.
+        """
+        return user_id in self.user_confirmed and trans_no in self.user_confirmed[user_id]
+
+    def get_missing_trans_ids(self, trans_ids: List[Tuple[str, int]]) -> List[Tuple[str, int]]:
+        """
+        Returns the (user_id, trans_no)'s in the given list of transactions
+        which are neither free nor confirmed, i.e. which this node lacks.
+        """
+        return [(user_id, trans_no) for user_id, trans_no in trans_ids
+                if not (user_id in self.user_pending and trans_no in self.user_pending[user_id]) and
+                not self.trans_was_confirmed(user_id, trans_no)]
+
+    def get_transactions(self, trans_ids: List[Tuple[str, int]]) -> List[Transaction]:
+        """
+        Returns the free transactions with the given (user_id, trans_no)'s.
+        Transactions which are not free are left out.
+        """
+        return [self.user_curr_trans[user_id][trans_no] for user_id, trans_no in trans_ids
+                if user_id in self.user_pending and trans_no in self.user_pending[user_id]]
+
+    def get_trans_summary(self) -> dict:
+        """
+        Returns a compact summary of the transactions this manager has seen,
+        free or confirmed, as the (start, end) intervals of the trans_no's of
+        each user. A peer can use it to send only the transactions missing.
+        """
+        summary = {}
+        for user_id in set(self.user_pending) | set(self.user_confirmed):
+            trans_nos = IntervalSet()
+            for user_trans_nos in (self.user_pending, self.user_confirmed):
+                if user_id in user_trans_nos:
+                    for start, end in user_trans_nos[user_id].intervals():
+                        trans_nos.add_range(start, end)
+            summary[user_id] = trans_nos.intervals()
+        return summary
+
+    def get_trans_not_in(self, summary: dict) -> List[Transaction]:
+        """
+        Returns the free transactions which are not in a summary returned
+        by get_trans_summary, e.g. by a peer.
+        """
+        trans_list = []
+        for user_id, user_trans in self.user_curr_trans.items():
+            seen = IntervalSet()
+            for start, end in summary.get(user_id, []):
+                seen.add_range(start, end)
+            trans_list.extend(trans for trans_no, trans in user_trans.items() if trans_no not in seen)
+        return trans_list
 
     def num_free(self) -> int:
         """
@@ -62,9 +132,59 @@ class FreeTransactionManager:
         if self.trans_was_added(trans):
             raise TransWasAlreadyAddedError(trans.user_id, trans.trans_no)
 
-        self.user_curr_trans[trans.user_id].append(trans)
-        self.user_curr_trans_no[trans.user_id].append(trans.trans_no)
+        self._add_pending(trans)
+        if self.wal is not None:
+            self.wal.log_add([trans])
+        return True
+
+    def add_transactions(self, trans_list: List[Transaction]) -> List[Transaction]:
+        """
+        Adds a list of transactions to the transactions not yet added.
+
+        Parameters
+        ----------
+        trans_list: list of Transaction
+            The transactions to add.
+
+        Returns
+        -------
+
+        list of Transaction:
+            The transactions that were not added because they were added before.
+        """
+        already_added = []
+        added = []
+        for trans in trans_list:
+            if self.trans_was_added(trans):
+                already_added.append(trans)
+            else:
+                self._add_pending(trans)
+                added.append(trans)
+        if self.wal is not None:
+            self.wal.log_add(added)
+        return already_added
+
+    def _add_pending(self, trans: Transaction):
+        """
+        Records the transaction as free without any checks.
+        """
+        self.user_curr_trans[trans.user_id][trans.trans_no] = trans
+        self.user_pending[trans.user_id].add(trans.trans_no)
         self.size += 1
+
+    def _remove_pending(self, user_id: str, trans_no: int) -> bool:
+        """
+        Removes the free transaction with the given user_id and trans_no.
+        Returns False if there was no such transaction.
+        """
+        if user_id not in self.user_pending or \
+           not self.user_pending[user_id].discard(trans_no):
+            return False
+        del self.user_curr_trans[user_id][trans_no]
+        self.size -= 1
+        if len(self.user_pending[user_id]) == 0:
+            del self.user_pending[user_id]
+            del self.user_curr_trans[user_id]
         return True
 
     def __len__(self) -> int:
@@ -92,26 +212,36 @@ class FreeTransactionManager:
             violating the constraint that for each user all the transactions
             be in sequence within the fork.
         """
+        # user not in fork gives -1, so the sequence must start at 0.
+        return self.get_ready_runs(
+            {user_id: get_latest_trans(user_id) + 1 for user_id in self.user_pending})
+
+    def get_ready_runs(self, next_trans_nos: dict) -> List[Transaction]:
+        """
+        For each user in next_trans_nos returns the run of free transactions
+        numbered next_trans_no, next_trans_no + 1, ... up to the first missing
+        trans_no.
+
+        Parameters
+        ----------
+
+        next_trans_nos: dict
+            Maps user_ids to the trans_no the run of the user must start at.
+
+        Return
+        ------
+        list of Transaction:
+            The runs of the users one after the other.
+        """
         ret_trans = []
-        for user_id in self.user_curr_trans:
-            all_trans = sorted(self.user_curr_trans[user_id])
-            all_trans_no = np.array([trans.trans_no for trans in all_trans])
-            # user not in fork the transaction is to be added to.
-            latest_trans_no = get_latest_trans(user_id)
-            if latest_trans_no == -1:
-                if all_trans[0].trans_no != 0:
-                    continue
-                first_trans_no = 0
-            else:
-                first_trans_no = np.where(all_trans_no == latest_trans_no + 1)[0]
-                if len(first_trans_no) == 0:
-                    continue
-                first_trans_no = first_trans_no[0]
-            latest_trans_no = np.where( (all_trans_no[1:] - all_trans_no[0:-1]) > 1)[0]
-            if len(latest_trans_no) == 0:
-                ret_trans.extend(all_trans[first_trans_no:])
-            else:
-                ret_trans.extend(all_trans[first_trans_no:latest_trans_no[0]+1])
+        for user_id, first_trans_no in next_trans_nos.items():
+            if user_id not in self.user_pending:
+                continue
+            interval = self.user_pending[user_id].interval_containing(first_trans_no)
+            if interval is None:
+                continue
+            user_trans = self.user_curr_trans[user_id]
+            ret_trans.extend(user_trans[trans_no] for trans_no in range(first_trans_no, interval[1] + 1))
 
         return ret_trans
 
@@ -136,12 +266,15 @@ class FreeTransactionManager:
         """
         first_trans, remove_failures = self._remove_trans_in_list(sorted_trans_list)
         self._remove_older_transactions(first_trans)
+        if self.wal is not None and self.wal.needs_compaction():
+            self.wal.compact(self.get_trans_list())
         return remove_failures
 
     def _remove_trans_in_list(self, sorted_trans_list: List[Transaction]) -> Tuple[dict, list]:
         """
         For each user removes all the transactions that are in the
-        given list from the dictionary of user transactions.
+        given list from the dictionary of user transactions, and records
+        them as confirmed.
 
         Parameters
         ----------
@@ -159,28 +292,28 @@ class FreeTransactionManager:
             user, and removals which failed.
         """
         first_trans = {}
-        user_trans_no_dict = defaultdict(lambda : [])
         remove_failures = []
+        removed = []
         # remove transactions in the list
         for trans in sorted_trans_list:
-            try:
-                if trans.user_id not in first_trans:
-                    first_trans[trans.user_id] = trans.trans_no
-                self.user_curr_trans[trans.user_id].remove(trans)
-                self.user_curr_trans_no[trans.user_id].remove(trans.trans_no)
-                self.size -= 1
-                user_trans_no_dict[trans.user_id].append(trans.trans_no)
-            except Exception as e:
+            if trans.user_id not in first_trans:
+                first_trans[trans.user_id] = trans.trans_no
+            self.user_confirmed[trans.user_id].add(trans.trans_no)
+            if self._remove_pending(trans.user_id, trans.trans_no):
+                removed.append((trans.user_id, trans.trans_no))
+            else:
                 remove_failures.append(trans)
+        if self.wal is not None:
+            self.wal.log_remove(removed)
 
-        for user_id in user_trans_no_dict:
-            self.user_max_trans[user_id] = min(user_trans_no_dict[user_id])
         return first_trans, remove_failures
     
-    def _remove_older_transactions(self, trans_dict: dict) -> dict:
+    def _remove_older_transactions(self, trans_dict: dict):
         """
         For each user in trans_dict, removes all the transactions
-        that are older than the transaction in trans_dict. 
+        that are older than the transaction in trans_dict. Since
+        transactions are numbered contiguously in a fork these
+        are recorded as confirmed too.
 
         Parameters
         ----------
@@ -188,33 +321,78 @@ class FreeTransactionManager:
         trans_dict: dict
             Maps user_id's to transaction numbers        
         """
-        # remove all older transactions
+        removed_ids = []
         for user_id in trans_dict:
-            old_len = len(self.user_curr_trans[user_id])
-            self.user_curr_trans[user_id] = list(
-                filter(lambda t: t.trans_no <= trans_dict[user_id],
-                       self.user_curr_trans[user_id])
-            )
-            self.user_curr_trans_no[user_id] = list(
-                filter(lambda t: t <= trans_dict[user_id], 
-                       self.user_curr_trans_no[user_id])
-            )
-            self.size -= old_len - len(self.user_curr_trans[user_id])
-
-    def update_trans_in_inc_block(self, trans_list: List[Transaction]):
+            if user_id not in self.user_pending:
+                continue
+            removed = self.user_pending[user_id].discard_below(trans_dict[user_id])
+            user_trans = self.user_curr_trans[user_id]
+            for start, end in removed:
+                self.user_confirmed[user_id].add_range(start, end)
+                for trans_no in range(start, end + 1):
+                    del user_trans[trans_no]
+                    self.size -= 1
+                    removed_ids.append((user_id, trans_no))
+            if len(self.user_pending[user_id]) == 0:
+                del self.user_pending[user_id]
+                del self.user_curr_trans[user_id]
+        if self.wal is not None:
+            self.wal.log_remove(removed_ids)
+
+    def release_transactions(self, trans_list: List[Transaction], get_latest_trans) -> int:
         """
-        Updates the internal data structure to account for the transactions in
-        trans_list.
+        Moves transactions from blocks that were dropped (e.g. after a reorg) back
+        into the free transactions. Transactions which are still in the longest
+        fork (i.e. their trans_no is at most the latest trans_no for the user
+        there) stay confirmed, and ones which are already free are ignored.
 
-        Paramters
-        ---------
+        Parameters
+        ----------
 
         trans_list: list of Transaction
-            transaction list to update the internal data structures with.
+            The transactions in the dropped blocks.
+
+        get_latest_trans: func
+            Function that gets the latest trans_no for a user in the longest fork.
+
+        Returns
+        -------
+
+        int:
+            The number of transactions that were made free again.
         """
+        released = []
+        latest_trans = {}
         for trans in trans_list:
-            if trans.trans_no > self.user_max_trans[trans.user_id]:
-                self.user_max_trans[trans.user_id] = trans.trans_no
+            if trans.user_id not in latest_trans:
+                latest_trans[trans.user_id] = get_latest_trans(trans.user_id)
+            if trans.trans_no <= latest_trans[trans.user_id]:
+                continue
+            if trans.user_id in self.user_confirmed:
+                self.user_confirmed[trans.user_id].discard(trans.trans_no)
+            if trans.user_id in self.user_pending and \
+               trans.trans_no in self.user_pending[trans.user_id]:
+                continue
+            self._add_pending(trans)
+            released.append(trans)
+        if self.wal is not None:
+            self.wal.log_add(released)
+        return len(released)
+
+    def flush_wal(self):
+        """
+        Writes out any transactions waiting in the write-ahead log buffer
+        for longer than its flush interval.
+        """
+        if self.wal is not None:
+            self.wal.flush_if_due()
+
+    def close(self):
+        """
+        Writes out and closes the write-ahead log if there is one.
+        """
+        if self.wal is not None:
+            self.wal.close()
 
     def get_trans_list(self) -> List[Transaction]:
         """
@@ -225,7 +403,7 @@ class FreeTransactionManager:
         list of trans:
             Returns the list of the transactions
         """
-        return [trans for user_id in self.user_curr_trans for trans in self.user_curr_trans[user_id]]
+        return [trans for user_id in self.user_curr_trans for trans in self.user_curr_trans[user_id].values()]
 
     def to_json(self) -> dict:
         """
@@ -238,7 +416,7 @@ class FreeTransactionManager:
         """
         return {TRANS_NOT_YET_ADDED:
                     {
-                        user_id:  [trans.to_json() for trans in self.user_curr_trans[user_id]]
+                        user_id:  [trans.to_json() for trans in self.user_curr_trans[user_id].values()]
                         for user_id in self.user_curr_trans
                      }
                 }
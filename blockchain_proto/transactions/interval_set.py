@@ -0,0 +1,178 @@
+"""
+Copyright 2022 M. M. Hassan Mahmud
+
+This Source Code Form is subject to the terms of the Mozilla Public
+License, v. 2.0. If a copy of the MPL was not distributed with this
+file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+
+Class for compactly storing sets of integers (e.g. transaction numbers)
+as sorted lists of disjoint intervals.
+"""
+from bisect import bisect_right
+from typing import Iterator, List, Tuple
+
+
+class IntervalSet:
+    """
+    A set of integers stored as sorted, disjoint and non-adjacent
+    closed intervals [start, end]. Since transaction numbers for a user
+    are mostly dense and in order, the set for a user is usually a single
+    interval regardless of how many numbers it holds.
+
+    Membership checks and finding the interval containing a number
+    are O(log k) where k is the number of intervals.
+    """
+    def __init__(self):
+        self.starts = []
+        self.ends = []
+        self.size = 0
+
+    def _find(self, n: int) -> int:
+        """
+        Returns the index of the interval with the largest start
+        which is <= n, or -1 if no such interval exists.
+        """
+        return bisect_right(self.starts, n) - 1
+
+    def __contains__(self, n: int) -> bool:
+        i = self._find(n)
+        return i >= 0 and n <= self.ends[i]
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __iter__(self) -> Iterator[int]:
+        for start, end in zip(self.starts, self.ends):
+            yield from range(start, end + 1)
+
+    def num_intervals(self) -> int:
+        """
+        Returns the number of disjoint intervals in the set.
+        """
+        return len(self.starts)
+
+    def intervals(self) -> List[Tuple[int, int]]:
+        """
+        Returns the intervals in the set as a list of (start, end) tuples.
+        """
+        return list(zip(self.starts, self.ends))
+
+    def interval_containing(self, n: int) -> Tuple[int, int]:
+        """
+        Returns the interval (start, end) containing n, or None if n
+        is not in the set.
+        """
+        i = self._find(n)
+        if i >= 0 and n <= self.ends[i]:
+            return self.starts[i], self.ends[i]
+        return None
+
+    def min(self) -> int:
+        """
+        Returns the smallest number in the set, or None if it is empty.
+        """
+        return self.starts[0] if self.starts else None
+
+    def max(self) -> int:
+        """
+        Returns the largest number in the set, or None if it is empty.
+        """
+        return self.ends[-1] if self.ends else None
+
+    def add(self, n: int):
+        """
+        Adds the number n to the set.
+        """
+        self.add_range(n, n)
+
+    def add_range(self, start: int, end: int):
+        """
+        Adds all the numbers in the closed interval [start, end] to the set,
+        merging it with any overlapping or adjacent intervals.
+
+        Parameters
+        ----------
+
+        start: int
+            The first number to add.
+
+        end: int
+            The last number to add.
+        """
+        if end < start:
+            return
+        # first interval that could merge: the one with the largest
+        # start <= start - 1 (it may end at or after start - 1)
+        lo = bisect_right(self.starts, start - 1) - 1
+        if lo < 0 or self.ends[lo] < start - 1:
+            lo += 1
+        # last interval that could merge: the one with the largest
+        # start <= end + 1
+        hi = bisect_right(self.starts, end + 1) - 1
+        if lo <= hi:
+            removed = sum(self.ends[i] - self.starts[i] + 1 for i in range(lo, hi + 1))
+            new_start = min(start, self.starts[lo])
+            new_end = max(end, self.ends[hi])
+            del self.starts[lo:hi + 1]
+            del self.ends[lo:hi + 1]
+        else:
+            removed = 0
+            new_start, new_end = start, end
+        self.starts.insert(lo, new_start)
+        self.ends.insert(lo, new_end)
+        self.size += new_end - new_start + 1 - removed
+
+    def discard(self, n: int) -> bool:
+        """
+        Removes the number n from the set if it is present.
+
+        Returns
+        -------
+
+        bool:
+            True if n was in the set, False otherwise.
+        """
+        i = self._find(n)
+        if i < 0 or n > self.ends[i]:
+            return False
+        start, end = self.starts[i], self.ends[i]
+        if start == end:
+            del self.starts[i]
+            del self.ends[i]
+        elif n == start:
+            self.starts[i] = n + 1
+        elif n == end:
+            self.ends[i] = n - 1
+        else:
+            self.ends[i] = n - 1
+            self.starts.insert(i + 1, n + 1)
+            self.ends.insert(i + 1, end)
+        self.size -= 1
+        return True
+
+    def discard_below(self, n: int) -> List[Tuple[int, int]]:
+        """
+        Removes all the numbers strictly smaller than n from the set.
+
+        Returns
+        -------
+
+        list of (int, int):
+            The intervals that were removed.
+        """
+        i = self._find(n - 1)
+        if i < 0:
+            return []
+        removed = list(zip(self.starts[0:i], self.ends[0:i]))
+        if self.ends[i] >= n:
+            removed.append((self.starts[i], n - 1))
+            self.starts[i] = n
+            del self.starts[0:i]
+            del self.ends[0:i]
+        else:
+            removed.append((self.starts[i], self.ends[i]))
+            del self.starts[0:i + 1]
+            del self.ends[0:i + 1]
+        self.size -= sum(end - start + 1 for start, end in removed)
+        return removed
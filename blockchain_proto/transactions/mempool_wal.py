@@ -0,0 +1,209 @@
+"""
+Copyright 2022 M. M. Hassan Mahmud
+
+This Source Code Form is subject to the terms of the Mozilla Public
+License, v. 2.0. If a copy of the MPL was not distributed with this
+file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+Write-ahead log for persisting the 'free' transactions of a node
+across restarts.
+"""
+from typing import List, Tuple
+import os
+import pickle
+import struct
+import time
+import logging
+
+from blockchain_proto.transactions.transaction import Transaction
+from blockchain_proto.log_messages import log_info, log_warning
+
+# record types in the log
+WAL_ADD = 'A'
+WAL_REMOVE = 'R'
+
+# each record is a pickle prefixed with its length
+RECORD_LEN = struct.Struct('>I')
+
+
+class MempoolWAL:
+    """
+    Append-only log of the transactions admitted to and removed from a
+    FreeTransactionManager. Records are buffered and written out and
+    synced to disk in groups (group commit), either when batch_size
+    records are waiting or when the oldest waiting record is older than
+    flush_interval seconds. The log is rewritten with only the live
+    transactions once it holds compact_factor times more records than
+    there are live transactions.
+
+    Parameters
+    ----------
+
+    path: str
+        Path of the log file.
+
+    batch_size: int
+        Number of buffered records that triggers a write to disk.
+
+    flush_interval: float
+        Maximum number of seconds a record stays in the buffer.
+
+    compact_factor: int
+        Ratio of records to live transactions that triggers a compaction.
+
+    min_compact_records: int
+        The log is never compacted while it has fewer records than this.
+    """
+    def __init__(self,
+                 path: str,
+                 batch_size: int = 256,
+                 flush_interval: float = 0.05,
+                 compact_factor: int = 4,
+                 min_compact_records: int = 1024):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.compact_factor = compact_factor
+        self.min_compact_records = min_compact_records
+        self.buffer = []
+        self.first_buffered_time = None
+        self.num_records = 0
+        self.num_live = 0
+        self.file = None
+
+    def replay(self) -> List[Transaction]:
+        """
+        Reads the log in a single pass and returns the transactions that
+        were admitted and not removed afterwards, in the order they were
+        admitted. A partially written record at the end of the log (e.g.
+        because of a crash) is dropped. Opens the log for appending.
+
+        Returns
+        -------
+
+        list of Transaction:
+            The live transactions in the log.
+        """
+        live_trans = {}
+        self.num_records = 0
+        good_offset = 0
+        if os.path.exists(self.path):
+            with open(self.path, 'rb') as f:
+                data = f.read()
+            while good_offset + RECORD_LEN.size <= len(data):
+                rec_len, = RECORD_LEN.unpack_from(data, good_offset)
+                rec_end = good_offset + RECORD_LEN.size + rec_len
+                if rec_end > len(data):
+                    break
+                record = pickle.loads(data[good_offset + RECORD_LEN.size:rec_end])
+                if record[0] == WAL_ADD:
+                    for trans in record[1]:
+                        live_trans[(trans.user_id, trans.trans_no)] = trans
+                else:
+                    for trans_id in record[1]:
+                        live_trans.pop(trans_id, None)
+                self.num_records += 1
+                good_offset = rec_end
+            if good_offset < len(data):
+                log_warning(logging, f"Dropping {len(data) - good_offset} bytes of partial record at end "
+                                     f"of mempool log {self.path}.")
+
+        self.file = open(self.path, 'ab')
+        self.file.truncate(good_offset)
+        self.num_live = len(live_trans)
+        log_info(logging, f"Replayed {self.num_live} transactions from mempool log {self.path}.")
+        return list(live_trans.values())
+
+    def log_add(self, trans_list: List[Transaction]):
+        """
+        Logs that the given transactions were admitted.
+        """
+        if len(trans_list) > 0:
+            self.num_live += len(trans_list)
+            self._append((WAL_ADD, list(trans_list)))
+
+    def log_remove(self, trans_ids: List[Tuple[str, int]]):
+        """
+        Logs that the transactions with the given (user_id, trans_no)'s were removed.
+        """
+        if len(trans_ids) > 0:
+            self.num_live -= len(trans_ids)
+            self._append((WAL_REMOVE, list(trans_ids)))
+
+    def _append(self, record: tuple):
+        """
+        Buffers the record, and writes out the buffer if it is full or
+        its oldest record has waited for long enough.
+        """
+        data = pickle.dumps(record)
+        self.buffer.append(RECORD_LEN.pack(len(data)) + data)
+        self.num_records += 1
+        if self.first_buffered_time is None:
+            self.first_buffered_time = time.monotonic()
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+        else:
+            self.flush_if_due()
+
+    def flush_if_due(self):
+        """
+        Writes out the buffer if its oldest record has waited for
+        more than flush_interval seconds.
+        """
+        if self.first_buffered_time is not None and \
+           time.monotonic() - self.first_buffered_time >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes out all the buffered records and syncs them to disk.
+        """
+        if len(self.buffer) == 0:
+            return
+        self.file.write(b''.join(self.buffer))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.buffer = []
+        self.first_buffered_time = None
+
+    def needs_compaction(self) -> bool:
+        """
+        Returns True if the log has grown enough relative to the number
+        of live transactions to be compacted.
+        """
+        return self.num_records >= self.min_compact_records and \
+            self.num_records > self.compact_factor * max(self.num_live, 1)
+
+    def compact(self, live_trans: List[Transaction]):
+        """
+        Rewrites the log so that it only contains the given live transactions.
+        The new log is written to a temporary file which then replaces the log.
+
+        Parameters
+        ----------
+
+        live_trans: list of Transaction
+            The transactions that are currently free.
+        """
+        self.flush()
+        self.file.close()
+        tmp_path = self.path + '.compact'
+        with open(tmp_path, 'wb') as f:
+            data = pickle.dumps((WAL_ADD, list(live_trans)))
+            f.write(RECORD_LEN.pack(len(data)) + data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self.file = open(self.path, 'ab')
+        self.num_records = 1
+        self.num_live = len(live_trans)
+        log_info(logging, f"Compacted mempool log {self.path} to {self.num_live} transactions.")
+
+    def close(self):
+        """
+        Writes out the buffered records and closes the log.
+        """
+        if self.file is not None:
+            self.flush()
+            self.file.close()
+            self.file = None
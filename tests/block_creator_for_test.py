@@ -11,6 +11,7 @@ Utility functions for creating blocks for tests.
 import numpy as np
 from blockchain_proto.transactions.transaction import Transaction
 from blockchain_proto.blockchain.block_helper import create_block
+from blockchain_proto.blockchain.consensus import InstantSealEngine
 
 
 def create_transactions(base_trans):
@@ -60,3 +61,11 @@ def create_transactions_2(user_nums, base_trans, trans_per_user):
             tr_list.append(tr)
 
     return tr_list
+
+
+def create_block_instant(transactions, prev_block_hash, difficulty=1):
+    """
+    Creates a block sealed by the development InstantSealEngine, so no
+    puzzle is solved.
+    """
+    return create_block(transactions, prev_block_hash, difficulty, engine=InstantSealEngine())
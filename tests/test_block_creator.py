@@ -12,7 +12,10 @@ from blockchain_proto.blockchain.block_helper import create_block, validate_bloc
     create_block_hash
 from blockchain_proto.transactions.transaction import Transaction
 from blockchain_proto.blockchain.puzzle import sha_256_hash_string, check_solution
-from tests.block_creator_for_test import  create_transactions
+from blockchain_proto.blockchain.blockchain_ds import BlockChain
+from blockchain_proto.blockchain.consensus import ConsensusEngine, InstantSealEngine, ProofOfWorkEngine, \
+    INSTANT_SEAL_NONCE
+from tests.block_creator_for_test import  create_transactions, create_transactions_2, create_block_instant
 
 
 def test_block_creation():
@@ -47,8 +50,49 @@ def test_block_creation():
     assert validate_block_hashes(block)
 
 
+def test_instant_seal_block_creation():
+    # a difficulty far too high to solve in a test
+    block = create_block_instant(create_transactions([23, 1]), 'test_hash', difficulty=16)
+    assert block.block_header.nonce == INSTANT_SEAL_NONCE
+    assert validate_block_hashes(block, InstantSealEngine())
+
+    # nodes using proof of work reject instantly sealed blocks
+    for engine in [None, ProofOfWorkEngine()]:
+        try:
+            validate_block_hashes(block, engine)
+            assert False
+        except ValueError:
+            pass
+
+    # but development nodes accept blocks with solved puzzles
+    block = create_block(create_transactions([23, 1]), 'test_hash', 1)
+    assert validate_block_hashes(block, InstantSealEngine())
+
+    blockchain = BlockChain(trans_per_block=5, difficulty=16, consensus=InstantSealEngine())
+    for t in create_transactions_2([1, 2], [0, 0], [10, 10]):
+        blockchain.add_transaction(t)
+    blocks = blockchain.get_block_list()
+    assert len(blocks) == 4
+    assert all(block.block_header.nonce == INSTANT_SEAL_NONCE for block in blocks)
+
+    other = BlockChain(trans_per_block=5, difficulty=16, consensus=InstantSealEngine())
+    assert other.add_incoming_blocks(blocks) == blocks
+    production = BlockChain(trans_per_block=5, difficulty=16)
+    assert production.add_incoming_blocks(blocks) == []
+
+    # an engine which does not verify seals cannot be created
+    class SealOnlyEngine(ConsensusEngine):
+        def seal(self, trans_hash, prev_block_hash, timestamp, difficulty):
+            return "0"
+    try:
+        SealOnlyEngine()
+        assert False
+    except TypeError:
+        pass
+
 
 if __name__ == '__main__':
     test_block_creation()
+    test_instant_seal_block_creation()
 
 
@@ -0,0 +1,92 @@
+"""
+Copyright 2022 M. M. Hassan Mahmud
+
+This Source Code Form is subject to the terms of the Mozilla Public
+License, v. 2.0. If a copy of the MPL was not distributed with this
+file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+
+Tests for the time triggered block production.
+"""
+import time
+
+from blockchain_proto.blockchain.block_production import LatencyHistogram, BlockProductionScheduler
+from blockchain_proto.blockchain.blockchain_ds import BlockChain
+from blockchain_proto.blockchain.block_size import AdaptiveBlockSize
+from blockchain_proto.blockchain.block_helper import create_block
+from blockchain_proto.consts import LATENCY_COUNTS, LATENCY_TOTAL
+from block_creator_for_test import create_transactions_2
+
+
+def test_latency_histogram():
+    histogram = LatencyHistogram([1.0, 2.0])
+    for latency in [0.5, 1.0, 1.5, 3.0, 4.0]:
+        histogram.record(latency)
+    assert histogram.counts == [2, 1, 2]
+    assert histogram.total == 5
+    assert histogram.max_latency == 4.0
+
+
+def test_block_production_scheduler():
+    scheduler = BlockProductionScheduler(max_wait=2.0)
+    trans_list = create_transactions_2([1], [0], [3])
+    scheduler.trans_admitted(trans_list[0:2], 10.0)
+    scheduler.trans_admitted(trans_list[2:3], 11.0)
+    assert not scheduler.is_due([], 20.0)
+    assert not scheduler.is_due(trans_list, 11.5)
+    assert scheduler.is_due(trans_list, 12.0)
+    assert not scheduler.is_due(trans_list[2:3], 12.0)
+
+    scheduler.trans_confirmed(trans_list, 12.0)
+    assert scheduler.histogram.total == 3
+    assert len(scheduler.admit_times) == 0
+    assert not BlockProductionScheduler().is_due(trans_list, 1000.0)
+
+
+def test_blockchain_tick():
+    blockchain = BlockChain(trans_per_block=5, difficulty=1, max_block_wait=1.0)
+    blocks, _ = blockchain.add_transactions(create_transactions_2([1], [0], [7]))
+    assert len(blocks) == 1
+    assert blockchain.tick() == []
+
+    # the two transactions left over are sealed once they waited long enough
+    blocks = blockchain.tick(time.monotonic() + 1.0)
+    assert len(blocks) == 1 and len(blocks[0].transactions) == 2
+    assert len(blockchain.block_template) == 0
+    assert blockchain.tick(time.monotonic() + 10.0) == []
+    production = blockchain.to_json()['block_production']
+    assert production[LATENCY_TOTAL] == 7
+    assert sum(production[LATENCY_COUNTS]) == 7
+
+    # partial blocks are not sealed below the minimum block size
+    policy = AdaptiveBlockSize(min_size=3, max_size=5, target_interval=10.0, initial_size=5)
+    blockchain = BlockChain(trans_per_block=5, difficulty=1, block_size_policy=policy, max_block_wait=1.0)
+    blockchain.add_transactions(create_transactions_2([1], [0], [2]))
+    assert blockchain.tick(time.monotonic() + 1.0) == []
+    blockchain.add_transactions(create_transactions_2([1], [2], [1]))
+    assert len(blockchain.tick(time.monotonic() + 1.0)) == 1
+
+
+def test_blockchain_tick_after_reorg():
+    blockchain = BlockChain(trans_per_block=4, difficulty=1, max_block_wait=1.0)
+    main_blocks, _ = blockchain.add_transactions(create_transactions_2([1], [0], [8]))
+    assert len(main_blocks) == 2
+
+    # a competing fork overtakes the second block and frees two of its transactions
+    prev_hash = main_blocks[0].hash()
+    for trans_list in [create_transactions_2([1, 2], [4, 0], [2, 2]), create_transactions_2([2], [2], [4])]:
+        block = create_block(trans_list, prev_hash, 1)
+        blockchain.add_incoming_block(block)
+        prev_hash = block.hash()
+    assert sorted(trans.trans_no for trans in blockchain.block_template.transactions) == [6, 7]
+
+    # the released transactions are sealed once they waited long enough
+    blocks = blockchain.tick(time.monotonic() + 1.0)
+    assert len(blocks) == 1 and len(blocks[0].transactions) == 2
+
+
+if __name__ == '__main__':
+    test_latency_histogram()
+    test_block_production_scheduler()
+    test_blockchain_tick()
+    test_blockchain_tick_after_reorg()
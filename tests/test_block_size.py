@@ -0,0 +1,100 @@
+"""
+Copyright 2022 M. M. Hassan Mahmud
+
+This Source Code Form is subject to the terms of the Mozilla Public
+License, v. 2.0. If a copy of the MPL was not distributed with this
+file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+
+Tests for the block size policies.
+"""
+from blockchain_proto.blockchain.block_size import FixedBlockSize, AdaptiveBlockSize
+from blockchain_proto.blockchain.blockchain_ds import BlockChain
+from blockchain_proto.blockchain.block_helper import create_block, validate_block_hash
+from blockchain_proto.exceptions import BlockSizeError
+from block_creator_for_test import create_transactions_2, create_block_instant
+
+
+def test_adaptive_block_size():
+    policy = AdaptiveBlockSize(min_size=2, max_size=20, target_interval=10.0, initial_size=4)
+    assert policy.current() == 4
+    assert policy.bounds() == (2, 20)
+
+    # a large backlog grows the blocks up to the maximum
+    now = 0.0
+    for i in range(10):
+        now += 10.0
+        policy.block_added(backlog=1000, now=now)
+    assert policy.current() == 20
+
+    # no backlog and slow blocks shrink them down to the minimum
+    for i in range(20):
+        now += 60.0
+        policy.block_added(backlog=0, now=now)
+    assert policy.current() == 2
+
+    # some backlog at the target interval keeps the size
+    for i in range(5):
+        now += 10.0
+        policy.block_added(backlog=3, now=now)
+    assert policy.current() == 2
+
+    # fast blocks grow the size
+    for i in range(10):
+        now += 1.0
+        policy.block_added(backlog=3, now=now)
+    assert policy.current() > 2
+
+    assert FixedBlockSize(5).current() == 5
+    assert FixedBlockSize(5).bounds() is None
+
+
+def test_blockchain_adaptive_block_size():
+    policy = AdaptiveBlockSize(min_size=2, max_size=8, target_interval=1000.0, initial_size=2)
+    blockchain = BlockChain(trans_per_block=2, difficulty=1, block_size_policy=policy)
+
+    # a backlog of transactions makes blocks grow as they are created
+    blocks, _ = blockchain.add_transactions(create_transactions_2([1], [0], [30]))
+    sizes = [len(block.transactions) for block in blocks]
+    assert sizes[0] == 2
+    assert sizes == sorted(sizes) and sizes[-1] == 8
+    assert blockchain.trans_per_block == policy.current()
+
+    # incoming blocks must have a size within the bounds
+    prev_hash = blocks[-1].hash()
+    latest = blockchain.fork_manager.get_longest_latest_trans_no("User 1")
+    for num_trans in [1, 9]:
+        block = create_block_instant(create_transactions_2([1], [latest + 1], [num_trans]), prev_hash)
+        try:
+            blockchain.add_incoming_block(block)
+            assert False
+        except BlockSizeError:
+            pass
+    block = create_block(create_transactions_2([1], [latest + 1], [5]), prev_hash, 1)
+    assert blockchain.add_incoming_block(block) == block
+
+
+def test_blockchain_shrinking_block_size():
+    # with a tiny target interval blocks always come too slowly, so the
+    # size shrinks whenever the backlog is smaller than a block
+    policy = AdaptiveBlockSize(min_size=1, max_size=100, target_interval=1e-9, initial_size=8)
+    blockchain = BlockChain(trans_per_block=8, difficulty=1, block_size_policy=policy)
+    blocks = []
+    for i in range(4):
+        new_blocks, _ = blockchain.add_transactions(create_transactions_2([1], [14 * i], [14]))
+        blocks.extend(new_blocks)
+    sizes = [len(block.transactions) for block in blocks]
+    assert any(size < prev_size for prev_size, size in zip(sizes, sizes[1:]))
+
+    # the blocks hash the transactions they were created with
+    for block in blocks:
+        validate_block_hash(block)
+    peer = BlockChain(trans_per_block=8, difficulty=1,
+                      block_size_policy=AdaptiveBlockSize(min_size=1, max_size=100, target_interval=1e-9))
+    assert len(peer.add_incoming_blocks(blocks)) == len(blocks)
+
+
+if __name__ == '__main__':
+    test_adaptive_block_size()
+    test_blockchain_adaptive_block_size()
+    test_blockchain_shrinking_block_size()
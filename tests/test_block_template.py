@@ -0,0 +1,48 @@
+"""
+Copyright 2022 M. M. Hassan Mahmud
+
+This Source Code Form is subject to the terms of the Mozilla Public
+License, v. 2.0. If a copy of the MPL was not distributed with this
+file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+
+Tests for the block template.
+"""
+from blockchain_proto.blockchain.block_template import BlockTemplate
+from blockchain_proto.transactions.transaction import Transaction
+from blockchain_proto.consts import NULL_BLOCK_HASH
+from block_creator_for_test import create_transactions_2
+
+
+def test_block_template():
+    block_size = 4
+    trans_list = create_transactions_2([1, 2], [0, 5], [3, 4])
+    template = BlockTemplate()
+    template.reset(NULL_BLOCK_HASH, trans_list[0:2])
+
+    assert not template.is_full(block_size)
+    assert template.get_next_trans_no("User 1", lambda user_id: -1) == 2
+    assert template.get_next_trans_no("User 2", lambda user_id: 4) == 5
+
+    # the incrementally computed hash matches the hash of the block's transactions
+    assert template.get_trans_hash(block_size) == Transaction.get_trans_hash(trans_list[0:2])
+    template.extend(trans_list[2:], block_size)
+    assert template.num_hashed == block_size
+    assert template.is_full(block_size)
+    assert template.get_trans_hash(block_size) == Transaction.get_trans_hash(trans_list[0:4])
+
+    block_trans, trans_hash = template.pop_block(block_size)
+    assert block_trans == trans_list[0:4]
+    assert trans_hash == Transaction.get_trans_hash(trans_list[0:4])
+    assert len(template) == 3
+    assert template.get_trans_hash(block_size) == Transaction.get_trans_hash(trans_list[4:])
+    assert template.get_next_trans_no("User 2", lambda user_id: 4) == 9
+
+    # the hash is recomputed when the block size shrinks
+    assert template.get_trans_hash(2) == Transaction.get_trans_hash(trans_list[4:6])
+    block_trans, trans_hash = template.pop_block(1)
+    assert trans_hash == Transaction.get_trans_hash(trans_list[4:5])
+
+
+if __name__ == '__main__':
+    test_block_template()
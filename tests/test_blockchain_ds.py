@@ -8,7 +8,11 @@ file, You can obtain one at https://mozilla.org/MPL/2.0/.
 
 Tests for the blockchain data structure.
 """
-from blockchain_proto.blockchain.block_helper import create_block
+from datetime import datetime
+from blockchain_proto.blockchain.block_helper import create_block, create_block_hash
+from blockchain_proto.blockchain.block_simple import BlockHeader, BlockSimple
+from blockchain_proto.transactions.transaction import Transaction
+from blockchain_proto.consts import NULL_BLOCK_HASH
 from blockchain_proto.blockchain.blockchain_ds import BlockChain
 from copy import deepcopy
 from block_creator_for_test import create_transactions_2
@@ -73,5 +77,109 @@ def test_blockchain_ds():
     assert blockchain.free_trans_manager.num_free() == 0
 
 
+def test_blockchain_ds_reorg():
+    trans_per_block = 3
+    blockchain = BlockChain(trans_per_block=trans_per_block, difficulty=1)
+    for t in create_transactions_2([1], [0], [9]):
+        blockchain.add_transaction(t)
+    main_blocks = blockchain.get_block_list()
+    assert len(main_blocks) == 3
+    assert blockchain.free_trans_manager.num_free() == 0
+    assert blockchain.main_chain == [block.hash() for block in main_blocks]
+
+    # a competing fork off the first block that overtakes the main branch
+    prev_hash = main_blocks[0].hash()
+    fork_hashes = []
+    for trans_list in [create_transactions_2([1], [3], [3]),
+                       create_transactions_2([2], [0], [3]),
+                       create_transactions_2([2], [3], [3])]:
+        inc_block = create_block(trans_list, prev_hash, 1)
+        blockchain.add_incoming_block(inc_block)
+        prev_hash = inc_block.hash()
+        fork_hashes.append(prev_hash)
+
+    assert blockchain.fork_manager.get_longest_fork().head_block_hash == prev_hash
+    assert blockchain.main_chain == [main_blocks[0].hash()] + fork_hashes
+    assert [header.block_hash for header in blockchain.get_headers(1, 2)] == fork_hashes[0:2]
+    assert blockchain.fork_manager.get_longest_latest_trans_no("User 1") == 5
+    # only the transactions of the main branch that are not in the
+    # new longest fork are free again, and ready for the next block
+    assert sorted(t.trans_no for t in blockchain.get_trans_not_added()) == [6, 7, 8]
+    assert len(blockchain.block_template) == 3
+    assert blockchain.block_template.prev_block_hash == prev_hash
+
+    # the next local transaction creates a block on the new longest fork
+    new_blocks = blockchain.add_transaction(create_transactions_2([3], [0], [1])[0])
+    assert len(new_blocks) == 1 and new_blocks[0].prev_hash() == prev_hash
+    assert blockchain.free_trans_manager.num_free() == 1
+
+
+def test_blockchain_ds_budgeted_cleanup():
+    blockchain = BlockChain(trans_per_block=3, difficulty=1, cleanup_interval=100, cleanup_budget=1)
+    for t in create_transactions_2([1], [0], [9]):
+        blockchain.add_transaction(t)
+    main_blocks = blockchain.get_block_list()
+
+    # three single block forks off the first block
+    for i in range(3):
+        inc_block = create_block(create_transactions_2([2], [0], [3]), main_blocks[0].hash(), 1)
+        blockchain.add_incoming_block(inc_block)
+    assert blockchain.fork_manager.num_forks() == 4
+    assert blockchain.blocks_since_cleanup == 6
+
+    # each idle cleanup drops one fork, and releases its transactions in bulk
+    blockchain.fork_manager.fork_len_disc = 0
+    assert blockchain.run_idle_tasks()
+    assert blockchain.blocks_since_cleanup == 0
+    assert blockchain.fork_manager.num_forks() == 3
+    assert blockchain.free_trans_manager.num_free() == 3
+    assert blockchain.run_idle_tasks()
+    assert not blockchain.run_idle_tasks()
+    assert blockchain.fork_manager.num_forks() == 1
+    assert len(blockchain.block_map) == 3
+    assert blockchain.free_trans_manager.num_free() == 3
+    assert not blockchain.run_idle_tasks()
+
+
+def create_unsolved_block(trans_list, prev_hash):
+    # a block whose hash matches its contents but whose puzzle is not solved
+    trans_hash = Transaction.get_trans_hash(trans_list)
+    timestamp = datetime.now()
+    nonce = "unsolved"
+    return BlockSimple(BlockHeader(block_hash=create_block_hash(trans_hash, prev_hash, timestamp, 4, nonce),
+                                   transactions_hash=trans_hash,
+                                   prev_block_hash=prev_hash,
+                                   timestamp=timestamp,
+                                   difficulty=4,
+                                   nonce=nonce),
+                       trans_list)
+
+
+def test_blockchain_ds_assume_valid():
+    blocks = []
+    prev_hash = NULL_BLOCK_HASH
+    for i in range(4):
+        blocks.append(create_unsolved_block(create_transactions_2([1], [3 * i], [3]), prev_hash))
+        prev_hash = blocks[-1].hash()
+
+    blockchain = BlockChain(trans_per_block=3, difficulty=1)
+    assert blockchain.add_incoming_blocks(blocks) == []
+
+    # only the checkpoint and its ancestors skip the puzzle check
+    blockchain = BlockChain(trans_per_block=3, difficulty=1, assume_valid_hashes=[blocks[2].hash()])
+    assert blockchain.add_incoming_blocks(blocks) == blocks[0:3]
+    assert blockchain.fork_manager.get_longest_latest_trans_no("User 1") == 8
+    assert len(blockchain.fork_manager.assume_valid.assumed_valid) == 0
+
+    # blocks whose contents do not match their hash are not assumed valid
+    forged = create_unsolved_block(create_transactions_2([2], [0], [3]), NULL_BLOCK_HASH)
+    forged.block_header.block_hash = "forged"
+    blockchain = BlockChain(trans_per_block=3, difficulty=1, assume_valid_hashes=["forged"])
+    assert blockchain.add_incoming_blocks([forged]) == []
+
+
 if __name__ == '__main__':
     test_blockchain_ds()
+    test_blockchain_ds_reorg()
+    test_blockchain_ds_budgeted_cleanup()
+    test_blockchain_ds_assume_valid()
@@ -0,0 +1,76 @@
+"""
+Copyright 2022 M. M. Hassan Mahmud
+
+This Source Code Form is subject to the terms of the Mozilla Public
+License, v. 2.0. If a copy of the MPL was not distributed with this
+file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+
+Tests for the compression of message payloads.
+"""
+import os
+import pickle
+
+import zmq
+
+from blockchain_proto.codec import PayloadCodec, parse_thresholds
+from blockchain_proto.gossip import GossipBatcher
+from blockchain_proto.consts import BLOCKS_AND_TRANS, SYNC_BLOCKS, TRANS_BATCH_GOSSIP, RAW_PAYLOAD, \
+    ZLIB_PAYLOAD, CODEC_PAYLOADS, CODEC_COMPRESSED, CODEC_RAW_BYTES, CODEC_RATIO, CODEC_DECOMPRESSED
+from block_creator_for_test import create_transactions_2
+
+
+def test_payload_codec():
+    trans_list = create_transactions_2([1, 2], [0, 0], [50, 50])
+    payload = pickle.dumps(trans_list)
+    codec = PayloadCodec(parse_thresholds(['blocks_trans:1024', 'sync_blocks:1024']))
+
+    # large payloads of the given types are compressed
+    encoded = codec.encode(BLOCKS_AND_TRANS, payload)
+    assert encoded[0:1] == ZLIB_PAYLOAD and len(encoded) < len(payload) / 2
+    assert pickle.loads(codec.decode(encoded)) == trans_list
+
+    # small payloads and other types are not, but are still flagged
+    assert codec.encode(BLOCKS_AND_TRANS, payload[0:100]) == RAW_PAYLOAD + payload[0:100]
+    assert codec.encode(TRANS_BATCH_GOSSIP, payload) == RAW_PAYLOAD + payload
+    assert pickle.loads(PayloadCodec().decode(zmq.Frame(RAW_PAYLOAD + payload))) == trans_list
+
+    # payloads that do not shrink are sent raw
+    random_bytes = os.urandom(2048)
+    assert codec.encode(SYNC_BLOCKS, random_bytes) == RAW_PAYLOAD + random_bytes
+
+    counters = codec.to_json()
+    assert counters['blocks_trans'][CODEC_PAYLOADS] == 1
+    assert counters['blocks_trans'][CODEC_RAW_BYTES] == len(payload)
+    assert counters['blocks_trans'][CODEC_RATIO] > 2
+    assert counters['sync_blocks'][CODEC_COMPRESSED] == 0
+    assert counters['sync_blocks'][CODEC_RATIO] == 1.0
+    assert counters[CODEC_DECOMPRESSED] == 1
+    assert 'trans_batch' not in counters
+
+    # unknown flags and thresholds without a size are rejected
+    try:
+        codec.decode(b'\x02' + payload)
+        assert False
+    except ValueError:
+        pass
+    try:
+        parse_thresholds(['blocks_trans'])
+        assert False
+    except ValueError:
+        pass
+
+
+def test_gossip_batcher_encode():
+    sent = []
+    codec = PayloadCodec({TRANS_BATCH_GOSSIP: 0})
+    batcher = GossipBatcher(sent.append, batch_size=100, encode=codec.encode)
+    trans_list = create_transactions_2([1], [0], [100])
+    batcher.add([], trans_list)
+    assert sent[0][0] == TRANS_BATCH_GOSSIP and sent[0][1][0:1] == ZLIB_PAYLOAD
+    assert pickle.loads(codec.decode(sent[0][1])) == trans_list
+
+
+if __name__ == '__main__':
+    test_payload_codec()
+    test_gossip_batcher_encode()
@@ -13,6 +13,7 @@ from datetime import datetime
 from blockchain_proto.blockchain.block_helper import create_block
 from blockchain_proto.blockchain.block_simple import BlockHeader, BlockSimple
 from blockchain_proto.forks.fork_manager import  ForkManager
+from blockchain_proto.transactions.transaction import Transaction
 from blockchain_proto.consts import NULL_BLOCK_HASH
 from block_creator_for_test import create_transactions
 from blockchain_proto.exceptions import UnorderedTransactionError, PrecBlockNotFoundError, \
@@ -178,11 +179,268 @@ def test_fork_manager_cleanup():
     assert len(fork_manager.forks) == 1
 
 
+def test_fork_manager_cleanup_overtaken_main():
+    fork_manager = ForkManager()
+    main_branch_len = 6
+    fork_entry_point = 2
+    fork_len = 8
+    block_map = {}
+
+    # create main branch
+    base_trans = [0, 0]
+    prev_hash = NULL_BLOCK_HASH
+    block_list = []
+    for i in range(main_branch_len):
+        trans = create_transactions(base_trans)
+        block = create_block(trans, prev_hash, 1)
+        fork_manager.add_blocks([block])
+        base_trans [0] += 3
+        base_trans [1] += 1
+        prev_hash = block.block_header.block_hash
+        block_list.append(block)
+        block_map[block.hash()] = block
+
+    # create a fork that becomes much longer than the main branch
+    base_trans = [(fork_entry_point+1)*3, fork_entry_point+1]
+    prev_hash = block_list[fork_entry_point].hash()
+    for i in range(fork_len):
+        trans = create_transactions(base_trans)
+        block = create_block(trans, prev_hash, 1)
+        fork_manager.add_blocks([block])
+        base_trans [0] += 3
+        base_trans [1] += 1
+        prev_hash = block.block_header.block_hash
+        block_map[block.hash()] = block
+
+    assert fork_manager.longest_fork.fork_id == 1
+    assert fork_manager.fork_index.longest() == 1
+
+    # dropping the main branch only releases the blocks after the
+    # point where the fork entered it
+    fork_manager.fork_len_disc = 2
+    bhashes_released = fork_manager.cleanup_forks(block_map)
+    assert bhashes_released == [block.hash() for block in reversed(block_list[fork_entry_point+1:])]
+    assert len(fork_manager.forks) == 1 and len(fork_manager.fork_index) == 1
+    assert fork_manager.get_longest_latest_trans_no("User 2") == fork_entry_point + fork_len
+    for block in block_list[0:fork_entry_point+1]:
+        assert block.hash() in fork_manager.validator.latest_trans
+
+
+def test_fork_manager_ancestors():
+    fork_manager = ForkManager()
+    main_branch_len = 40
+    fork_entry_point = 22
+    fork_len = 9
+
+    # create main branch
+    base_trans = [0, 0]
+    prev_hash = NULL_BLOCK_HASH
+    block_list = []
+    for i in range(main_branch_len):
+        trans = create_transactions(base_trans)
+        block = create_block(trans, prev_hash, 1)
+        fork_manager.add_blocks([block])
+        base_trans [0] += 3
+        base_trans [1] += 1
+        prev_hash = block.block_header.block_hash
+        block_list.append(block)
+
+    # create the fork
+    base_trans = [(fork_entry_point+1)*3, fork_entry_point+1]
+    prev_hash = block_list[fork_entry_point].hash()
+    fork_block_list = []
+    for i in range(fork_len):
+        trans = create_transactions(base_trans)
+        block = create_block(trans, prev_hash, 1)
+        fork_manager.add_blocks([block])
+        base_trans [0] += 3
+        base_trans [1] += 1
+        prev_hash = block.block_header.block_hash
+        fork_block_list.append(block)
+
+    main_head = block_list[-1].hash()
+    for height in range(1, main_branch_len + 1):
+        assert fork_manager.get_ancestor(main_head, height) == block_list[height - 1].hash()
+    assert fork_manager.get_ancestor(main_head, main_branch_len + 1) is None
+    assert fork_manager.get_ancestor(fork_block_list[-1].hash(), fork_entry_point + 2) == \
+        fork_block_list[0].hash()
+
+    entry_hash = block_list[fork_entry_point].hash()
+    assert fork_manager.get_common_ancestor(main_head, fork_block_list[-1].hash()) == entry_hash
+    assert fork_manager.get_common_ancestor(block_list[30].hash(), fork_block_list[3].hash()) == entry_hash
+    assert fork_manager.get_common_ancestor(block_list[30].hash(), block_list[5].hash()) == \
+        block_list[5].hash()
+
+    assert fork_manager.is_in_longest_fork(block_list[30].hash())
+    assert not fork_manager.is_in_longest_fork(fork_block_list[3].hash())
+
+
+def test_fork_manager_tip_state():
+    fork_manager = ForkManager()
+    main_branch_len = 5
+    fork_entry_point = 1
+    fork_len = 6
+
+    def check_tip_state():
+        head_hash = fork_manager.longest_fork.head_block_hash
+        for user_id in ["User 1", "User 2", "User 3"]:
+            assert fork_manager.get_longest_latest_trans_no(user_id) == \
+                fork_manager.validator.get_latest_trans(user_id, head_hash)
+
+    # create main branch
+    base_trans = [0, 0]
+    prev_hash = NULL_BLOCK_HASH
+    block_list = []
+    for i in range(main_branch_len):
+        trans = create_transactions(base_trans)
+        block = create_block(trans, prev_hash, 1)
+        fork_manager.add_blocks([block])
+        base_trans [0] += 3
+        base_trans [1] += 1
+        prev_hash = block.block_header.block_hash
+        block_list.append(block)
+        check_tip_state()
+
+    assert fork_manager.get_longest_latest_trans_no("User 1") == main_branch_len * 3 - 1
+    assert fork_manager.get_longest_latest_trans_no("User 3") == -1
+
+    # create a fork that overtakes the main branch
+    base_trans = [(fork_entry_point+1)*3, fork_entry_point+1]
+    prev_hash = block_list[fork_entry_point].hash()
+    for i in range(fork_len):
+        trans = create_transactions(base_trans)
+        block = create_block(trans, prev_hash, 1)
+        fork_manager.add_blocks([block])
+        base_trans [0] += 3
+        base_trans [1] += 1
+        prev_hash = block.block_header.block_hash
+        check_tip_state()
+
+    assert fork_manager.longest_fork.fork_id == 1
+    assert fork_manager.tip_state.head_hash == prev_hash
+    assert fork_manager.get_longest_latest_trans_no("User 2") == fork_entry_point + fork_len
+
+
+def test_fork_manager_finality_pruning():
+    fork_manager = ForkManager(finality_depth=10)
+    main_branch_len = 40
+    fork_entry_point = 35
+    fork_len = 2
+    block_map = {}
+
+    # create main branch, with a user only in the first block
+    base_trans = [0, 0]
+    prev_hash = NULL_BLOCK_HASH
+    block_list = []
+    for i in range(main_branch_len):
+        trans = list(create_transactions(base_trans))
+        if i == 0:
+            trans.append(Transaction(user_id="User 3", trans_no=0, trans_details="Pay Bob 3 Gold coins"))
+        block = create_block(trans, prev_hash, 1)
+        fork_manager.add_blocks([block])
+        base_trans [0] += 3
+        base_trans [1] += 1
+        prev_hash = block.block_header.block_hash
+        block_list.append(block)
+        block_map[block.hash()] = block
+
+    # create a fork which is kept
+    base_trans = [(fork_entry_point+1)*3, fork_entry_point+1]
+    prev_hash = block_list[fork_entry_point].hash()
+    for i in range(fork_len):
+        block = create_block(create_transactions(base_trans), prev_hash, 1)
+        fork_manager.add_blocks([block])
+        base_trans [0] += 3
+        base_trans [1] += 1
+        prev_hash = block.block_header.block_hash
+        block_map[block.hash()] = block
+
+    # the branch point of the fork is found without looking at the forks
+    assert fork_manager.block_depth_manager.get_oldest_branch_point() == block_list[fork_entry_point].hash()
+    assert fork_manager.cleanup_forks(block_map) == []
+    assert len(fork_manager.forks) == 2
+
+    # blocks before the one 10 blocks behind the head are collapsed into it
+    checkpoint_depth = main_branch_len - 10
+    checkpoint_hash = block_list[checkpoint_depth - 1].hash()
+    latest_trans = fork_manager.validator.latest_trans
+    assert len(latest_trans.trans_map) == main_branch_len - checkpoint_depth + 1 + fork_len
+    assert len(fork_manager.block_depth_manager.block_depth_map) == len(latest_trans.trans_map)
+    assert latest_trans.prev_hashes[checkpoint_hash] == NULL_BLOCK_HASH
+    assert fork_manager.get_ancestor(block_list[-1].hash(), checkpoint_depth) == checkpoint_hash
+    assert fork_manager.get_ancestor(block_list[-1].hash(), checkpoint_depth - 1) is None
+    assert fork_manager.get_common_ancestor(block_list[-1].hash(), prev_hash) == \
+        block_list[fork_entry_point].hash()
+
+    # the latest transactions are unchanged
+    head_hash = block_list[-1].hash()
+    assert fork_manager.validator.get_latest_trans("User 3", head_hash) == 0
+    assert fork_manager.validator.get_latest_trans("User 1", checkpoint_hash) == checkpoint_depth * 3 - 1
+    assert fork_manager.validator.get_latest_trans("User 2", prev_hash) == fork_entry_point + fork_len
+
+    # blocks can no longer be added on top of pruned blocks
+    block = create_block(create_transactions([30, 10]), block_list[9].hash(), 1)
+    assert fork_manager.add_blocks([block]) == [str(PrecBlockNotFoundError(block.hash(), block_list[9].hash()))]
+
+    # the chain keeps growing, and the state kept stays bounded
+    base_trans = [main_branch_len*3, main_branch_len]
+    prev_hash = head_hash
+    for i in range(20):
+        block = create_block(create_transactions(base_trans), prev_hash, 1)
+        fork_manager.add_blocks([block])
+        base_trans [0] += 3
+        base_trans [1] += 1
+        prev_hash = block.block_header.block_hash
+        block_map[block.hash()] = block
+    fork_manager.cleanup_forks(block_map)
+    assert len(fork_manager.forks) == 1
+    assert fork_manager.block_depth_manager.get_oldest_branch_point() is None
+    assert len(latest_trans.trans_map) == 11
+    assert fork_manager.validator.get_latest_trans("User 3", prev_hash) == 0
+    assert fork_manager.get_longest_latest_trans_no("User 2") == main_branch_len + 19
+
+
+def test_fork_manager_add_local_blocks():
+    fork_manager = ForkManager()
+    base_trans = [0, 0]
+    prev_hash = NULL_BLOCK_HASH
+    for i in range(3):
+        block = create_block(create_transactions(base_trans), prev_hash, 1)
+        assert fork_manager.add_local_blocks([block]) == [1]
+        base_trans [0] += 3
+        base_trans [1] += 1
+        prev_hash = block.block_header.block_hash
+
+    # the puzzle solution of local blocks is trusted
+    block = create_block(create_transactions(base_trans), prev_hash, 1)
+    block.block_header.nonce = "not a solution"
+    try:
+        fork_manager.add_local_blocks([block], self_check=True)
+        assert False
+    except ValueError:
+        pass
+    assert fork_manager.add_local_blocks([block]) == [1]
+    assert fork_manager.get_longest_fork().head_block_hash == block.hash()
+    assert fork_manager.get_longest_latest_trans_no("User 2") == 3
+
+    # links and transaction order are still checked
+    assert fork_manager.add_local_blocks([block]) == [str(BlockWasAlreadyAddedError(block.hash()))]
+    block = create_block(create_transactions([0, 0]), block.hash(), 1)
+    try:
+        fork_manager.add_local_blocks([block])
+        assert False
+    except EarliestTransMismatchError:
+        pass
 
 
 if __name__ == '__main__':
     test_fork_manager_add()
     test_fork_manager_cleanup()
+    test_fork_manager_cleanup_overtaken_main()
+    test_fork_manager_ancestors()
+    test_fork_manager_tip_state()
+    test_fork_manager_finality_pruning()
+    test_fork_manager_add_local_blocks()
 
 
 
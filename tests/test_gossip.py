@@ -0,0 +1,245 @@
+"""
+Copyright 2022 M. M. Hassan Mahmud
+
+This Source Code Form is subject to the terms of the Mozilla Public
+License, v. 2.0. If a copy of the MPL was not distributed with this
+file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+
+Tests for the gossip helpers.
+"""
+import pickle
+import random
+
+import zmq
+
+from blockchain_proto.gossip import GossipBatcher, InventoryTracker, SeenCache, PeerSelector
+from blockchain_proto.blockchain.blockchain_ds import BlockChain
+from blockchain_proto.blockchain.compact_block import CompactBlock, CompactBlockAssembler
+from blockchain_proto.transactions.transaction import Transaction
+from blockchain_proto.consts import TRANS_BATCH_GOSSIP, BLOCK_BATCH_GOSSIP, NULL_BLOCK_HASH, \
+    INV_BLOCKS_GOSSIP, INV_TRANS_GOSSIP, SEEN_CACHE_HITS, SEEN_CACHE_HIT_RATE
+from block_creator_for_test import create_transactions_2, create_block_instant
+
+
+def test_gossip_batcher():
+    sent = []
+    batcher = GossipBatcher(sent.append, batch_size=4, linger=1.0)
+    trans_list = create_transactions_2([1], [0], [10])
+    block = create_block_instant(trans_list[0:2], NULL_BLOCK_HASH)
+
+    # full batches are sent right away, the rest waits
+    batcher.add([block], trans_list, now=0.0)
+    assert [msg[0] for msg in sent] == [TRANS_BATCH_GOSSIP, TRANS_BATCH_GOSSIP]
+    assert pickle.loads(sent[0][1]) == trans_list[0:4]
+    assert pickle.loads(sent[1][1]) == trans_list[4:8]
+    assert len(batcher) == 3
+    assert batcher.seconds_until_due(0.5) == 0.5
+
+    batcher.flush_if_due(0.5)
+    assert len(sent) == 2
+    batcher.flush_if_due(1.0)
+    assert [msg[0] for msg in sent[2:]] == [BLOCK_BATCH_GOSSIP, TRANS_BATCH_GOSSIP]
+    assert pickle.loads(sent[2][1])[0].hash() == block.hash()
+    assert pickle.loads(sent[3][1]) == trans_list[8:10]
+    assert len(batcher) == 0
+    assert batcher.seconds_until_due(1.0) is None
+
+    # exactly full batches leave nothing waiting
+    batcher.add([], trans_list[0:4], now=2.0)
+    assert len(sent) == 5 and batcher.seconds_until_due(2.0) is None
+
+    # transactions can go before the blocks they are in
+    sent = []
+    batcher = GossipBatcher(sent.append, batch_size=4, linger=1.0, trans_first=True)
+    batcher.add([block], trans_list[0:2], now=0.0)
+    batcher.flush()
+    assert [msg[0] for msg in sent] == [TRANS_BATCH_GOSSIP, BLOCK_BATCH_GOSSIP]
+
+
+def test_inventory_gossip():
+    sent = []
+    batcher = GossipBatcher(sent.append, batch_size=2, linger=1.0,
+                            block_msg_type=INV_BLOCKS_GOSSIP, trans_msg_type=INV_TRANS_GOSSIP)
+    batcher.add(["hash"], [("User 1", 0), ("User 1", 1)], now=0.0)
+    assert sent == [[INV_TRANS_GOSSIP, pickle.dumps([("User 1", 0), ("User 1", 1)])]]
+
+    # only the missing blocks and transactions are requested
+    trans_list = create_transactions_2([1], [0], [4])
+    sender = BlockChain(trans_per_block=3, difficulty=1)
+    receiver = BlockChain(trans_per_block=3, difficulty=1)
+    blocks, _ = sender.add_transactions(trans_list)
+    receiver.add_transactions(trans_list[0:1])
+    trans_ids = [(trans.user_id, trans.trans_no) for trans in trans_list]
+    missing = receiver.get_missing_inventory([blocks[0].hash()], trans_ids)
+    assert missing == ([blocks[0].hash()], trans_ids[1:])
+
+    # confirmed transactions are not sent, they come with the blocks
+    sent_blocks, sent_trans = sender.get_inventory(*missing)
+    assert [block.hash() for block in sent_blocks] == [blocks[0].hash()]
+    assert sent_trans == trans_list[3:4]
+    receiver.add_incoming_blocks(sent_blocks)
+    receiver.add_transactions(sent_trans)
+    assert receiver.get_missing_inventory([blocks[0].hash()], trans_ids) == ([], [])
+
+    # an item announced by several peers is requested once per timeout
+    tracker = InventoryTracker(request_timeout=2.0)
+    assert tracker.to_request(["a", "b"], now=0.0) == ["a", "b"]
+    assert tracker.to_request(["a", "c"], now=1.0) == ["c"]
+    assert tracker.to_request(["a", "c"], now=2.5) == ["a"]
+    tracker.received(["c"])
+    assert tracker.to_request(["c"], now=2.5) == ["c"]
+
+
+def test_compact_blocks():
+    trans_list = create_transactions_2([1, 2], [0, 0], [6, 3])
+    sender = BlockChain(trans_per_block=3, difficulty=1)
+    blocks, _ = sender.add_transactions(trans_list)
+    assert len(blocks) == 3
+    compact_blocks = [CompactBlock.from_block(block) for block in blocks]
+    assert compact_blocks[1].trans_ids == [("User 1", 3), ("User 1", 4), ("User 1", 5)]
+    assert len(pickle.dumps(compact_blocks[0])) < len(pickle.dumps(blocks[0]))
+
+    # blocks whose transactions are all free are rebuilt right away
+    receiver = BlockChain(trans_per_block=100, difficulty=1)
+    receiver.add_transactions(trans_list)
+    assembler = CompactBlockAssembler(lambda trans_ids: receiver.get_inventory([], trans_ids)[1])
+    rebuilt, request_id, missing = assembler.add(compact_blocks)
+    assert request_id is None and missing == {}
+    assert [block.hash() for block in receiver.add_incoming_blocks(rebuilt)] == [block.hash() for block in blocks]
+
+    # otherwise only the missing transactions are requested, and the blocks
+    # are returned in order once they arrive
+    receiver = BlockChain(trans_per_block=100, difficulty=1)
+    receiver.add_transactions(trans_list[0:4])
+    assembler = CompactBlockAssembler(lambda trans_ids: receiver.get_inventory([], trans_ids)[1])
+    rebuilt, request_id, missing = assembler.add(compact_blocks)
+    assert rebuilt == [] and request_id is not None
+    assert missing == {blocks[1].hash(): [("User 1", 4), ("User 1", 5)],
+                       blocks[2].hash(): [("User 2", 0), ("User 2", 1), ("User 2", 2)]}
+    block_trans = {bhash: sender.get_block_transactions(bhash, trans_ids) for bhash, trans_ids in missing.items()}
+    assert block_trans[blocks[1].hash()] == trans_list[4:6]
+    rebuilt, failed = assembler.trans_received(request_id, block_trans)
+    assert failed == [] and [block.hash() for block in rebuilt] == [block.hash() for block in blocks]
+    assert len(receiver.add_incoming_blocks(rebuilt)) == 3
+    assert assembler.trans_received(request_id, block_trans) == ([], [])
+
+    # a free transaction with the same id but different details is requested too
+    receiver = BlockChain(trans_per_block=100, difficulty=1)
+    receiver.add_transactions([Transaction("User 1", 0, "Pay Asha 1 Gold coins")] + trans_list[1:3])
+    assembler = CompactBlockAssembler(lambda trans_ids: receiver.get_inventory([], trans_ids)[1])
+    _, request_id, missing = assembler.add(compact_blocks[0:1])
+    assert missing == {blocks[0].hash(): compact_blocks[0].trans_ids}
+
+    # blocks that cannot be rebuilt with what was sent are reported
+    rebuilt, failed = assembler.trans_received(request_id, {})
+    assert rebuilt == [] and failed == [blocks[0].hash()]
+
+
+def test_seen_cache():
+    cache = SeenCache(max_size=2)
+    assert not cache.check_and_add([TRANS_BATCH_GOSSIP, b'a'])
+    assert cache.check_and_add([TRANS_BATCH_GOSSIP, b'a'])
+    # the frames are not simply concatenated
+    assert not cache.check_and_add([TRANS_BATCH_GOSSIP + b'a'])
+    assert not cache.check_and_add([BLOCK_BATCH_GOSSIP, b'a'])
+
+    # the least recently seen message is evicted
+    assert len(cache) == 2
+    assert not cache.check_and_add([TRANS_BATCH_GOSSIP, b'a'])
+    assert cache.check_and_add([BLOCK_BATCH_GOSSIP, b'a'])
+    assert cache.to_json()[SEEN_CACHE_HITS] == 2
+    assert cache.to_json()[SEEN_CACHE_HIT_RATE] == 2 / 6
+
+    # frames received without copying are keyed like the bytes they hold
+    assert cache.check_and_add([zmq.Frame(BLOCK_BATCH_GOSSIP), zmq.Frame(b'a')])
+
+
+def test_peer_selector():
+    selector = PeerSelector(fanout=3, rng=random.Random(0))
+    peers = [f"tcp://localhost:{port}" for port in range(5000, 5010, 2)]
+    chosen = selector.add_peers(peers)
+    assert len(chosen) == 3 and set(chosen) <= set(peers)
+
+    # new peers choose their own neighbours once the fanout is reached
+    for port in range(6000, 6100, 2):
+        assert selector.peer_joined(f"tcp://localhost:{port}") is None
+    assert len(selector.known) == 55 and len(selector.neighbours) == 3
+
+    # peers which ask are subscribed to on top of the neighbours
+    assert selector.subscribe_requested("tcp://localhost:6000") == "tcp://localhost:6000"
+    assert selector.subscribe_requested("tcp://localhost:6000") is None
+    assert selector.subscribe_requested(chosen[0]) is None
+    assert selector.is_subscribed("tcp://localhost:6000") and len(selector.neighbours) == 3
+
+    # a neighbour is only lost if it is not reconnected within the timeout
+    lost, reconnected = selector.neighbours[0:2]
+    selector.peer_disconnected(lost, now=0.0)
+    selector.peer_disconnected(reconnected, now=0.0)
+    selector.peer_disconnected("tcp://localhost:1", now=0.0)
+    selector.peer_reconnected(reconnected)
+    assert selector.lost_peers(now=9.0) == []
+    assert selector.lost_peers(now=10.0) == [lost]
+
+    # a lost neighbour is replaced by a known peer, but not one which asked
+    replacement = selector.peer_lost(lost)
+    assert replacement not in (None, lost, "tcp://localhost:6000") and lost not in selector.known
+    assert len(selector.neighbours) == 3 and replacement in selector.neighbours
+    assert selector.lost_peers(now=20.0) == []
+    assert selector.peer_lost("tcp://localhost:6000") is None
+    assert not selector.is_subscribed("tcp://localhost:6000")
+
+    # without a fanout every peer is a neighbour
+    selector = PeerSelector()
+    assert sorted(selector.add_peers(peers)) == peers
+    assert selector.peer_joined("tcp://localhost:7000") == "tcp://localhost:7000"
+
+
+def test_peer_selector_subscribers():
+    rng = random.Random(1)
+    selectors = {}
+
+    def subscribers(address):
+        return [other for other, selector in selectors.items() if selector.is_subscribed(address)]
+
+    def join(address):
+        selector = PeerSelector(fanout=3, rng=rng)
+        for neighbour in selector.add_peers(list(selectors)):
+            selectors[neighbour].subscribe_requested(address)
+        for other, other_selector in selectors.items():
+            if other_selector.peer_joined(address) is not None:
+                selector.subscribe_requested(other)
+        selectors[address] = selector
+
+    def leave(address):
+        # only the nodes subscribed to a node notice that it left, the
+        # others still know it
+        del selectors[address]
+        for other, selector in selectors.items():
+            lost = address
+            while lost is not None and selector.is_subscribed(lost):
+                replacement = selector.peer_lost(lost)
+                if replacement in selectors:
+                    selectors[replacement].subscribe_requested(other)
+                    replacement = None
+                # a peer which already left is found when connecting to it
+                lost = replacement
+
+    # every node keeps subscribers as nodes join and leave, and the number
+    # of peers each node subscribes to stays bounded on average
+    for i in range(200):
+        join(f"tcp://localhost:{5000 + i}")
+        if i % 3 == 2:
+            leave(rng.choice(list(selectors)))
+        assert all(len(subscribers(address)) >= min(3, len(selectors) - 1) for address in selectors)
+    num_subscribed = [len(selector.neighbours) + len(selector.requested) for selector in selectors.values()]
+    assert sum(num_subscribed) / len(num_subscribed) <= 6
+
+
+if __name__ == '__main__':
+    test_gossip_batcher()
+    test_inventory_gossip()
+    test_compact_blocks()
+    test_seen_cache()
+    test_peer_selector()
+    test_peer_selector_subscribers()
@@ -0,0 +1,66 @@
+"""
+Copyright 2022 M. M. Hassan Mahmud
+
+This Source Code Form is subject to the terms of the Mozilla Public
+License, v. 2.0. If a copy of the MPL was not distributed with this
+file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+
+Tests for the IntervalSet class.
+"""
+from blockchain_proto.transactions.interval_set import IntervalSet
+
+
+def test_interval_set_add():
+    iset = IntervalSet()
+
+    # dense, in order numbers use a single interval
+    for n in range(1000):
+        iset.add(n)
+    assert iset.num_intervals() == 1
+    assert len(iset) == 1000
+    assert 0 in iset and 999 in iset and 1000 not in iset and -1 not in iset
+
+    # gaps create new intervals and filling them merges
+    iset.add(1002)
+    iset.add_range(1005, 1010)
+    assert iset.intervals() == [(0, 999), (1002, 1002), (1005, 1010)]
+    iset.add_range(1000, 1004)
+    assert iset.intervals() == [(0, 1010)]
+    assert len(iset) == 1011
+
+    # overlapping ranges are not double counted
+    iset.add_range(500, 1020)
+    assert iset.intervals() == [(0, 1020)]
+    assert len(iset) == 1021
+    assert iset.min() == 0 and iset.max() == 1020
+
+
+def test_interval_set_remove():
+    iset = IntervalSet()
+    iset.add_range(0, 20)
+
+    assert iset.discard(10)
+    assert not iset.discard(10)
+    assert iset.intervals() == [(0, 9), (11, 20)]
+    assert iset.interval_containing(15) == (11, 20)
+    assert iset.interval_containing(10) is None
+
+    assert iset.discard(0) and iset.discard(20)
+    assert iset.intervals() == [(1, 9), (11, 19)]
+    assert len(iset) == 18
+
+    removed = iset.discard_below(13)
+    assert removed == [(1, 9), (11, 12)]
+    assert iset.intervals() == [(13, 19)]
+    assert len(iset) == 7
+    assert list(iset) == list(range(13, 20))
+
+    assert iset.discard_below(5) == []
+    assert iset.discard_below(100) == [(13, 19)]
+    assert len(iset) == 0 and iset.max() is None
+
+
+if __name__ == '__main__':
+    test_interval_set_add()
+    test_interval_set_remove()
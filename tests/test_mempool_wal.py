@@ -0,0 +1,60 @@
+"""
+Copyright 2022 M. M. Hassan Mahmud
+
+This Source Code Form is subject to the terms of the Mozilla Public
+License, v. 2.0. If a copy of the MPL was not distributed with this
+file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+
+Tests for the write-ahead log of the free transactions.
+"""
+import os
+from blockchain_proto.transactions.mempool_wal import MempoolWAL
+from blockchain_proto.transactions.free_transaction_manager import FreeTransactionManager
+from block_creator_for_test import create_transactions_2
+
+
+def test_mempool_wal_replay(tmp_path):
+    wal_path = str(tmp_path / "mempool.wal")
+    trans_list = create_transactions_2([1, 2], [0, 0], [10, 5])
+
+    free_trans_manager = FreeTransactionManager(MempoolWAL(wal_path, batch_size=4))
+    free_trans_manager.add_transactions(trans_list)
+    # removes the older transactions of the user too
+    free_trans_manager.remove_older_and_equal_trans(trans_list[3:6])
+    assert free_trans_manager.num_free() == 9
+    free_trans_manager.close()
+
+    # restarting rebuilds the free transactions from the log
+    free_trans_manager = FreeTransactionManager(MempoolWAL(wal_path))
+    assert free_trans_manager.num_free() == 9
+    assert sorted(free_trans_manager.get_trans_list()) == sorted(trans_list[6:])
+
+    # a partially written record at the end is dropped
+    free_trans_manager.close()
+    with open(wal_path, 'ab') as f:
+        f.write(b'\x00\x00\x01\x00partial')
+    free_trans_manager = FreeTransactionManager(MempoolWAL(wal_path))
+    assert free_trans_manager.num_free() == 9
+    free_trans_manager.close()
+
+
+def test_mempool_wal_compaction(tmp_path):
+    wal_path = str(tmp_path / "mempool.wal")
+    trans_list = create_transactions_2([1], [0], [40])
+
+    wal = MempoolWAL(wal_path, batch_size=1, compact_factor=2, min_compact_records=8)
+    free_trans_manager = FreeTransactionManager(wal)
+    for trans in trans_list:
+        free_trans_manager.add_transaction(trans)
+    size_before = os.path.getsize(wal_path)
+    for i in range(0, 36, 4):
+        free_trans_manager.remove_older_and_equal_trans(trans_list[i:i + 4])
+
+    assert wal.num_records < 8
+    assert os.path.getsize(wal_path) < size_before
+    free_trans_manager.close()
+
+    free_trans_manager = FreeTransactionManager(MempoolWAL(wal_path))
+    assert sorted(free_trans_manager.get_trans_list()) == trans_list[36:]
+    free_trans_manager.close()
@@ -0,0 +1,307 @@
+"""
+Copyright 2022 M. M. Hassan Mahmud
+
+This Source Code Form is subject to the terms of the Mozilla Public
+License, v. 2.0. If a copy of the MPL was not distributed with this
+file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+
+Tests for the headers-first sync.
+"""
+from blockchain_proto.sync import HeaderSync, BlockDownloadScheduler
+from blockchain_proto.blockchain.blockchain_ds import BlockChain
+from blockchain_proto.consts import NULL_BLOCK_HASH, GET_HEADERS, GET_BLOCK_BODIES, GET_MEMPOOL
+from block_creator_for_test import create_transactions_2, create_block_instant
+
+
+def run_sync(header_sync: HeaderSync, servers: dict, client: BlockChain, trans_chunk_size: int = 2):
+    """
+    Runs a header sync of the client with the servers, by peer id, answering
+    the requests in the order they were made, and returns the requests made
+    and the transactions sent.
+    """
+    all_requests = []
+    trans_sent = []
+    while not header_sync.is_done():
+        requests = header_sync.next_requests()
+        assert len(requests) > 0
+        all_requests.extend(requests)
+        for peer, msg_type, data in requests:
+            server = servers[peer]
+            if msg_type == GET_HEADERS:
+                start_height, headers = server.get_headers_after(*data)
+                header_sync.headers_received(headers, start_height, data[0])
+            elif msg_type == GET_BLOCK_BODIES:
+                blocks, _ = server.get_inventory(data[1], [])
+                client.add_incoming_blocks(header_sync.blocks_received(data[0], blocks, data[2]),
+                                           headers_checked=True)
+            else:
+                summary, generation = data
+                trans_list = server.get_trans_not_added() if summary is None else server.get_trans_not_in(summary)
+                trans_sent.extend(trans_list)
+                for start in range(0, max(len(trans_list), 1), trans_chunk_size):
+                    client.add_transactions(header_sync.trans_received(
+                        trans_list[start:start + trans_chunk_size], start + trans_chunk_size >= len(trans_list),
+                        generation, peer))
+    return all_requests, trans_sent
+
+
+def test_header_sync():
+    server = BlockChain(trans_per_block=2, difficulty=1)
+    server.add_transactions(create_transactions_2([1, 2], [0, 0], [7, 6]))
+    assert len(server.main_chain) == 6
+
+    # the client already has the first block
+    client = BlockChain(trans_per_block=2, difficulty=1)
+    client.add_incoming_block(server.block_map[server.main_chain[0]])
+    downloader = BlockDownloadScheduler(["a", "b"], chunk_size=2, max_chunks_per_peer=1)
+    header_sync = HeaderSync("a", client.block_map, header_page_size=2, downloader=downloader)
+    requests, _ = run_sync(header_sync, {"a": server, "b": server}, client)
+
+    assert client.main_chain == server.main_chain
+    assert sorted(client.get_trans_not_added()) == sorted(server.get_trans_not_added())
+    # the bodies are downloaded from both peers, the rest from the sync peer
+    body_requests = [(peer, data[1]) for peer, msg_type, data in requests if msg_type == GET_BLOCK_BODIES]
+    assert sum(len(hashes) for _, hashes in body_requests) == 5
+    assert all(len(hashes) <= 2 for _, hashes in body_requests)
+    assert set(peer for peer, _ in body_requests) == {"a", "b"}
+    assert [msg_type for _, msg_type, _ in requests].count(GET_HEADERS) == 4
+    assert all(peer == "a" for peer, msg_type, _ in requests if msg_type != GET_BLOCK_BODIES)
+    assert requests[-1] == ("a", GET_MEMPOOL, (None, 0))
+
+
+def test_block_locator_sync():
+    server = BlockChain(trans_per_block=2, difficulty=1)
+    server.add_transactions(create_transactions_2([1], [0], [61]))
+    locator = server.get_block_locator()
+    heights = [server.main_chain_heights[bhash] for bhash in locator]
+    assert heights[0:10] == list(range(29, 19, -1))
+    assert heights[10:] == [18, 14, 6, 0]
+    assert server.get_headers_after(locator, 5) == (30, [])
+    assert server.get_headers_after(["unknown"] + locator[3:], 1)[0] == 27
+    assert server.get_headers_after([], 1)[0] == 0
+
+    # a client that was in sync, then missed a few blocks and transactions
+    client = BlockChain(trans_per_block=2, difficulty=1)
+    run_sync(HeaderSync("a", client.block_map, client.get_block_locator(), client.get_trans_summary),
+             {"a": server}, client)
+    assert client.main_chain == server.main_chain
+    server.add_transactions(create_transactions_2([1, 2], [61, 0], [4, 2]))
+
+    header_sync = HeaderSync("a", client.block_map, client.get_block_locator(), client.get_trans_summary,
+                             header_page_size=10)
+    requests, trans_sent = run_sync(header_sync, {"a": server}, client)
+    assert client.main_chain == server.main_chain
+    assert header_sync.start_height == 30 and header_sync.num_headers == 3
+    assert sum(len(data[1]) for _, msg_type, data in requests if msg_type == GET_BLOCK_BODIES) == 3
+    # only the missing free transactions are sent
+    assert len(trans_sent) == 1
+    assert sorted(client.get_trans_not_added()) == sorted(server.get_trans_not_added())
+    assert server.get_trans_not_in(client.get_trans_summary()) == []
+    assert server.get_trans_not_in({}) == server.get_trans_not_added()
+
+
+def test_header_sync_invalid():
+    server = BlockChain(trans_per_block=2, difficulty=1)
+    server.add_transactions(create_transactions_2([1], [0], [4]))
+
+    # unsealed headers are rejected
+    header_sync = HeaderSync("a", header_page_size=10)
+    header_sync.next_requests()
+    headers = server.get_headers(0, 10)
+    headers[0] = create_block_instant([], headers[0].prev_block_hash).block_header
+    try:
+        header_sync.headers_received(headers, 0)
+        assert False
+    except ValueError:
+        pass
+
+    # as are headers that do not form a chain, or start from an unknown block
+    for headers in [server.get_headers(0, 1) * 2, server.get_headers(1, 10)]:
+        header_sync = HeaderSync("a", header_page_size=10)
+        header_sync.next_requests()
+        try:
+            header_sync.headers_received(headers, 0)
+            assert False
+        except ValueError:
+            pass
+
+    # replies to other requests are ignored
+    header_sync = HeaderSync("a", header_page_size=10)
+    header_sync.next_requests()
+    header_sync.headers_received(server.get_headers(1, 10), 1, ["other"])
+    assert header_sync.num_headers == 0
+
+
+def test_header_sync_assume_valid():
+    # a chain whose blocks are not sealed, with a checkpoint at the last one
+    blocks = []
+    prev_hash = NULL_BLOCK_HASH
+    for i in range(6):
+        blocks.append(create_block_instant(create_transactions_2([1], [2 * i], [2]), prev_hash, difficulty=4))
+        prev_hash = blocks[-1].hash()
+    server = BlockChain(trans_per_block=2, difficulty=1, assume_valid_hashes=[blocks[5].hash()])
+    assert server.add_incoming_blocks(blocks) == blocks
+
+    # the seals of the checkpoint and its ancestors are not checked, in the
+    # headers or the bodies, even though they arrive in different pages
+    client = BlockChain(trans_per_block=2, difficulty=1, assume_valid_hashes=[blocks[5].hash()])
+    downloader = BlockDownloadScheduler(["a"], chunk_size=2, max_chunks_per_peer=1)
+    header_sync = HeaderSync("a", client.block_map, engine=client.consensus, header_page_size=2,
+                             downloader=downloader,
+                             assume_valid_hashes=client.fork_manager.assume_valid.checkpoint_hashes)
+    run_sync(header_sync, {"a": server}, client)
+    assert client.main_chain == server.main_chain
+    assert len(client.main_chain) == 6
+
+    # but the seals of the headers after the checkpoint are
+    header_sync = HeaderSync("a", engine=client.consensus, header_page_size=2,
+                             assume_valid_hashes=[blocks[3].hash()])
+    header_sync.next_requests()
+    header_sync.headers_received(server.get_headers(0, 2), 0)
+    header_sync.next_requests()
+    header_sync.headers_received(server.get_headers(2, 2), 2)
+    assert len(header_sync.downloader) == 4
+    header_sync.next_requests()
+    try:
+        header_sync.headers_received(server.get_headers(4, 2), 4)
+        assert False
+    except ValueError:
+        pass
+
+    # as are those of all the headers if the checkpoint is not in the chain
+    header_sync = HeaderSync("a", engine=client.consensus, header_page_size=4, assume_valid_hashes=["other"])
+    header_sync.next_requests()
+    header_sync.headers_received(server.get_headers(0, 4), 0)
+    assert len(header_sync.downloader) == 0
+    header_sync.next_requests()
+    try:
+        header_sync.headers_received(server.get_headers(4, 4), 4)
+        assert False
+    except ValueError:
+        pass
+
+
+def test_header_sync_timeout():
+    server = BlockChain(trans_per_block=2, difficulty=1)
+    server.add_transactions(create_transactions_2([1], [0], [5]))
+
+    # a sync peer which does not reply is replaced by another peer
+    downloader = BlockDownloadScheduler(["a", "b", "c"], chunk_size=2, timeout=5.0)
+    header_sync = HeaderSync("a", header_page_size=10, downloader=downloader)
+    assert header_sync.next_requests(now=0.0) == [("a", GET_HEADERS, ([], 10))]
+    assert header_sync.next_requests(now=1.0) == []
+    assert header_sync.next_requests(now=5.0) == [("b", GET_HEADERS, ([], 10))]
+    assert header_sync.sync_peer == "b" and downloader.peers == ["b", "c"]
+    start_height, headers = server.get_headers_after([], 10)
+    header_sync.headers_received(headers, start_height, [])
+
+    # as is one which does not send its free transactions
+    for peer, msg_type, data in header_sync.next_requests(now=6.0):
+        header_sync.blocks_received(data[0], server.get_inventory(data[1], [])[0])
+    assert header_sync.next_requests(now=6.0) == [("b", GET_MEMPOOL, (None, 0))]
+    assert header_sync.next_requests(now=11.0) == [("c", GET_MEMPOOL, (None, 0))]
+
+    # a late reply from the peer which timed out does not end the sync
+    assert header_sync.trans_received(server.get_trans_not_added(), True, 0, "b") == []
+    assert not header_sync.is_done()
+
+    # the last peer is asked again
+    assert header_sync.next_requests(now=16.0) == [("c", GET_MEMPOOL, (None, 0))]
+    header_sync.trans_received(server.get_trans_not_added(), True)
+    assert header_sync.is_done()
+
+
+def test_header_sync_stale_blocks():
+    server = BlockChain(trans_per_block=1, difficulty=1)
+    server.add_transactions(create_transactions_2([1], [0], [2]))
+    start_height, headers = server.get_headers_after([], 10)
+
+    # a late reply to the same chunk of an earlier sync is ignored
+    downloader = BlockDownloadScheduler(["a", "b"], chunk_size=1, max_chunks_per_peer=1)
+    header_sync = HeaderSync("a", header_page_size=10, downloader=downloader, generation=2)
+    header_sync.next_requests(now=0.0)
+    header_sync.headers_received(headers, start_height, [])
+    requests = header_sync.next_requests(now=0.0)
+    assert [(peer, data[0], data[2]) for peer, _, data in requests] == [("a", 0, 2), ("b", 1, 2)]
+    assert header_sync.blocks_received(0, [], 1) == []
+    assert header_sync.next_requests(now=0.0) == []
+    assert len(downloader.failed) == 0
+
+    blocks = server.get_inventory(server.main_chain, [])[0]
+    assert header_sync.blocks_received(0, blocks[0:1], 2) == blocks[0:1]
+    assert header_sync.blocks_received(1, blocks[1:2], 2) == blocks[1:2]
+
+
+def test_header_sync_stale_trans():
+    trans_list = create_transactions_2([1], [0], [2])
+
+    # the last chunk of the free transactions of an earlier sync does not
+    # end a sync which is still fetching headers
+    header_sync = HeaderSync("a", generation=2)
+    header_sync.next_requests()
+    assert header_sync.trans_received(trans_list, True) == []
+    assert header_sync.trans_received(trans_list, True, 1, "a") == []
+    assert not header_sync.is_done()
+
+    # nor one fetching the free transactions, unless it is for this sync
+    header_sync.headers_received([], 0, [])
+    assert header_sync.next_requests() == [("a", GET_MEMPOOL, (None, 2))]
+    assert header_sync.trans_received(trans_list, True, 1, "a") == []
+    assert header_sync.trans_received(trans_list, True, 2, "b") == []
+    assert not header_sync.is_done()
+    assert header_sync.trans_received(trans_list, True, 2, "a") == trans_list
+    assert header_sync.is_done()
+
+
+def test_block_download_scheduler():
+    server = BlockChain(trans_per_block=1, difficulty=1)
+    server.add_transactions(create_transactions_2([1], [0], [6]))
+    hashes = server.main_chain
+    get_blocks = lambda block_hashes: server.get_inventory(block_hashes, [])[0]
+
+    # chunks are spread over the peers, within their in-flight limits
+    downloader = BlockDownloadScheduler(["a", "b"], chunk_size=1, max_chunks_per_peer=2, timeout=5.0)
+    downloader.add_hashes(hashes)
+    requests = downloader.next_requests(now=0.0)
+    assert [(peer, chunk) for peer, _, chunk in requests] == \
+        [("a", hashes[0:1]), ("b", hashes[1:2]), ("a", hashes[2:3]), ("b", hashes[3:4])]
+    assert downloader.next_requests(now=1.0) == []
+
+    # blocks are returned in order, whichever peer answers first
+    chunk_ids = [chunk_id for _, chunk_id, _ in requests]
+    assert downloader.blocks_received(chunk_ids[1], get_blocks(hashes[1:2])) == []
+    assert downloader.blocks_received(chunk_ids[3], get_blocks(hashes[3:4])) == []
+    ready = downloader.blocks_received(chunk_ids[0], get_blocks(hashes[0:1]))
+    assert [block.hash() for block in ready] == hashes[0:2]
+
+    # a block left out is requested from the other peer
+    assert downloader.blocks_received(chunk_ids[2], []) == []
+    requests = downloader.next_requests(now=1.0)
+    assert [(peer, chunk) for peer, _, chunk in requests] == \
+        [("a", hashes[4:5]), ("b", hashes[2:3]), ("a", hashes[5:6])]
+
+    # as are blocks whose chunk timed out
+    requests = downloader.next_requests(now=6.0)
+    assert [(peer, chunk) for peer, _, chunk in requests] == [("b", hashes[2:3]), ("b", hashes[4:5])]
+
+    # a late reply is still used, and a peer removed has its chunks requested again
+    ready = downloader.blocks_received(chunk_ids[2], get_blocks(hashes[2:3]))
+    assert [block.hash() for block in ready] == hashes[2:4]
+    downloader.remove_peer("b")
+    requests = downloader.next_requests(now=6.0)
+    assert [(peer, chunk) for peer, _, chunk in requests] == [("a", hashes[4:5]), ("a", hashes[5:6])]
+    assert downloader.blocks_received(requests[1][1], get_blocks(hashes[5:6])) == []
+    ready = downloader.blocks_received(requests[0][1], get_blocks(hashes[4:5]))
+    assert [block.hash() for block in ready] == hashes[4:6]
+    assert len(downloader) == 0
+
+if __name__ == '__main__':
+    test_header_sync()
+    test_block_locator_sync()
+    test_header_sync_invalid()
+    test_header_sync_assume_valid()
+    test_header_sync_timeout()
+    test_header_sync_stale_blocks()
+    test_header_sync_stale_trans()
+    test_block_download_scheduler()
@@ -169,7 +169,39 @@ def test_transaction_manager_get_valid():
                                     (base_trans_nos[user] + num_trans[user])))
 
 
+def test_transaction_manager_release():
+    free_trans_manager = FreeTransactionManager()
+    trans = [Transaction(user_id="User 1",
+                         trans_no=trans_no,
+                         trans_details=f"Pay Bob {trans_no} Gold coins")
+             for trans_no in range(10)]
+    for tr in trans:
+        free_trans_manager.add_transaction(tr)
+
+    # put the transactions in a block
+    free_trans_manager.remove_older_and_equal_trans(trans)
+    assert free_trans_manager.num_free() == 0
+    assert free_trans_manager.user_confirmed["User 1"].num_intervals() == 1
+    try:
+        free_trans_manager.add_transaction(trans[3])
+    except TransWasAlreadyAddedError:
+        pass
+    else:
+        assert False
+
+    # the block is dropped but the longest fork still has the first 5
+    num_released = free_trans_manager.release_transactions(trans, lambda user_id: 4)
+    assert num_released == 5
+    assert free_trans_manager.num_free() == 5
+    valid_trans = free_trans_manager.get_valid_trans(lambda user_id: 4)
+    assert [tr.trans_no for tr in valid_trans] == list(range(5, 10))
+
+    # releasing again does nothing
+    assert free_trans_manager.release_transactions(trans, lambda user_id: 4) == 0
+
+
 if __name__ == '__main__':
     test_transaction()
     test_transaction_manager_add()
-    test_transaction_manager_get_valid()
\ No newline at end of file
+    test_transaction_manager_get_valid()
+    test_transaction_manager_release()
\ No newline at end of file